@@ -0,0 +1,101 @@
+<?php
+/***
+ * Copyright (c) 2012, Zoptimizer, LightyBolt
+ * All rights reserved.
+ *
+ * This work is licensed under
+ * the Creative Commons Attribution-NonCommercial-NoDerivs 3.0 Unported License.
+ *
+ * To view a copy of this license, visit
+ *
+ *   http://creativecommons.org/licenses/by-nc-nd/3.0/
+ *
+ * or send a letter to
+ *
+ *   Creative Commons, 444 Castro Street, Suite 900,
+ *   Mountain View, California, 94041, USA.
+ */
+namespace Zopt\Api;
+
+require_once 'base/rpc.php';
+require_once 'api/api.php';
+
+/**
+ * The client of the api gateway in python/rpc/apiserver.py, which runs a batch of requests in one round trip.
+ *
+ * The gateway dispatches the requests at once, and streams the response of each one back as soon as it completes.
+ */
+class RpcApiClient {
+  const KIND_RESPONSE = 0;
+  const KIND_END = 1;
+
+  /**
+   * @var \Zopt\Base\RpcClient the rpc client connecting to the api gateway
+   */
+  private $_client = NULL;
+
+  /**
+   * @var int The id of the last query
+   */
+  private $_queryId = 0;
+
+  public function __construct($client) {
+    $this->_client = $client;
+  }
+
+  /**
+   * Run the requests, and pass the responses to the callback in the order they complete.
+   *
+   * @param Request[] $requests The requests
+   * @param string $authToken The authentication token
+   * @param callable $callback Called with ($id, Response) for each request
+   * @throws ServerException If the query is rejected as a whole
+   */
+  public function stream($requests, $authToken, $callback) {
+    $this->_queryId = ($this->_queryId + 1) & 0x7fffffff;
+    $query = array('requests' => array(), 'authToken' => $authToken);
+    foreach ($requests as $request) {
+      $query['requests'][] = array('id' => $request->id, 'handler' => $request->handler, 'params' => (object)$request->params);
+    }
+    try {
+      $this->_client->send(pack('V', $this->_queryId) . json_encode($query));
+      while (TRUE) {
+        $frame = $this->_client->recv();
+        $header = unpack('VqueryId/Ckind', $frame);
+        if ($header['queryId'] !== $this->_queryId) {
+          $this->_client->close();
+          throw new ServerException("Mismatched response for query {$this->_queryId}");
+        }
+        $output = json_decode(substr($frame, 5), TRUE);
+        if ($header['kind'] === self::KIND_END) break;
+        call_user_func($callback, $output['id'], new Response(
+            isset($output['data']) ? $output['data'] : NULL,
+            isset($output['error']) ? $output['error'] : NULL
+        ));
+      }
+    } catch (\Zopt\Base\RpcException $e) {
+      throw new ServerException($e->getMessage(), $e->getCode(), $e);
+    }
+    if (isset($output['error'])) throw new ServerException($output['error']);
+  }
+
+  /**
+   * Run the requests, the same as Server::run.
+   *
+   * @param Request[] $requests The requests
+   * @param string $authToken The authentication token
+   * @return Result The result, with the error set if the query is rejected as a whole
+   */
+  public function run($requests, $authToken) {
+    $result = new Result();
+    $result->responses = array();
+    try {
+      $this->stream($requests, $authToken, function($id, $response) use ($result) {
+        $result->responses[$id] = $response;
+      });
+    } catch (ServerException $e) {
+      $result->error = $e->getMessage();
+    }
+    return $result;
+  }
+}
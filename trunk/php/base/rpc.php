@@ -0,0 +1,243 @@
+<?php
+/***
+ * Copyright (c) 2012, Zoptimizer, LightyBolt
+ * All rights reserved.
+ *
+ * This work is licensed under
+ * the Creative Commons Attribution-NonCommercial-NoDerivs 3.0 Unported License.
+ *
+ * To view a copy of this license, visit
+ *
+ *   http://creativecommons.org/licenses/by-nc-nd/3.0/
+ *
+ * or send a letter to
+ *
+ *   Creative Commons, 444 Castro Street, Suite 900,
+ *   Mountain View, California, 94041, USA.
+ */
+namespace Zopt\Base;
+
+class RpcException extends \Exception {
+}
+
+/**
+ * The server shed the request as it's overloaded, so the request could be retried later, or elsewhere.
+ */
+class RpcOverloadedException extends RpcException {
+  /**
+   * @var string The first bytes of the shed request payload
+   */
+  public $payloadHead;
+
+  public function __construct($message, $payloadHead) {
+    parent::__construct($message);
+    $this->payloadHead = $payloadHead;
+  }
+}
+
+/**
+ * The client of the python/rpc SocketServer, which speaks the NetworkChannel framing:
+ *   | 4 bytes header | optional fields | payload |
+ * See python/rpc/channel.py for the header layout.
+ */
+class RpcClient {
+  const LENGTH_MASK = 0x00ffffff;
+  const FLAG_DEADLINE = 0x01000000;
+  const FLAG_COMPRESSED = 0x02000000;
+  const FLAG_CHUNK = 0x04000000;
+  const CHUNK_LAST = 0x01;
+  const CHUNK_ABORTED = 0x02;
+  const PRIORITY_SHIFT = 27;
+  const PRIORITY_NORMAL = 0;
+  const PRIORITY_INTERACTIVE = 1;
+  const PRIORITY_BATCH = 2;
+  const CONTROL_COMPRESSION = 4;
+  const CODEC_ZLIB = 1;
+  const CONTROL_OVERLOADED = 9;
+
+  private $_host;
+  private $_port;
+
+  /**
+   * @var float Seconds to wait for a response, which is also sent to the server as the request deadline
+   */
+  private $_timeout;
+
+  /**
+   * @var bool Whether the server may compress the responses, see python/rpc/compression.py
+   */
+  private $_compression;
+
+  /**
+   * @var resource The persistent socket, NULL if not connected
+   */
+  private $_socket = NULL;
+
+  public function __construct($host, $port, $timeout = 1.0, $compression = FALSE) {
+    $this->_host = $host;
+    $this->_port = $port;
+    $this->_timeout = $timeout;
+    $this->_compression = $compression;
+  }
+
+  private function _connect() {
+    if (!is_null($this->_socket)) return;
+    $socket = @pfsockopen($this->_host, $this->_port, $errno, $errstr, $this->_timeout);
+    if ($socket === FALSE) throw new RpcException("Failed to connect to {$this->_host}:{$this->_port}: $errstr", $errno);
+    stream_set_timeout($socket, (int)$this->_timeout, (int)(($this->_timeout - (int)$this->_timeout) * 1000000));
+    $this->_socket = $socket;
+    // a persistent socket may have been set up by an earlier request, resending it is harmless.
+    if ($this->_compression) $this->_write(pack('VCC', 0x100000000 - 2, self::CONTROL_COMPRESSION, 1 << self::CODEC_ZLIB));
+  }
+
+  /**
+   * @return float Seconds to wait for a response
+   */
+  public function getTimeout() {
+    return $this->_timeout;
+  }
+
+  /**
+   * Close the connection, e.g. when a response is broken.
+   */
+  public function close() {
+    if (is_null($this->_socket)) return;
+    fclose($this->_socket);
+    $this->_socket = NULL;
+  }
+
+  private function _write($data) {
+    for ($written = 0, $length = strlen($data); $written < $length; $written += $num) {
+      $num = fwrite($this->_socket, substr($data, $written));
+      if (($num === FALSE) || ($num === 0)) {
+        $this->close();
+        throw new RpcException("Failed to send to {$this->_host}:{$this->_port}");
+      }
+    }
+  }
+
+  private function _read($length) {
+    $data = '';
+    while (strlen($data) < $length) {
+      $chunk = fread($this->_socket, $length - strlen($data));
+      if (($chunk === FALSE) || ($chunk === '')) {
+        $this->close();
+        throw new RpcException("Failed to receive from {$this->_host}:{$this->_port}");
+      }
+      $data .= $chunk;
+    }
+    return $data;
+  }
+
+  /**
+   * Send a request without waiting for its response, so that requests could be pipelined.
+   *
+   * @param string $payload The request payload
+   * @param int $priority The priority class of the request, one of PRIORITY_*
+   * @throws RpcException
+   */
+  public function send($payload, $priority = self::PRIORITY_NORMAL) {
+    if (strlen($payload) > self::LENGTH_MASK) throw new RpcException("Payload of " . strlen($payload) . " bytes is too large");
+    $this->_connect();
+    $header = strlen($payload) | self::FLAG_DEADLINE | ($priority << self::PRIORITY_SHIFT);
+    $this->_write(pack('VV', $header, (int)($this->_timeout * 1000)) . $payload);
+  }
+
+  /**
+   * Send a streamed request, chunk by chunk, so that it needn't be built in memory as a whole.
+   *
+   * @param array|\Traversable $chunks The chunks of the request, each less than 16M bytes
+   * @throws RpcException
+   */
+  public function sendStream($chunks) {
+    $this->_connect();
+    foreach ($chunks as $chunk) {
+      if (strlen($chunk) > self::LENGTH_MASK) throw new RpcException("Chunk of " . strlen($chunk) . " bytes is too large");
+      $this->_write(pack('VC', strlen($chunk) | self::FLAG_CHUNK, 0) . $chunk);
+    }
+    $this->_write(pack('VC', self::FLAG_CHUNK, self::CHUNK_LAST));
+  }
+
+  /**
+   * Receive the next response, passing each chunk of a streamed response to the callback as it arrives.
+   *
+   * A response which isn't streamed is passed as a single chunk.
+   *
+   * @param callable $callback Called with each chunk of the response
+   * @throws RpcException If the server aborted the response
+   * @throws RpcOverloadedException If the server shed the request
+   */
+  public function recvStream($callback) {
+    do {
+      $chunk = $this->_recvFrame($chunkFlags);
+      if (($chunkFlags & self::CHUNK_ABORTED) !== 0) {
+        throw new RpcException("Aborted streamed response from {$this->_host}:{$this->_port}");
+      }
+      if ($chunk !== '') call_user_func($callback, $chunk);
+    } while (!is_null($chunkFlags) && (($chunkFlags & self::CHUNK_LAST) === 0));
+  }
+
+  /**
+   * Receive the next response.
+   *
+   * @return string The response payload, or the whole of a streamed response
+   * @throws RpcException
+   */
+  public function recv() {
+    $payload = '';
+    $this->recvStream(function($chunk) use (&$payload) {
+      $payload .= $chunk;
+    });
+    return $payload;
+  }
+
+  /**
+   * Receive the next data frame.
+   *
+   * @param int $chunkFlags Set to the chunk flags of the frame, NULL if it isn't a chunk
+   * @return string The frame payload
+   * @throws RpcException
+   */
+  private function _recvFrame(&$chunkFlags) {
+    $this->_connect();
+    $chunkFlags = NULL;
+    while (TRUE) {
+      $header = unpack('V', $this->_read(4));
+      $header = $header[1];
+      if ($header & 0x80000000) {  // a control message, of length -header
+        $control = $this->_read(0x100000000 - $header);
+        if (ord($control) === self::CONTROL_OVERLOADED) {
+          throw new RpcOverloadedException("Overloaded server {$this->_host}:{$this->_port}", substr($control, 1));
+        }
+        continue;
+      }
+      if ($header & self::FLAG_DEADLINE) $this->_read(4);
+      if ($header & self::FLAG_COMPRESSED) $field = unpack('Ccodec/VrawLength', $this->_read(5));
+      if ($header & self::FLAG_CHUNK) {
+        $chunkFlags = unpack('C', $this->_read(1));
+        $chunkFlags = $chunkFlags[1];
+      }
+      $payload = $this->_read($header & self::LENGTH_MASK);
+      if (!($header & self::FLAG_COMPRESSED)) return $payload;
+      if ($field['codec'] === self::CODEC_ZLIB) $payload = @gzuncompress($payload, $field['rawLength']);
+      if (($field['codec'] !== self::CODEC_ZLIB) || ($payload === FALSE) || (strlen($payload) !== $field['rawLength'])) {
+        $this->close();
+        throw new RpcException("Broken compressed response from {$this->_host}:{$this->_port}");
+      }
+      return $payload;
+    }
+  }
+
+  /**
+   * Send a request and wait for its response.
+   *
+   * @param string $payload The request payload
+   * @param int $priority The priority class of the request, one of PRIORITY_*
+   * @return string The response payload
+   * @throws RpcException
+   */
+  public function call($payload, $priority = self::PRIORITY_NORMAL) {
+    $this->send($payload, $priority);
+    return $this->recv();
+  }
+}
@@ -36,28 +36,32 @@ class LocalCache implements CacheInterface {
   private $_isFuzzy = FALSE;
 
   /**
-   * @var CacheDetail[] The container for items
+   * @var CacheDetail[] The container for items, from the least recently used to the most
    */
-  private $_items;
+  private $_items = array();
 
   public function __construct($maxExpire = 0, $isFuzzy = FALSE) {
     $this->_maxExpire = $maxExpire;
     $this->_isFuzzy = $isFuzzy;
   }
 
-  private function _cleanBefore($time) {
-    if (count($this->_items) < self::$_maxCapacity) return;
-    uasort($this->_items, 'CacheDetail::cmp');
-    if ($this->_maxExpire === 0) {
-      $i = -1;
-    } else {
-      for ($count=count($this->_items), $i=$count-1; $i>=0; $i--) {
-        $validUntil = $this->_items[$i]->validUntil;
-        if (($validUntil !== 0) && ($validUntil < $time)) break;
-      }
+  /**
+   * Evict the least recently used items beyond the capacity.
+   *
+   * PHP arrays keep the insertion order, and every access re-inserts the
+   * item at the end, so the first item is always the least recently used one.
+   */
+  private function _evict() {
+    while (count($this->_items) > self::$_maxCapacity) {
+      reset($this->_items);
+      unset($this->_items[key($this->_items)]);
     }
-    $remains = min($count - $i - 1, self::$_maxCapacity / 2);
-    $this->_items = array_slice($this->_items, $count-$remains, $remains, TRUE);
+  }
+
+  private function _touch($key) {
+    $detail = $this->_items[$key];
+    unset($this->_items[$key]);
+    $this->_items[$key] = $detail;
   }
 
   /**
@@ -66,8 +70,9 @@ class LocalCache implements CacheInterface {
   public function set($key, $val, $ttl = 0) {
     $current = time();
     $ttl = getTtl($ttl, $this->_maxExpire);
+    unset($this->_items[$key]);
     $this->_items[$key] = new CacheDetail($val, ($ttl === 0) ? 0 : $ttl + $current);
-    $this->_cleanBefore($current);
+    $this->_evict();
     return TRUE;
   }
 
@@ -76,11 +81,12 @@ class LocalCache implements CacheInterface {
    */
   public function setMulti($values, $ttl = 0) {
     $current = time();
+    $ttl = getTtl($ttl, $this->_maxExpire);
     foreach ($values as $key => $val) {
-      $ttl = getTtl($ttl, $this->_maxExpire);
+      unset($this->_items[$key]);
       $this->_items[$key] = new CacheDetail($val, ($ttl === 0) ? 0 : $ttl + $current);
     }
-    $this->_cleanBefore($current);
+    $this->_evict();
     return array_keys($values);
   }
 
@@ -97,6 +103,7 @@ class LocalCache implements CacheInterface {
       }
       if ($this->_isFuzzy && isFuzzyExpired($current, $this->_items[$key]->validUntil, $this->_maxExpire / 10)) return FALSE;
     }
+    $this->_touch($key);
     return ($returnDetail) ? $this->_items[$key] : $this->_items[$key]->val;
   }
 
@@ -115,6 +122,7 @@ class LocalCache implements CacheInterface {
         }
         if ($this->_isFuzzy && isFuzzyExpired($current, $this->_items[$key]->validUntil, $this->_maxExpire / 10)) continue;
       }
+      $this->_touch($key);
       $results[$key] = $returnDetail ? $this->_items[$key] : $this->_items[$key]->val;
     }
     return $results;
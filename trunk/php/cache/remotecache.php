@@ -17,6 +17,7 @@
  */
 namespace Zopt\Cache;
 
+require_once 'base/rpc.php';
 require_once 'cache/cache.php';
 
 class MemCache implements CacheInterface {
@@ -134,3 +135,264 @@ class MemCache implements CacheInterface {
     return $res;
   }
 }
+
+/**
+ * The cache backed by python/rpc/cacheserver.py, see there for the protocol.
+ */
+class RpcCache implements CacheInterface {
+  const OP_GET = 1;
+  const OP_SET = 2;
+  const OP_REMOVE = 3;
+  const OP_STATS = 4;
+  const OP_LEASE_GET = 5;
+
+  // the status of the items in an OP_LEASE_GET response
+  const STATUS_HIT = 0;
+  const STATUS_REFRESH = 1;
+  const STATUS_LEASE = 2;
+
+  /**
+   * @var float The fraction of the client timeout before the lease of a loading key is passed to another client,
+   * less than 1 so that the waiting clients are still waiting when they get the lease
+   */
+  const LEASE_TIMEOUT_RATIO = 0.5;
+
+  /**
+   * @var \Zopt\Base\RpcClient the rpc client connecting to the cache server
+   */
+  private $_client = NULL;
+
+  /**
+   * @var int The max expire time. 0 means never expire.
+   */
+  private $_maxExpire = 0;
+
+  /**
+   * @var bool Is fuzzy expire to avoid updating at the same time
+   */
+  private $_isFuzzy = FALSE;
+
+  /**
+   * @var string The identifier of this cache to avoid collision
+   */
+  private $_id = NULL;
+
+  /**
+   * @var int The id of the last request
+   */
+  private $_requestId = 0;
+
+  public function __construct($client, $id = NULL, $maxExpire = 43200, $isFuzzy = TRUE) {  // 43200 seconds = 12 hrs
+    $this->_client = $client;
+    $this->_id = (!is_null($id) && is_string($id)) ? $id : 'rc_' . dechex(crc32('RC' . time() . rand()));
+    $this->_maxExpire = $maxExpire;
+    $this->_isFuzzy = $isFuzzy;
+  }
+
+  /**
+   * Send a request and parse the items of its response.
+   *
+   * @param int $op The request op
+   * @param string $fields The packed op fields
+   * @param string[] $items The packed items
+   * @return string The packed items of the response, preceded by the number of items
+   * @throws CacheException
+   */
+  private function _call($op, $fields, $items) {
+    $this->_requestId = ($this->_requestId + 1) & 0x7fffffff;
+    $payload = pack('CV', $op, $this->_requestId) . $fields . pack('V', count($items)) . implode('', $items);
+    try {
+      $response = $this->_client->call($payload);
+    } catch (\Zopt\Base\RpcException $e) {
+      throw new CacheException($e->getMessage(), $e->getCode(), $e);
+    }
+    $header = unpack('Cop/VrequestId', $response);
+    if (($header['op'] !== $op) || ($header['requestId'] !== $this->_requestId)) {
+      $this->_client->close();
+      throw new CacheException("Mismatched response for request {$this->_requestId}");
+    }
+    return substr($response, 5);
+  }
+
+  private function _packKey($key) {
+    $internalKey = $this->_id . $key;
+    return pack('v', strlen($internalKey)) . $internalKey;
+  }
+
+  /**
+   * Parse the keys of the failed items in a set / remove response.
+   */
+  private function _parseKeys($body) {
+    $keys = array();
+    $count = unpack('V', $body);
+    $idLength = strlen($this->_id);
+    for ($i=0, $pos=4; $i<$count[1]; $i++) {
+      $length = unpack('v', substr($body, $pos, 2));
+      $keys[] = substr($body, $pos + 2 + $idLength, $length[1] - $idLength);
+      $pos += 2 + $length[1];
+    }
+    return $keys;
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  public function set($key, $val, $ttl = 0) {
+    $errorKeys = $this->setMulti(array($key => $val), $ttl);
+    return empty($errorKeys);
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  public function setMulti($values, $ttl = 0) {
+    $ttl = getTtl($ttl, $this->_maxExpire);
+    $items = array();
+    foreach ($values as $key => $val) {
+      $data = serialize($val);
+      $items[] = $this->_packKey($key) . pack('V', strlen($data)) . $data;
+    }
+    return $this->_parseKeys($this->_call(self::OP_SET, pack('V', $ttl), $items));
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  public function get($key, $returnDetail = FALSE) {
+    $results = $this->getMulti(array($key), $returnDetail);
+    return isset($results[$key]) ? $results[$key] : FALSE;
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  public function getMulti($keys, $returnDetail = FALSE) {
+    if (empty($keys)) return array();
+    $items = array();
+    foreach ($keys as $key) {
+      $items[] = $this->_packKey($key);
+    }
+    // the server applies the fuzzy expiry, in the same way as isFuzzyExpired.
+    $fuzzyRange = $this->_isFuzzy ? (int)($this->_maxExpire / 10) : 0;
+    $body = $this->_call(self::OP_GET, pack('V', $fuzzyRange), $items);
+    $results = array();
+    $idLength = strlen($this->_id);
+    foreach ($this->_parseValues($body) as $internalKey => $detail) {
+      $val = unserialize($detail->val);
+      $results[substr($internalKey, $idLength)] = $returnDetail ? new CacheDetail($val, $detail->validUntil) : $val;
+    }
+    return $results;
+  }
+
+  /**
+   * Parse the items of a get / stats response.
+   *
+   * @return CacheDetail[string] The raw values and their expiry time by the keys
+   */
+  private function _parseValues($body) {
+    $results = array();
+    $count = unpack('V', $body);
+    for ($i=0, $pos=4; $i<$count[1]; $i++) {
+      $length = unpack('v', substr($body, $pos, 2));
+      $key = substr($body, $pos + 2, $length[1]);
+      $pos += 2 + $length[1];
+      $detail = unpack('VvalidUntil/Vlength', substr($body, $pos, 8));
+      $results[$key] = new CacheDetail(substr($body, $pos + 8, $detail['length']), $detail['validUntil']);
+      $pos += 8 + $detail['length'];
+    }
+    return $results;
+  }
+
+  /**
+   * Get the items, and load the missing ones with only one client loading each key.
+   *
+   * Concurrent misses of a key are coalesced by the server: the first client gets the lease to load it,
+   * and the others wait for it to be set.  The items expiring within $refreshAhead seconds are refreshed
+   * by the one client holding their lease, while the others keep using the cached values.
+   *
+   * @param string[] $keys The keys of the items
+   * @param callable $loader Load the items from the backend, function($keys) returning the values by the keys
+   * @param int $ttl Seconds that the loaded items will exist
+   * @param int $refreshAhead Seconds before the expiry to refresh the items, default to a tenth of the max expire
+   * @return mixed[string] The values by the keys, without the ones the loader failed to load
+   * @throws CacheException
+   */
+  public function fetchMulti($keys, $loader, $ttl = 0, $refreshAhead = NULL) {
+    if (empty($keys)) return array();
+    $items = array();
+    foreach ($keys as $key) {
+      $items[] = $this->_packKey($key);
+    }
+    if (is_null($refreshAhead)) $refreshAhead = (int)($this->_maxExpire / 10);
+    $leaseTimeout = (int)($this->_client->getTimeout() * self::LEASE_TIMEOUT_RATIO * 1000);  // in milliseconds
+    $body = $this->_call(self::OP_LEASE_GET, pack('VV', $refreshAhead, $leaseTimeout), $items);
+    $results = array();
+    $leasedKeys = array();
+    $idLength = strlen($this->_id);
+    $count = unpack('V', $body);
+    for ($i=0, $pos=4; $i<$count[1]; $i++) {
+      $length = unpack('v', substr($body, $pos, 2));
+      $key = substr($body, $pos + 2 + $idLength, $length[1] - $idLength);
+      $pos += 2 + $length[1];
+      $detail = unpack('Cstatus/VvalidUntil/Vlength', substr($body, $pos, 9));
+      if ($detail['status'] !== self::STATUS_LEASE) $results[$key] = unserialize(substr($body, $pos + 9, $detail['length']));
+      if ($detail['status'] !== self::STATUS_HIT) $leasedKeys[] = $key;
+      $pos += 9 + $detail['length'];
+    }
+    if (!empty($leasedKeys)) {
+      $values = call_user_func($loader, $leasedKeys);
+      if (!empty($values)) {
+        $this->setMulti($values, $ttl);
+        $results = $values + $results;  // the refreshed values win, keeping the numeric keys
+      }
+    }
+    return $results;
+  }
+
+  /**
+   * Get the item, and load it if missing with only one client loading it.  See fetchMulti.
+   *
+   * @return mixed The value, FALSE if the loader failed to load it
+   * @throws CacheException
+   */
+  public function fetch($key, $loader, $ttl = 0, $refreshAhead = NULL) {
+    $results = $this->fetchMulti(array($key), function($keys) use ($loader) {
+      $val = call_user_func($loader, $keys[0]);
+      return ($val === FALSE) ? array() : array($keys[0] => $val);
+    }, $ttl, $refreshAhead);
+    return isset($results[$key]) ? $results[$key] : FALSE;
+  }
+
+  /**
+   * Get the statistics of the cache server, e.g. hits, misses, evictions.
+   *
+   * @return int[string] The stats of each shard, by "<worker pid>:<stat name>"
+   * @throws CacheException
+   */
+  public function stats() {
+    $stats = array();
+    foreach ($this->_parseValues($this->_call(self::OP_STATS, '', array())) as $name => $detail) {
+      $stats[$name] = (int)$detail->val;
+    }
+    return $stats;
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  public function remove($key) {
+    $errorKeys = $this->removeMulti(array($key));
+    return empty($errorKeys);
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  public function removeMulti($keys) {
+    $items = array();
+    foreach ($keys as $key) {
+      $items[] = $this->_packKey($key);
+    }
+    return $this->_parseKeys($this->_call(self::OP_REMOVE, '', $items));
+  }
+}
@@ -0,0 +1,153 @@
+<?php
+/***
+ * Copyright (c) 2012, Zoptimizer, LightyBolt
+ * All rights reserved.
+ *
+ * This work is licensed under
+ * the Creative Commons Attribution-NonCommercial-NoDerivs 3.0 Unported License.
+ *
+ * To view a copy of this license, visit
+ *
+ *   http://creativecommons.org/licenses/by-nc-nd/3.0/
+ *
+ * or send a letter to
+ *
+ *   Creative Commons, 444 Castro Street, Suite 900,
+ *   Mountain View, California, 94041, USA.
+ */
+namespace Zopt\Geo;
+
+require_once 'base/rpc.php';
+require_once 'geo/location.php';
+
+/**
+ * The client of the geo server in python/rpc/geoserver.py, which indexes the locations by id,
+ * so that the nearby ones are found without scanning all of them.
+ */
+class RpcGlobe {
+  const OP_PUT = 1;
+  const OP_REMOVE = 2;
+  const OP_RADIUS = 3;
+  const OP_NEAREST = 4;
+  const OP_DIST = 5;
+
+  /**
+   * @var \Zopt\Base\RpcClient the rpc client connecting to the geo server
+   */
+  private $_client = NULL;
+
+  /**
+   * @var int The id of the last request
+   */
+  private $_requestId = 0;
+
+  public function __construct($client) {
+    $this->_client = $client;
+  }
+
+  /**
+   * Send a request and return the items of its response.
+   *
+   * @return string The packed items of the response, preceded by the number of items
+   * @throws \Zopt\Base\RpcException
+   */
+  private function _call($op, $fields, $items) {
+    $this->_requestId = ($this->_requestId + 1) & 0x7fffffff;
+    $payload = pack('CV', $op, $this->_requestId) . $fields . pack('V', count($items)) . implode('', $items);
+    $response = $this->_client->call($payload);
+    $header = unpack('Cop/VrequestId', $response);
+    if (($header['op'] !== $op) || ($header['requestId'] !== $this->_requestId)) {
+      $this->_client->close();
+      throw new \Zopt\Base\RpcException("Mismatched response for request {$this->_requestId}");
+    }
+    return substr($response, 5);
+  }
+
+  private function _packId($id) {
+    $id = (string)$id;
+    return pack('v', strlen($id)) . $id;
+  }
+
+  private function _packLocation($loc) {
+    return pack('dd', $loc->latitude, $loc->longitude);
+  }
+
+  /**
+   * Parse the items of a radius / nearest / dist response.
+   *
+   * @return float[string] The distances (in meter) by the ids
+   */
+  private function _parseDists($body) {
+    $dists = array();
+    $count = unpack('V', $body);
+    for ($i=0, $pos=4; $i<$count[1]; $i++) {
+      $length = unpack('v', substr($body, $pos, 2));
+      $id = substr($body, $pos + 2, $length[1]);
+      $dist = unpack('d', substr($body, $pos + 2 + $length[1], 8));
+      $dists[$id] = $dist[1];
+      $pos += 10 + $length[1];
+    }
+    return $dists;
+  }
+
+  /**
+   * Insert or move the locations.
+   *
+   * @param Location[string] $locations The locations by the ids
+   * @throws \Zopt\Base\RpcException
+   */
+  public function put($locations) {
+    $items = array();
+    foreach ($locations as $id => $loc) {
+      $items[] = $this->_packId($id) . $this->_packLocation($loc);
+    }
+    $this->_call(self::OP_PUT, '', $items);
+  }
+
+  /**
+   * Remove the locations.
+   *
+   * @param string[] $ids The ids of the locations
+   * @throws \Zopt\Base\RpcException
+   */
+  public function remove($ids) {
+    $this->_call(self::OP_REMOVE, '', array_map(array($this, '_packId'), $ids));
+  }
+
+  /**
+   * Find the locations within a radius, nearest first.
+   *
+   * @param Location $loc The center
+   * @param float $radius The radius (in meter)
+   * @param int $limit Maximum number of the locations to return, 0 for no limit
+   * @return float[string] The distances (in meter) by the ids
+   * @throws \Zopt\Base\RpcException
+   */
+  public function nearby($loc, $radius, $limit = 0) {
+    return $this->_parseDists($this->_call(self::OP_RADIUS, $this->_packLocation($loc) . pack('dV', $radius, $limit), array()));
+  }
+
+  /**
+   * Find the k nearest locations, nearest first.
+   *
+   * @param Location $loc The center
+   * @param int $k The number of the locations to return
+   * @return float[string] The distances (in meter) by the ids
+   * @throws \Zopt\Base\RpcException
+   */
+  public function nearest($loc, $k) {
+    return $this->_parseDists($this->_call(self::OP_NEAREST, $this->_packLocation($loc) . pack('V', $k), array()));
+  }
+
+  /**
+   * Calculate the distances from a location to the indexed ones in batch, the same as Globe::dist with haversine.
+   *
+   * @param Location $loc Location from
+   * @param string[] $ids The ids of the locations to
+   * @return float[string] The distances (in meter) by the ids, without the unknown ids
+   * @throws \Zopt\Base\RpcException
+   */
+  public function dists($loc, $ids) {
+    return $this->_parseDists($this->_call(self::OP_DIST, $this->_packLocation($loc), array_map(array($this, '_packId'), $ids)));
+  }
+}
@@ -0,0 +1,146 @@
+<?php
+/***
+ * Copyright (c) 2012, Zoptimizer, LightyBolt
+ * All rights reserved.
+ *
+ * This work is licensed under
+ * the Creative Commons Attribution-NonCommercial-NoDerivs 3.0 Unported License.
+ *
+ * To view a copy of this license, visit
+ *
+ *   http://creativecommons.org/licenses/by-nc-nd/3.0/
+ *
+ * or send a letter to
+ *
+ *   Creative Commons, 444 Castro Street, Suite 900,
+ *   Mountain View, California, 94041, USA.
+ */
+namespace Zopt\Rank;
+
+require_once 'base/rpc.php';
+require_once 'rank/scorers.php';
+
+/**
+ * The client of the rank server in python/rpc/rankserver.py, which scores whole candidate sets in batch.
+ *
+ * The server keeps the events of each series, and scores them with the scorer configured for the series,
+ * i.e. the vectorized SumScorer or AnnealScorer.
+ */
+class RpcRanker {
+  const OP_ADD = 1;
+  const OP_SET_CURRENT = 2;
+  const OP_RANK = 3;
+  const OP_TOP = 4;
+
+  /**
+   * @var \Zopt\Base\RpcClient the rpc client connecting to the rank server
+   */
+  private $_client = NULL;
+
+  /**
+   * @var int The id of the last request
+   */
+  private $_requestId = 0;
+
+  public function __construct($client) {
+    $this->_client = $client;
+  }
+
+  /**
+   * Send a request and return the items of its response.
+   *
+   * @return string The packed items of the response, preceded by the number of items
+   * @throws \Zopt\Base\RpcException
+   */
+  private function _call($op, $fields, $items) {
+    $this->_requestId = ($this->_requestId + 1) & 0x7fffffff;
+    $payload = pack('CV', $op, $this->_requestId) . $fields . pack('V', count($items)) . implode('', $items);
+    $response = $this->_client->call($payload);
+    $header = unpack('Cop/VrequestId', $response);
+    if (($header['op'] !== $op) || ($header['requestId'] !== $this->_requestId)) {
+      $this->_client->close();
+      throw new \Zopt\Base\RpcException("Mismatched response for request {$this->_requestId}");
+    }
+    return substr($response, 5);
+  }
+
+  /**
+   * Add the events of the items to a series.
+   *
+   * @param string $series The name of the series
+   * @param ScoreEvent[][string] $events The events by the items
+   * @throws \Zopt\Base\RpcException
+   */
+  public function addEvents($series, $events) {
+    $items = array();
+    foreach ($events as $item => $itemEvents) {
+      $item = (string)$item;
+      foreach ($itemEvents as $event) {
+        $items[] = pack('v', strlen($item)) . $item . pack('V', $event->timestamp) . pack('d', $event->score);
+      }
+    }
+    $this->_call(self::OP_ADD, pack('C', strlen($series)) . $series, $items);
+  }
+
+  /**
+   * Set the time point to score the events at.
+   *
+   * @param int $current The UNIX timestamp, NULL to follow the clock of the server
+   * @throws \Zopt\Base\RpcException
+   */
+  public function setCurrent($current = NULL) {
+    $this->_call(self::OP_SET_CURRENT, pack('V', is_null($current) ? 0 : $current), array());
+  }
+
+  /**
+   * Rank the items by the weighted sum of their scores in the series.
+   *
+   * @param string[] $items The candidate items
+   * @param float[string] $weights The weights by the series
+   * @param int $topK The number of the top items to return, 0 for all the items in their original order
+   * @return float[string] The scores by the items, from high to low if $topK is not 0
+   * @throws \Zopt\Base\RpcException
+   */
+  public function rank($items, $weights, $topK = 0) {
+    $fields = pack('VC', $topK, count($weights));
+    foreach ($weights as $series => $weight) {
+      $fields .= pack('C', strlen($series)) . $series . pack('d', $weight);
+    }
+    $packedItems = array();
+    foreach ($items as $item) {
+      $item = (string)$item;
+      $packedItems[] = pack('v', strlen($item)) . $item;
+    }
+    return $this->_parseScores($this->_call(self::OP_RANK, $fields, $packedItems));
+  }
+
+  /**
+   * Get the top items of a series by their current scores, without any candidate set.
+   *
+   * The series should have a ScoreIndex on the server, see python/rpc/scoreindex.py.
+   *
+   * @param string $series The name of the series
+   * @param int $topK The number of the top items to return
+   * @return float[string] The scores by the items, from high to low
+   * @throws \Zopt\Base\RpcException
+   */
+  public function top($series, $topK) {
+    return $this->_parseScores($this->_call(self::OP_TOP, pack('VC', $topK, strlen($series)) . $series, array()));
+  }
+
+  /**
+   * Parse the items of a rank / top response.
+   */
+  private function _parseScores($body) {
+    $scores = array();
+    $count = unpack('V', $body);
+    for ($i=0, $pos=4; $i<$count[1]; $i++) {
+      $length = unpack('v', substr($body, $pos, 2));
+      $item = substr($body, $pos + 2, $length[1]);
+      $score = unpack('d', substr($body, $pos + 2 + $length[1], 8));
+      $scores[$item] = $score[1];
+      $pos += 10 + $length[1];
+    }
+    return $scores;
+  }
+}
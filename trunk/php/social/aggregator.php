@@ -24,12 +24,12 @@ class Aggregator implements SocialProviderInterface {
   /**
    * @var SocialProviderInterface[int] An array of social networks
    */
-  private $_providers = array();
+  protected $_providers = array();
 
   /**
    * @var IdentityManagerInterface The identity manager handles snuid mappings
    */
-  private $_identityMgr = NULL;
+  protected $_identityMgr = NULL;
 
   public function __construct($identityMgr, $providers = array()) {
     $this->_identityMgr = $identityMgr;
@@ -50,6 +50,81 @@ class Aggregator implements SocialProviderInterface {
     return $ret;
   }
 
+  /**
+   * Query the users of the non-local social providers
+   *
+   * @param string[][int] $categorizedUids The uids by the snids
+   * @param UserIdentity[int] $snEgos The identities of the user who init the query by the snids, or NULL
+   * @return mixed[] array($users, $missedSnuids), the User array keyed with snuid, and the snuids can not be fetched
+   */
+  protected function _getSnUsers($categorizedUids, $snEgos) {
+    $ret = array();
+    $missedSnuids = array();
+    foreach ($categorizedUids as $snid => $uids) {
+      if (!isset($this->_providers[$snid])) {  // the given snid provider is not registered
+        foreach ($uids as $uid) {
+          $missedSnuids[] = "$snid:$uid";
+        }
+        continue;
+      }
+      $snEgo = (!is_null($snEgos) && isset($snEgos[$snid])) ? $snEgos[$snid] : NULL;
+      $snUsers = $this->_providers[$snid]->getUsers($uids, $snEgo);
+      foreach ($uids as $uid) {
+        $snuid = "$snid:$uid";
+        if (!isset($snUsers[$uid])) {
+          $missedSnuids[] = $snuid;
+        } else {
+          $ret[$snuid] = $snUsers[$uid];
+          $ret[$snuid]->id = $snuid;  // output marshaling
+        }
+      }
+    }
+    return array($ret, $missedSnuids);
+  }
+
+  /**
+   * Map the snuids to the uids of a social provider
+   *
+   * @param string[] $snuids The snuids
+   * @param UserIdentity[int][string] $mappings The identities of the snuids
+   * @param int $snid The social network ID
+   * @return string[] The uids in the social network
+   */
+  protected function _getSnUids($snuids, $mappings, $snid) {
+    $uids = array();
+    foreach ($snuids as $snuid) {
+      if (isset($mappings[$snuid][$snid])) {
+        $uids[] = $mappings[$snuid][$snid]->id;
+        continue;
+      }
+      list($uidSnid, $uid) = explode(':', $snuid);
+      if ($uidSnid == $snid) $uids[] = $uid;  // '==' instead of '===' as snid is int
+    }
+    return $uids;
+  }
+
+  /**
+   * Query the friends in all the networks
+   *
+   * @param UserIdentity[int] $identities The identities of the user by the snids
+   * @param UserIdentity[int][string] $mappings The identities of the excludes and includes
+   * @param string[] $excludes The excluded snuid list
+   * @param string[] $includes The included snuid list
+   * @param mixed[string] $criteria The hints that are used to tune the ranking
+   * @param int $snCount The number of items returned by each network, NULL (till the end)
+   * @return float[string][string][int] The friends list of each network keyed with snid
+   */
+  protected function _getSnFriends($identities, $mappings, $excludes, $includes, $criteria, $snCount) {
+    $snFriends = array();
+    foreach ($identities as $snid => $identity) {
+      if (!isset($this->_providers[$snid])) continue;  // the given snid is not registered
+      $snExcludes = $this->_getSnUids($excludes, $mappings, $snid);
+      $snIncludes = $this->_getSnUids($includes, $mappings, $snid);
+      $snFriends[$snid] = $this->_providers[$snid]->getFriends($identity, $snExcludes, $snIncludes, $criteria, 0, $snCount);
+    }
+    return $snFriends;
+  }
+
   /**
    * Returns the users
    *
@@ -83,27 +158,7 @@ class Aggregator implements SocialProviderInterface {
     unset($categorizedUids[SocialProviderConstant::LOCAL]);
 
     // query each underlying snid except the local provider
-    $ret = array();
-    $missedSnuids = array();
-    foreach ($categorizedUids as $snid => $uids) {
-      if (!isset($this->_providers[$snid])) {  // the given snid provider is not registered
-        foreach ($uids as $uid) {
-          $missedSnuids[] = "$snid:$uid";
-        }
-        continue;
-      }
-      $snEgo = (!is_null($snEgos) && isset($snEgos[$snid])) ? $snEgos[$snid] : NULL;
-      $snUsers = $this->_providers[$snid]->getUsers($uids, $snEgo);
-      foreach ($uids as $uid) {
-        $snuid = "$snid:$uid";
-        if (!isset($snUsers[$uid])) {
-          $missedSnuids[] = $snuid;
-        } else {
-          $ret[$snuid] = $snUsers[$uid];
-          $ret[$snuid]->id = $snuid;  // output marshaling
-        }
-      }
-    }
+    list($ret, $missedSnuids) = $this->_getSnUsers($categorizedUids, $snEgos);
 
     $snid = SocialProviderConstant::LOCAL;
     if (!isset($this->_providers[$snid])) return $ret;
@@ -160,33 +215,9 @@ class Aggregator implements SocialProviderInterface {
     $identities = $mappings[$snuid];  // fetched all identities that this $localIdentity has
 
     // fetch friends in all the networks
-    $snFriends = array();
-    foreach ($identities as $snid => $identity) {
-      if (!isset($this->_providers[$snid])) continue;  // the given snid is not registered
-
-      // build excludes and includes based on specific snid
-      $snExcludes = array();
-      foreach ($excludes as $exclude) {
-        if (isset($mappings[$exclude][$snid])) {
-          $excludes[] = $mappings[$exclude][$snid]->id;
-          continue;
-        }
-        list($exSnid, $exUid) = explode(':', $exclude);
-        if ($exSnid == $snid) $excludes[] = $exUid;  // '==' instead of '===' as snid is int
-      }
-      $snIncludes = array();
-      foreach ($includes as $include) {
-        if (isset($mappings[$include][$snid])) {
-          $includes[] = $mappings[$include][$snid]->id;
-          continue;
-        }
-        list($inSnid, $inUid) = explode(':', $include);
-        if ($inSnid == $snid) $includes[] = $inUid;  // '==' instead of '===' as snid is int
-      }
-      // TODO: optimize the return value to a range
-      $snCount = is_null($count) ? NULL : $offset + $count;
-      $snFriends[$snid] = $this->_providers[$snid]->getFriends($identity, $excludes, $includes, $criteria, 0, $snCount);
-    }
+    // TODO: optimize the return value to a range
+    $snCount = is_null($count) ? NULL : $offset + $count;
+    $snFriends = $this->_getSnFriends($identities, $mappings, $excludes, $includes, $criteria, $snCount);
 
     // user ID mapping for all the fetched friends
     $snuids = array();
@@ -0,0 +1,149 @@
+<?php
+/***
+ * Copyright (c) 2012, Zoptimizer, LightyBolt
+ * All rights reserved.
+ *
+ * This work is licensed under
+ * the Creative Commons Attribution-NonCommercial-NoDerivs 3.0 Unported License.
+ *
+ * To view a copy of this license, visit
+ *
+ *   http://creativecommons.org/licenses/by-nc-nd/3.0/
+ *
+ * or send a letter to
+ *
+ *   Creative Commons, 444 Castro Street, Suite 900,
+ *   Mountain View, California, 94041, USA.
+ */
+namespace Zopt\Social;
+
+require_once 'base/rpc.php';
+require_once 'social/aggregator.php';
+require_once 'social/facebook/data.php';
+
+/**
+ * The aggregator which queries the remote social providers through the social server in python/rpc/socialserver.py.
+ *
+ * The server queries all the remote providers of a request concurrently, each within its own deadline, in one rpc,
+ * instead of one after another. The users of the providers which failed or timed out are missed, and mapped to
+ * the local provider the same as Aggregator. The queries with criteria, and the snids the server does not serve,
+ * go to the registered providers.
+ */
+class RpcAggregator extends Aggregator {
+  const OP_GET_USERS = 1;
+  const OP_GET_FRIENDS = 2;
+
+  const STATUS_OK = 0;
+
+  /**
+   * @var \Zopt\Base\RpcClient the rpc client connecting to the social server
+   */
+  private $_client = NULL;
+
+  /**
+   * @var int The id of the last request
+   */
+  private $_requestId = 0;
+
+  /**
+   * @var callable[int] The parsers of the raw user blobs by the snids served by the social server
+   */
+  private $_parsers;
+
+  public function __construct($client, $identityMgr, $providers = array(), $parsers = NULL) {
+    parent::__construct($identityMgr, $providers);
+    $this->_client = $client;
+    $this->_parsers = is_null($parsers) ? array(SocialProviderConstant::FACEBOOK => array('\Zopt\Social\Facebook\User', 'parse')) : $parsers;
+  }
+
+  /**
+   * Send a request and return its result.
+   *
+   * @param int $op The request op
+   * @param mixed[string] $args The arguments
+   * @return mixed The decoded result
+   * @throws SocialException
+   */
+  private function _call($op, $args) {
+    $this->_requestId = ($this->_requestId + 1) & 0x7fffffff;
+    try {
+      $response = $this->_client->call(pack('CV', $op, $this->_requestId) . json_encode((object)$args));
+    } catch (\Zopt\Base\RpcException $e) {
+      throw new SocialException($e->getMessage(), $e->getCode(), $e);
+    }
+    $header = unpack('Cop/VrequestId/Cstatus', $response);
+    if (($header['op'] !== $op) || ($header['requestId'] !== $this->_requestId)) {
+      $this->_client->close();
+      throw new SocialException("RpcAggregator: mismatched response for request {$this->_requestId}");
+    }
+    $result = json_decode(substr($response, 6), TRUE);
+    if ($header['status'] !== self::STATUS_OK) throw new SocialException("RpcAggregator: $result");
+    return $result;
+  }
+
+  private function _getToken($identity) {
+    return (is_null($identity) || is_null($auth = $identity->getAuth())) ? NULL : $auth->token;
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  protected function _getSnUsers($categorizedUids, $snEgos) {
+    $args = array();
+    foreach ($categorizedUids as $snid => $uids) {
+      if (!isset($this->_parsers[$snid])) continue;
+      $snEgo = (!is_null($snEgos) && isset($snEgos[$snid])) ? $snEgos[$snid] : NULL;
+      $args[$snid] = array('uids' => array_values($uids), 'token' => $this->_getToken($snEgo));
+      unset($categorizedUids[$snid]);
+    }
+    list($ret, $missedSnuids) = parent::_getSnUsers($categorizedUids, $snEgos);
+    if (empty($args)) return array($ret, $missedSnuids);
+
+    $result = $this->_call(self::OP_GET_USERS, $args);
+    foreach ($result['users'] as $snid => $blobs) {
+      foreach ($blobs as $uid => $blob) {
+        $snuid = "$snid:$uid";
+        try {
+          $ret[$snuid] = call_user_func($this->_parsers[$snid], $blob);
+          $ret[$snuid]->id = $snuid;  // output marshaling
+        } catch (SocialException $e) {
+          $missedSnuids[] = $snuid;
+        }
+      }
+    }
+    foreach ($result['missed'] as $snid => $uids) {
+      foreach ($uids as $uid) {
+        $missedSnuids[] = "$snid:$uid";
+      }
+    }
+    return array($ret, $missedSnuids);
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  protected function _getSnFriends($identities, $mappings, $excludes, $includes, $criteria, $snCount) {
+    $args = array();
+    if (is_null($criteria)) {  // the criteria are ranked by the registered providers
+      foreach ($identities as $snid => $identity) {
+        if (!isset($this->_parsers[$snid])) continue;
+        $args[$snid] = array('uid' => $identity->id, 'token' => $this->_getToken($identity), 'offset' => 0, 'count' => $snCount);
+        unset($identities[$snid]);
+      }
+    }
+    $snFriends = parent::_getSnFriends($identities, $mappings, $excludes, $includes, $criteria, $snCount);
+    if (empty($args)) return $snFriends;
+
+    $result = $this->_call(self::OP_GET_FRIENDS, $args);
+    foreach ($result['friends'] as $snid => $friends) {
+      foreach ($this->_getSnUids($excludes, $mappings, $snid) as $exclude) {
+        unset($friends[$exclude]);
+      }
+      foreach ($this->_getSnUids($includes, $mappings, $snid) as $include) {
+        $friends[$include] = 0.0;
+      }
+      $snFriends[$snid] = array_slice($friends, 0, $snCount, TRUE);
+    }
+    return $snFriends;
+  }
+}
@@ -18,6 +18,7 @@
 namespace Zopt\Social;
 
 require_once 'social/data.php';
+require_once 'cache/cache.php';
 
 class Auth {
   public $token;
@@ -63,3 +64,66 @@ interface IdentityManagerInterface {
    */
   public function getMappings($snuids);
 }
+
+/**
+ * The identity manager which caches the mappings of another one, so that the aggregator does not
+ * look up the same snuids again and again.
+ *
+ * The snuids without mappings are cached as well, as an empty array.
+ */
+class CachedIdentityMgr implements IdentityManagerInterface {
+  const KEY_PREFIX = 'idmap:';
+
+  /**
+   * @var IdentityManagerInterface The identity manager being cached
+   */
+  private $_identityMgr;
+
+  /**
+   * @var \Zopt\Cache\CacheInterface The cache of the mappings
+   */
+  private $_cache;
+
+  /**
+   * @var int Seconds that a mapping is cached
+   */
+  private $_ttl;
+
+  public function __construct($identityMgr, $cache, $ttl = 600) {
+    $this->_identityMgr = $identityMgr;
+    $this->_cache = $cache;
+    $this->_ttl = $ttl;
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  public function getMappings($snuids) {
+    $keys = array();
+    foreach ($snuids as $snuid) {
+      $keys[] = self::KEY_PREFIX . $snuid;
+    }
+    $cached = empty($keys) ? array() : $this->_cache->getMulti($keys, FALSE);
+
+    $ret = array();
+    $missed = array();
+    foreach ($snuids as $snuid) {
+      $key = self::KEY_PREFIX . $snuid;
+      if (!isset($cached[$key])) {
+        $missed[] = $snuid;
+      } elseif (!empty($cached[$key])) {
+        $ret[$snuid] = $cached[$key];
+      }
+    }
+    if (empty($missed)) return $ret;
+
+    $mappings = $this->_identityMgr->getMappings($missed);
+    $values = array();
+    foreach ($missed as $snuid) {
+      $values[self::KEY_PREFIX . $snuid] = isset($mappings[$snuid]) ? $mappings[$snuid] : array();
+      if (isset($mappings[$snuid])) $ret[$snuid] = $mappings[$snuid];
+    }
+    $this->_cache->setMulti($values, $this->_ttl);
+    return $ret;
+  }
+}
@@ -0,0 +1,296 @@
+<?php
+/***
+ * Copyright (c) 2012, Zoptimizer, LightyBolt
+ * All rights reserved.
+ *
+ * This work is licensed under
+ * the Creative Commons Attribution-NonCommercial-NoDerivs 3.0 Unported License.
+ *
+ * To view a copy of this license, visit
+ *
+ *   http://creativecommons.org/licenses/by-nc-nd/3.0/
+ *
+ * or send a letter to
+ *
+ *   Creative Commons, 444 Castro Street, Suite 900,
+ *   Mountain View, California, 94041, USA.
+ */
+namespace Zopt\Storage;
+
+require_once 'base/rpc.php';
+require_once 'storage/datastore.php';
+
+/**
+ * The scanner kept by the data store proxy, which streams the rows in key order chunk by chunk.
+ */
+class RpcScanner implements ScannerInterface {
+  /**
+   * @var RpcDataStoreClient The client which opened this scanner
+   */
+  private $_store;
+
+  /**
+   * @var int The id of the scanner in the proxy
+   */
+  public $scannerId;
+
+  /**
+   * @var int Number of the rows pulled from the proxy at a time
+   */
+  private $_chunkSize;
+
+  /**
+   * @var string[string][] The rows pulled but not returned yet
+   */
+  private $_rows = array();
+
+  /**
+   * @var bool The proxy has sent all the rows
+   */
+  private $_done = FALSE;
+
+  public function __construct($store, $scannerId, $chunkSize) {
+    $this->_store = $store;
+    $this->scannerId = $scannerId;
+    $this->_chunkSize = $chunkSize;
+  }
+
+  /**
+   * Mark the scanner as closed, once the proxy has sent all the rows or closed it.
+   */
+  public function setDone() {
+    $this->_done = TRUE;
+  }
+
+  /**
+   * @return bool Whether the proxy has sent all the rows
+   */
+  public function isDone() {
+    return $this->_done;
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  public function getNextResult() {
+    $results = $this->getNextResults(1);
+    return ($results === FALSE) ? FALSE : reset($results);
+  }
+
+  /**
+   * Returns the next rows of values, by their row keys.
+   *
+   * @param int $count number of the rows
+   * @return string[string][string]|bool The associate lists given the columnName=>value by the row keys, or FALSE if scanner reaches the end
+   * @throws DataStoreClientException
+   */
+  public function getNextResults($count) {
+    while ((count($this->_rows) < $count) && !$this->_done) {
+      $chunk = $this->_store->scan($this->scannerId, max($count - count($this->_rows), $this->_chunkSize));
+      foreach ($chunk['rows'] as $row) {
+        $this->_rows[] = $row;
+      }
+      if ($chunk['done']) $this->_done = TRUE;
+    }
+    if (empty($this->_rows)) return FALSE;
+    $results = array();
+    foreach (array_splice($this->_rows, 0, $count) as $row) {
+      $results[$row[0]] = $row[1];
+    }
+    return $results;
+  }
+}
+
+/**
+ * The data store client talking to the data store proxy in python/rpc/dataserver.py.
+ *
+ * The proxy holds the pooled connections to the shard dbs, routes the row keys, caches the meta data,
+ * and batches the rows per shard, the same data layout as ShardSqlDataStoreClient.
+ */
+class RpcDataStoreClient implements DataStoreClientInterface {
+  const OP_GET_TABLE_NAMES = 1;
+  const OP_CREATE_TABLE = 2;
+  const OP_DELETE_TABLE = 3;
+  const OP_CREATE_FAMILY = 4;
+  const OP_DELETE_FAMILY = 5;
+  const OP_GET_ROWS = 6;
+  const OP_MUTATE_ROWS = 7;
+  const OP_DELETE_ROWS = 8;
+  const OP_OPEN_SCANNER = 9;
+  const OP_SCAN = 10;
+  const OP_CLOSE_SCANNER = 11;
+
+  const SCANNER_CHUNK_SIZE = 256;
+
+  const STATUS_OK = 0;
+
+  /**
+   * @var \Zopt\Base\RpcClient the rpc client connecting to the data store proxy
+   */
+  private $_client = NULL;
+
+  /**
+   * @var int The id of the last request
+   */
+  private $_requestId = 0;
+
+  public function __construct($client) {
+    $this->_client = $client;
+  }
+
+  /**
+   * Send a request and return its result.
+   *
+   * @param int $op The request op
+   * @param mixed[string] $args The arguments
+   * @return mixed The decoded result
+   * @throws DataStoreClientException
+   */
+  private function _call($op, $args = array()) {
+    $this->_requestId = ($this->_requestId + 1) & 0x7fffffff;
+    try {
+      $response = $this->_client->call(pack('CV', $op, $this->_requestId) . json_encode((object)$args));
+    } catch (\Zopt\Base\RpcException $e) {
+      throw new DataStoreClientException($e->getMessage(), $e->getCode(), $e);
+    }
+    $header = unpack('Cop/VrequestId/Cstatus', $response);
+    if (($header['op'] !== $op) || ($header['requestId'] !== $this->_requestId)) {
+      $this->_client->close();
+      throw new DataStoreClientException("Mismatched response for request {$this->_requestId}");
+    }
+    $result = json_decode(substr($response, 6), TRUE);
+    if ($header['status'] !== self::STATUS_OK) throw new DataStoreClientException($result);
+    return $result;
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  public function getTableNames() {
+    return $this->_call(self::OP_GET_TABLE_NAMES);
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  public function createTable($tableName) {
+    return $this->_call(self::OP_CREATE_TABLE, array('table' => $tableName));
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  public function deleteTable($tableName) {
+    return $this->_call(self::OP_DELETE_TABLE, array('table' => $tableName));
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  public function createFamily($tableName, $familyName) {
+    return $this->_call(self::OP_CREATE_FAMILY, array('table' => $tableName, 'family' => $familyName));
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  public function deleteFamily($tableName, $familyName) {
+    return $this->_call(self::OP_DELETE_FAMILY, array('table' => $tableName, 'family' => $familyName));
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  public function getRow($tableName, $rowKey, $columns = NULL, $timestamp = NULL) {
+    $rows = $this->getRows($tableName, array($rowKey), $columns, $timestamp);
+    return isset($rows[$rowKey]) ? $rows[$rowKey] : FALSE;
+  }
+
+  /**
+   * Returns the rows that match the keys in the given table, batched per shard by the proxy.
+   *
+   * @param string $tableName The table that this query run on
+   * @param string[] $rowKeys The row keys
+   * @param string[] $columns The columns that the result includes, see ShardSqlDataStoreClient::getRow
+   * @param int $timestamp The timestamp of the data has
+   *
+   * @return string[string][string] The associate lists given the columnName=>value by the row keys, without the missing rows
+   * @throws DataStoreClientException
+   */
+  public function getRows($tableName, $rowKeys, $columns = NULL, $timestamp = NULL) {
+    if (empty($rowKeys)) return array();
+    return $this->_call(self::OP_GET_ROWS, array('table' => $tableName, 'rowKeys' => array_values($rowKeys), 'columns' => $columns));
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  public function mutateRow($tableName, $rowKey, $mutations, $timestamp = NULL) {
+    $rows = $this->mutateRows($tableName, array($rowKey => $mutations), $timestamp);
+    return isset($rows[$rowKey]) ? $rows[$rowKey] : FALSE;
+  }
+
+  /**
+   * Apply the mutations to the rows in the given table, atomically for the rows in the same shard.
+   *
+   * @param string $tableName The table that this query run on
+   * @param Mutation[][string] $rowMutations The mutations by the row keys
+   * @param int $timestamp The timestamp of the data has
+   *
+   * @return string[string][string] The updated rows by the row keys, without the rows which are now empty
+   * @throws DataStoreClientException
+   */
+  public function mutateRows($tableName, $rowMutations, $timestamp = NULL) {
+    if (empty($rowMutations)) return array();
+    $packed = array();
+    foreach ($rowMutations as $rowKey => $mutations) {
+      foreach ($mutations as $mutation) {
+        $packed[$rowKey][] = array($mutation->isDelete, $mutation->columnName, $mutation->value);
+      }
+    }
+    return $this->_call(self::OP_MUTATE_ROWS, array('table' => $tableName, 'mutations' => (object)$packed));
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  public function deleteRow($tableName, $rowKey, $timestamp = NULL) {
+    $deleted = $this->_call(self::OP_DELETE_ROWS, array('table' => $tableName, 'rowKeys' => array($rowKey)));
+    return !empty($deleted);
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  public function openScanner($tableName, $startRowKey, $stopRowKey, $columns) {
+    $scannerId = $this->_call(self::OP_OPEN_SCANNER, array(
+        'table' => $tableName,
+        'startRowKey' => $startRowKey,
+        'stopRowKey' => $stopRowKey,
+        'columns' => $columns,
+        'batchSize' => self::SCANNER_CHUNK_SIZE,
+    ));
+    return new RpcScanner($this, $scannerId, self::SCANNER_CHUNK_SIZE);
+  }
+
+  /**
+   * Pull the next chunk of rows of a scanner, used by RpcScanner.
+   *
+   * @param int $scannerId The id of the scanner in the proxy
+   * @param int $count Maximum number of the rows
+   * @return mixed[string] {"rows": [[rowKey, row], ...], "done": bool}
+   * @throws DataStoreClientException
+   */
+  public function scan($scannerId, $count) {
+    return $this->_call(self::OP_SCAN, array('scannerId' => $scannerId, 'count' => $count));
+  }
+
+  /**
+   * {@inheritdoc}
+   */
+  public function closeScanner($scanner) {
+    if ($scanner->isDone()) return TRUE;
+    $scanner->setDone();
+    return $this->_call(self::OP_CLOSE_SCANNER, array('scannerId' => $scanner->scannerId));
+  }
+}
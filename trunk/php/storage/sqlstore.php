@@ -184,10 +184,17 @@ class ShardSqlDataStoreClient implements DataStoreClientInterface {
   private function _getShardId($rowKey) {
     $rowId = crc32($rowKey);
     $shards = array_keys($this->_shardDbs);
-    // Linear search, can do better if needed.
-    $idx = count($idx) - 1;
-    while ($idx > 0 && $shards[$idx] > $rowId) $idx--;
-    if ($idx === -1) $idx += count($idx);
+    // binary search for the last shard not greater than rowId, or wrap around to the last shard.
+    $idx = count($shards) - 1;
+    for ($low = 0, $high = count($shards) - 1; $low <= $high;) {
+      $mid = ($low + $high) >> 1;
+      if ($shards[$mid] <= $rowId) {
+        $idx = $mid;
+        $low = $mid + 1;
+      } else {
+        $high = $mid - 1;
+      }
+    }
     return $shards[$idx];
   }
 
@@ -0,0 +1,292 @@
+import asyncio
+import logging
+import time
+from channel import NetworkChannel
+
+"""Serves the rpc protocol on an asyncio event loop, e.g. uvloop, instead of the tornado IOLoop.
+
+This module runs on Python 3 only, where channel.py and iostream.py are
+importable as well; the SocketServer processes stay on Python 2.
+
+The framing is NetworkChannel itself, working on a TransportStream, which
+keeps the same bytearray read buffer as IOStream but is fed by the asyncio
+transport.  On the loops supporting BufferedProtocol, the transport receives
+straight into the free tail of the read buffer, with no intermediate bytes
+object; the other loops call data_received, which copies the data in.
+
+The server runs the payload handlers in the serving process, as there is no
+acceptor / worker split; run a server per core with reuse_port to use them
+all.  A payload handler is called the same as in SocketWorker,
+payload_handler(payload, callback), and it may also be a coroutine function,
+whose return value, unless None, is the response:
+
+  server = start_server(20007, handler, loop=uvloop.new_event_loop())
+
+A client not reading its responses fills the transport buffer until the
+transport pauses the protocol, which then stops reading the requests of the
+client and holds the write callbacks, e.g. the credits of a streamed
+response, until the transport drains, so that the responses never pile up
+without a limit.
+"""
+
+_Protocol = getattr(asyncio, "BufferedProtocol", asyncio.Protocol)
+
+class TransportStream(object):
+  """The IOStream interface used by NetworkChannel, on an asyncio transport."""
+
+  def __init__(self, transport, loop, name=None, min_buf_size=131072, max_buf_size=16777216, io_chunk_size=32768,
+               write_buf_size=262144):
+    """Initiate the stream.
+
+    Args:
+      transport: The asyncio transport of the connection.
+      loop: The asyncio event loop.
+      name: The name of this object, could be used in debug info output.
+      min_buf_size: Initial size of the read buffer, default set to be 128K bytes.
+      max_buf_size: Maximum size of the read buffer, default set to be 16M bytes.
+      io_chunk_size: Minimum free space offered to each transport read, default set to be 32K bytes.
+      write_buf_size: Bytes of the responses waiting for the next transport write, beyond
+          which the requests already received are not handled until the write, default set to be 256K bytes.
+    """
+    self.socket = transport  # None once closed, as IOStream
+    self._loop = loop
+    self.name = name or "TransportStream"
+    self.min_buf_size = min_buf_size
+    self.max_buf_size = max_buf_size
+    self.io_chunk_size = io_chunk_size
+    self.write_buf_size = write_buf_size
+    self._read_buf = bytearray(min_buf_size)
+    self._read_start = 0
+    self._read_end = 0
+    self._read_callbacks = []  # (num_bytes, callback), in the order of the reads
+    self._consuming = False  # the reads are being consumed, further down the stack
+    self._write_buf = bytearray()
+    self._write_callbacks = []
+    self._flush_scheduled = False
+    self._write_paused = False
+    self._close_callback = None
+
+  def set_close_callback(self, callback):
+    self._close_callback = callback
+
+  def read(self, num_bytes, callback):
+    """Call callback when we read the given number of bytes, see IOStream.read."""
+    if not self.socket and (self._read_callbacks or (self._read_end - self._read_start) < num_bytes):
+      raise IOError("Attempt to read/write to closed stream")
+    self._read_callbacks.append((num_bytes, callback))
+    self._consume_reads()
+
+  def _consume_reads(self):
+    """Fulfils the pending reads in a loop, so that a callback reading again doesn't recurse per frame.
+
+    The loop stops while the responses can't be written out, and goes on after the next write.
+    """
+    if self._consuming:
+      return  # the loop further down the stack takes the new read
+    self._consuming = True
+    try:
+      while self._read_callbacks and not self._write_paused and len(self._write_buf) < self.write_buf_size:
+        num_bytes, callback = self._read_callbacks[0]
+        if self._read_end - self._read_start < num_bytes:
+          return
+        self._read_callbacks.pop(0)
+        self._read_consume(num_bytes, callback)
+    finally:
+      self._consuming = False
+
+  def _read_consume(self, num_bytes, callback):
+    start = self._read_start
+    self._read_start += num_bytes
+    if callback:
+      try:
+        callback(self._read_buf, start, num_bytes)
+      except:
+        self.close()
+        raise
+
+  def reserve(self, num_bytes):
+    """Makes room for num_bytes at the end of the read buffer, returns False if the buffer would overflow."""
+    if self._read_end + num_bytes <= len(self._read_buf):
+      return True
+    length = self._read_end - self._read_start
+    size = len(self._read_buf)
+    while length + num_bytes > size:
+      size *= 2
+    if size > self.max_buf_size:
+      logging.error("%s: Reached maximum read buffer size", self.name)
+      self.close()
+      return False
+    if size > len(self._read_buf):
+      # the buffer may be exported to the transport, so it's replaced instead of resized.
+      new_buf = bytearray(size)
+      new_buf[:length] = self._read_buf[self._read_start:self._read_end]
+      self._read_buf = new_buf
+    else:
+      self._read_buf[:length] = self._read_buf[self._read_start:self._read_end]
+    self._read_start = 0
+    self._read_end = length
+    return True
+
+  def get_buffer(self):
+    """Returns the writable view of the free tail of the read buffer."""
+    if not self.reserve(self.io_chunk_size):
+      return memoryview(bytearray(self.io_chunk_size))  # the transport is closing, drops the data
+    return memoryview(self._read_buf)[self._read_end:]
+
+  def received(self, num_bytes):
+    """Handles num_bytes received into the tail of the read buffer."""
+    if not self.socket:
+      return
+    self._read_end += num_bytes
+    self._consume_reads()
+
+  def feed(self, data):
+    """Copies the received data into the read buffer and handles it."""
+    if self.reserve(len(data)):
+      self._read_buf[self._read_end:self._read_end + len(data)] = data
+      self.received(len(data))
+
+  def write(self, buf, offset, num_bytes, callback=0):
+    """Write the given data to this stream, see IOStream.write.
+
+    The writes of one loop iteration are coalesced into one transport write,
+    after which the callback is called.
+    """
+    if not self.socket:
+      raise IOError("Attempt to read/write to closed stream")
+    self._write_buf += buf[offset:offset + num_bytes]
+    if callback:
+      self._write_callbacks.append(callback)
+    if not self._flush_scheduled:
+      self._flush_scheduled = True
+      self._loop.call_soon(self._flush)
+
+  def _flush(self):
+    self._flush_scheduled = False
+    if not self.socket:
+      return
+    data = bytes(self._write_buf)
+    self._write_buf = bytearray()
+    self.socket.write(data)
+    self._run_write_callbacks()
+    self._consume_reads()
+
+  def _run_write_callbacks(self):
+    if self._write_paused:
+      return  # they run once the transport drains
+    callbacks = self._write_callbacks
+    self._write_callbacks = []
+    for callback in callbacks:
+      callback()
+
+  def pause_writing(self):
+    """Stops reading from the transport and holds the write callbacks, as its write buffer is full."""
+    self._write_paused = True
+    if self.socket:
+      self.socket.pause_reading()
+
+  def resume_writing(self):
+    """Resumes reading and runs the write callbacks held, as the transport has drained."""
+    self._write_paused = False
+    if self.socket:
+      self.socket.resume_reading()
+      self._run_write_callbacks()
+      self._consume_reads()
+
+  def close(self):
+    """Close this stream."""
+    if self.socket:
+      if self._write_buf:
+        self._flush()
+      transport = self.socket
+      self.socket = None
+      transport.close()
+      if self._close_callback:
+        self._close_callback()
+      self._read_callbacks = []
+      self._write_callbacks = []
+
+class RpcProtocol(_Protocol):
+  """The asyncio protocol of one client connection, which passes the frames to the payload handler."""
+
+  def __init__(self, payload_handler, loop):
+    self._payload_handler = payload_handler
+    self._loop = loop
+    self._stream = None
+    self._channel = None
+
+  def connection_made(self, transport):
+    self._stream = TransportStream(transport, self._loop)
+    self._channel = NetworkChannel(None, self._handle_payload, None, None, None, "RpcProtocol", self._stream)
+    self._channel.read()
+
+  def get_buffer(self, sizehint):
+    return self._stream.get_buffer()
+
+  def buffer_updated(self, nbytes):
+    self._stream.received(nbytes)
+
+  def data_received(self, data):
+    self._stream.feed(data)
+
+  def eof_received(self):
+    return False  # closes the transport
+
+  def connection_lost(self, exc):
+    self._stream.close()
+
+  def pause_writing(self):
+    self._stream.pause_writing()
+
+  def resume_writing(self):
+    self._stream.resume_writing()
+
+  def _respond(self, result):
+    if not self._channel.closed():
+      self._channel.write(result, 0, len(result))
+
+  def _handle_payload(self, buf, offset, num_bytes, deadline):
+    if deadline is not None and deadline < time.time():
+      return  # the client no longer waits for the result.
+    result = self._payload_handler(bytes(buf[offset:offset + num_bytes]), self._respond)
+    if asyncio.iscoroutine(result):
+      self._loop.create_task(result).add_done_callback(self._handle_done)
+
+  def _handle_done(self, task):
+    if task.cancelled():
+      return
+    if task.exception() is not None:
+      logging.error("Payload handler failed: %r", task.exception())
+      self._channel.close()
+    elif task.result() is not None:
+      self._respond(task.result())
+
+def start_server(port, payload_handler, ip_addr="localhost", loop=None, reuse_port=False):
+  """Starts serving the rpc protocol on the loop, returns the asyncio server.
+
+  Args:
+    port: The port to listen.
+    payload_handler: The handler of the payloads, the same as of SocketServer, or a coroutine function.
+        Function fingerprint: payload_handler(payload, callback)
+    ip_addr: The address to listen.
+    loop: The asyncio event loop, default asyncio.get_event_loop().
+    reuse_port: Sets SO_REUSEPORT, so that the servers of several processes share the port.
+  """
+  loop = loop or asyncio.get_event_loop()
+  kwargs = {"reuse_port": True} if reuse_port else {}
+  return loop.run_until_complete(loop.create_server(lambda: RpcProtocol(payload_handler, loop), ip_addr, port, **kwargs))
+
+def main():
+  # only for test
+  try:
+    import uvloop
+    loop = uvloop.new_event_loop()
+  except ImportError:
+    loop = asyncio.new_event_loop()
+  def echo_handler(payload, callback):
+    callback(payload)
+  start_server(20007, echo_handler, loop=loop)
+  loop.run_forever()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,208 @@
+import json
+import logging
+import struct
+from cachestore import CacheStore
+from socketserver import SocketServer
+
+"""The api gateway, which serves the batched queries of Zopt\\Api\\RpcApiClient.
+
+A query to php/api/index.php pays one http round trip and one php bootstrap,
+and runs its requests one after another.  The gateway takes the same query
+in one frame, dispatches its requests to the registered services at once, and
+streams the response of each request back as soon as it completes, tagged
+with the request id.  The auth token of the query is verified once, and the
+verification is cached across queries.
+
+Request = | 4 bytes query_id | json query |
+  query: {"requests": [request, ...], "authToken": token}, the same as php/api/io.php,
+  and a request is {"id": id, "handler": "service.method", "params": params} or its json string.
+Response = | 4 bytes query_id | 1 byte kind | json |, one frame per request then the end frame:
+  KIND_RESPONSE: {"id": id, "data": data} or {"id": id, "error": error}
+  KIND_END: {} or {"error": error} if the query is rejected as a whole.
+"""
+
+KIND_RESPONSE = 0
+KIND_END = 1
+
+_HEADER = struct.Struct("<I")
+_KIND = struct.Struct("<B")
+
+class ApiError(Exception):
+  """The error reported as the error of a response, like Zopt\\Api\\ServerException."""
+  pass
+
+class Service(object):
+  """The base class of the services, whose public methods are the handlers.
+
+  A handler is called as method(params, auth_token, callback), and reports its
+  data by callback(data), either at once or later from the io loop.  It fails
+  the request by raising or calling back with an ApiError.
+  """
+
+  @staticmethod
+  def get_args(params, names):
+    for name in names:
+      if name not in params:
+        raise ApiError("The must-have argument %s is not found." % name)
+    return [params[name] for name in names]
+
+  @staticmethod
+  def get_opt_args(params, defaults):
+    return [params.get(name, default) for name, default in defaults]
+
+class SampleService(Service):
+  def hello(self, params, auth_token, callback):
+    callback("hello world!")
+
+def _parse_request(request):
+  """Parse a request the same as Request::parse, returns (id, handler, params)."""
+  if isinstance(request, basestring):
+    try:
+      request = json.loads(request)
+    except ValueError:
+      request = None
+  if (not isinstance(request, dict) or
+      not isinstance(request.get("id"), (basestring, int, long, float, bool)) or
+      not isinstance(request.get("handler"), basestring) or request["handler"].count(".") != 1):
+    raise ApiError("Request.parse: malformat request.")
+  return request["id"], request["handler"], request.get("params") or {}
+
+def _end_frame(header, error=None):
+  return header + _KIND.pack(KIND_END) + json.dumps({"error": error} if error else {})
+
+class _Query(object):
+  """The requests of a query in flight, which sends the end frame once all of them are responded."""
+
+  def __init__(self, header, num, callback):
+    self._header = header
+    self._remaining = num
+    self._callback = callback
+    if not num:
+      callback(_end_frame(header))
+
+  def respond(self, request_id, data=None, error=None):
+    output = {"id": request_id}
+    if data is not None:
+      output["data"] = data
+    if error is not None:
+      output["error"] = error
+    self._callback(self._header + _KIND.pack(KIND_RESPONSE) + json.dumps(output))
+    self._remaining -= 1
+    if not self._remaining:
+      self._callback(_end_frame(self._header))
+
+class ApiService(object):
+  """The payload handler of the workers."""
+
+  def __init__(self, services, verify_token=None, token_ttl=60, token_cache_size=65536):
+    """Initiate the service.
+
+    Args:
+      services: The services by their names, e.g. {"sample": SampleService()}.
+      verify_token: The function verifying an auth token, returns its json-able context (e.g. the user id)
+          or raises ApiError, default accepts all tokens as AuthToken::parse does.
+          Function fingerprint: verify_token(token)
+      token_ttl: Seconds that a verification is cached.
+      token_cache_size: Maximum number of the cached verifications.
+    """
+    self._services = dict(services)
+    self._verify_token = verify_token or (lambda token: {})
+    self._token_ttl = token_ttl
+    self._token_cache = CacheStore(token_cache_size, token_cache_size * 1024)
+
+  def register(self, name, service):
+    """Register a service, returns the previous one of the name, or None."""
+    previous = self._services.get(name)
+    self._services[name] = service
+    return previous
+
+  def _get_auth_token(self, token):
+    """Returns the context of the verified token, raises ApiError if it's invalid."""
+    key = json.dumps(token)
+    cached = self._token_cache.get(key)
+    if cached is not None:
+      context = json.loads(cached[0])
+    else:
+      try:
+        context = {"context": self._verify_token(token)}
+      except ApiError as e:
+        context = {"error": str(e)}
+      self._token_cache.set(key, json.dumps(context), self._token_ttl)
+    if "error" in context:
+      raise ApiError(context["error"])
+    return context["context"]
+
+  def _dispatch(self, query, request_id, handler, params, auth_token):
+    responded = [False]
+
+    def callback(data=None):
+      if responded[0]:
+        logging.warning("Handler %s responded twice to request %r", handler, request_id)
+        return
+      responded[0] = True
+      if isinstance(data, ApiError):
+        query.respond(request_id, error=str(data))
+      else:
+        query.respond(request_id, data=data)
+
+    service_name, method_name = handler.split(".")
+    try:
+      service = self._services.get(service_name)
+      if service is None:
+        raise ApiError("Service %s is not registered" % service_name)
+      method = None if method_name.startswith("_") else getattr(service, method_name, None)
+      if method is None:
+        raise ApiError("Method %s is not found" % handler)
+      method(params, auth_token, callback)
+    except ApiError as e:
+      callback(e)
+    except Exception:
+      logging.exception("Failed to handle %s", handler)
+      callback(ApiError("Internal error"))
+
+  def handle(self, payload, callback):
+    header = bytes(payload[:_HEADER.size])
+    try:
+      query = json.loads(str(payload[_HEADER.size:]))
+      if not isinstance(query, dict) or not isinstance(query.get("requests"), list) or "authToken" not in query:
+        raise ApiError("Query.parse: malformat query.")
+      requests = [_parse_request(request) for request in query["requests"]]
+      auth_token = self._get_auth_token(query["authToken"])
+    except ValueError:
+      callback(_end_frame(header, "Query.parse: malformat query."))
+      return
+    except ApiError as e:
+      callback(_end_frame(header, str(e)))
+      return
+    except Exception:
+      # e.g. verify_token failing on its backend, the client still gets its end frame.
+      logging.exception("Failed to parse the query")
+      callback(_end_frame(header, "Internal error"))
+      return
+
+    in_flight = _Query(header, len(requests), callback)
+    for request_id, handler, params in requests:
+      self._dispatch(in_flight, request_id, handler, params, auth_token)
+
+class ApiServer(SocketServer):
+  """The api gateway."""
+
+  def __init__(self, port, services, verify_token=None, token_ttl=60, **kwargs):
+    """Initiate the api gateway.
+
+    Args:
+      port: The port to listen.
+      services: The services by their names, see ApiService.
+      verify_token: The function verifying an auth token, see ApiService.
+      token_ttl: Seconds that a verification is cached.
+      kwargs: The other arguments of SocketServer.
+    """
+    SocketServer.__init__(self, port, ApiService(services, verify_token, token_ttl).handle, **kwargs)
+
+def main():
+  # only for test
+  server = ApiServer(20006, {"sample": SampleService()}, idle_timeout = 60)
+  server.start()
+
+if __name__ == '__main__':
+  main()
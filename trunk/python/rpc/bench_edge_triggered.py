@@ -0,0 +1,63 @@
+"""Benchmarks the epoll_ctl calls of IOStream in level- and edge-triggered modes.
+
+A client stream pings an echo stream over a socket pair, and the update_handler
+calls (i.e. epoll_ctl syscalls) made for the echo stream are counted.
+
+Usage: python bench_edge_triggered.py [round_trips]
+"""
+
+import socket
+import sys
+import time
+from collections import defaultdict
+from tornado import ioloop
+import iostream
+
+class CountingIOLoop(ioloop.IOLoop):
+  """An IO loop which counts update_handler calls per fd."""
+
+  def __init__(self):
+    ioloop.IOLoop.__init__(self)
+    self.update_nums = defaultdict(int)
+
+  def update_handler(self, fd, events):
+    self.update_nums[fd] += 1
+    ioloop.IOLoop.update_handler(self, fd, events)
+
+def run(edge_triggered, round_trips, msg_size=100):
+  io_loop = CountingIOLoop()
+  server_sock, client_sock = socket.socketpair()
+  server = iostream.IOStream(server_sock, io_loop, "echo", edge_triggered=edge_triggered)
+  client = iostream.IOStream(client_sock, io_loop, "ping")
+  msg = bytearray(msg_size)
+  left = [round_trips]
+
+  def echo(buf, offset, num_bytes):
+    server.write(buf, offset, num_bytes, None)
+    server.read(msg_size, echo)
+
+  def pong(buf, offset, num_bytes):
+    left[0] -= 1
+    if not left[0]:
+      io_loop.stop()
+      return
+    client.write(msg, 0, msg_size, None)
+    client.read(msg_size, pong)
+
+  server.read(msg_size, echo)
+  client.write(msg, 0, msg_size, None)
+  client.read(msg_size, pong)
+  start = time.time()
+  io_loop.start()
+  elapsed = time.time() - start
+  update_num = io_loop.update_nums[server_sock.fileno()]
+  server.close()
+  client.close()
+  return elapsed, update_num
+
+if __name__ == '__main__':
+  round_trips = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  for edge_triggered in (False, True):
+    elapsed, update_num = run(edge_triggered, round_trips)
+    print "%s-triggered: %d round trips in %.3fs, %d epoll_ctl calls" % (
+        "edge" if edge_triggered else "level", round_trips, elapsed, update_num)
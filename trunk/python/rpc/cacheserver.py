@@ -0,0 +1,357 @@
+import functools
+import os
+import struct
+import time
+from tornado import ioloop
+from socketserver import SocketServer
+from cachestore import CacheStore, is_fuzzy_expired
+from hashring import HashRing
+from timerwheel import TimerWheel
+
+"""A sharded cache service on SocketServer, which backs Zopt\\Cache\\RpcCache.
+
+Every worker process owns one shard of the keys, routed by a consistent hash
+ring over the live workers, so that the death of a worker only moves its own
+keys.  The server splits each multi-key request by shard, sends one
+sub-request to each involved worker, and merges their responses into one
+response for the client.
+
+OP_LEASE_GET coalesces the concurrent misses of a key (single-flight): the
+first client missing the key gets a lease to load it from the backend and
+set it, and the other clients asking for the key meanwhile wait until it's
+set, instead of all hitting the backend.  Items about to expire within
+refresh_ahead seconds are handed out with a lease to one client, which
+refreshes them while the others keep getting the cached value.  A lease
+not set within lease_timeout milliseconds passes to the next waiting client,
+so the clients should send a lease_timeout shorter than their own timeout,
+or the waiters would give up before getting the lease.  The acceptor tags
+the OP_LEASE_GET sub-requests with the addr_id of the connection after the
+header, so that a closed connection stops waiting, and passes on the leases
+it holds at once.
+
+All integers are little-endian.  Request payload:
+  | 1 byte op | 4 bytes request_id | op fields | 4 bytes item_num | items |
+  OP_GET:    op fields = | 4 bytes fuzzy_range |
+             item = | 2 bytes key_len | key |
+  OP_SET:    op fields = | 4 bytes ttl |
+             item = | 2 bytes key_len | key | 4 bytes value_len | value |
+  OP_REMOVE: no op fields
+             item = | 2 bytes key_len | key |
+  OP_STATS:  no op fields, no items, sent to all shards
+  OP_LEASE_GET:
+             op fields = | 4 bytes refresh_ahead | 4 bytes lease_timeout |
+             item = | 2 bytes key_len | key |
+Response payload:
+  | 1 byte op | 4 bytes request_id | 4 bytes item_num | items |
+  OP_GET:    item = | 2 bytes key_len | key | 4 bytes valid_until | 4 bytes value_len | value |
+             for the found items, valid_until is 0 for persistent items.
+  OP_SET, OP_REMOVE:
+             item = | 2 bytes key_len | key |, for the items failed to set, or not found to remove.
+  OP_STATS:  the same items as OP_GET, the key is "<worker pid>:<stat name>"
+             and the value is the decimal stat value.
+  OP_LEASE_GET:
+             item = | 2 bytes key_len | key | 1 byte status | 4 bytes valid_until | 4 bytes value_len | value |
+             for all the items, see STATUS_*.
+"""
+
+OP_GET = 1
+OP_SET = 2
+OP_REMOVE = 3
+OP_STATS = 4
+OP_LEASE_GET = 5
+
+# The status of the items in an OP_LEASE_GET response.
+STATUS_HIT = 0
+STATUS_REFRESH = 1  # a hit about to expire, the client holds the lease to refresh it
+STATUS_LEASE = 2  # a miss, the client holds the lease to load and set it
+
+_HEADER = struct.Struct("<BI")
+_UINT16 = struct.Struct("<H")
+_UINT32 = struct.Struct("<I")
+_OP_FIELDS_SIZES = {OP_GET: 4, OP_SET: 4, OP_REMOVE: 0, OP_STATS: 0, OP_LEASE_GET: 8}
+_LEASE_FIELDS = struct.Struct("<II")
+_LEASE_ITEM = struct.Struct("<BII")
+
+def _iter_items(op, buf, offset):
+  """Iterates the items of a request, yields (key, item_start, item_end) tuples.
+
+  Args:
+    op: The request op.
+    buf: The buffer stores the request.
+    offset: Offset of the 4 bytes item_num in the buffer.
+  """
+  item_num = _UINT32.unpack_from(buf, offset)[0]
+  pos = offset + 4
+  for _ in xrange(item_num):
+    key_len = _UINT16.unpack_from(buf, pos)[0]
+    key_end = pos + 2 + key_len
+    item_end = key_end
+    if op == OP_SET:
+      item_end += 4 + _UINT32.unpack_from(buf, key_end)[0]
+    yield bytes(buf[pos + 2:key_end]), pos, item_end
+    pos = item_end
+
+def _pack_key(key):
+  return _UINT16.pack(len(key)) + key
+
+def _pack_lease_item(key, status, valid_until, value):
+  return _pack_key(key) + _LEASE_ITEM.pack(status, valid_until, len(value)) + value
+
+class _Lease(object):
+  """The lease on a key, granted to the client loading it."""
+
+  __slots__ = ("holder", "timeout", "timer", "waiters")
+
+  def __init__(self, holder, timeout):
+    self.holder = holder  # the addr_id of the client holding the lease
+    self.timeout = timeout
+    self.timer = None
+    self.waiters = []  # the _PendingResponse objects waiting for the key
+
+class _PendingResponse(object):
+  """The response of an OP_LEASE_GET request, which may wait for the leases of other clients."""
+
+  __slots__ = ("addr_id", "header", "items", "waiting_num", "callback")
+
+  def __init__(self, addr_id, header, callback):
+    self.addr_id = addr_id
+    self.header = header
+    self.items = []
+    self.waiting_num = 0
+    self.callback = callback
+
+  def add(self, item):
+    """Adds an item which has been waited for, sends the response when it's complete."""
+    self.items.append(item)
+    self.waiting_num -= 1
+    if not self.waiting_num:
+      self.send()
+
+  def send(self):
+    self.callback(self.header + _UINT32.pack(len(self.items)) + "".join(self.items))
+
+class CacheService(object):
+  """The payload handler of the workers, which serves requests on its own shard."""
+
+  def __init__(self, capacity=65536, max_bytes=268435456):
+    # created before the workers fork, so that each worker has its own store.
+    self._store = CacheStore(capacity, max_bytes)
+    self._leases = {}  # key -> _Lease
+    self._held_leases = {}  # addr_id -> set of the keys whose leases it holds
+    self._waiting_responses = {}  # addr_id -> {_PendingResponse: [the keys it waits for]}
+    self._timer_wheel = None  # created in the worker process, on the worker's io loop
+
+  def _grant_lease(self, key, holder, timeout, now):
+    if self._timer_wheel is None:
+      self._timer_wheel = TimerWheel(ioloop.IOLoop.instance(), tick=0.1)
+    lease = self._leases[key] = _Lease(holder, timeout)
+    lease.timer = self._timer_wheel.add_timeout(now + timeout, functools.partial(self._expire_lease, key))
+    self._held_leases.setdefault(holder, set()).add(key)
+    return lease
+
+  def _pop_lease(self, key):
+    lease = self._leases.pop(key, None)
+    if lease is None:
+      return None
+    self._timer_wheel.remove_timeout(lease.timer)
+    keys = self._held_leases[lease.holder]
+    keys.discard(key)
+    if not keys:
+      del self._held_leases[lease.holder]
+    return lease
+
+  def _wait_lease(self, lease, key, response):
+    lease.waiters.append(response)
+    response.waiting_num += 1
+    self._waiting_responses.setdefault(response.addr_id, {}).setdefault(response, []).append(key)
+
+  def _end_wait(self, response, key):
+    responses = self._waiting_responses[response.addr_id]
+    keys = responses[response]
+    keys.remove(key)
+    if not keys:
+      del responses[response]
+      if not responses:
+        del self._waiting_responses[response.addr_id]
+
+  def _expire_lease(self, key):
+    """The lease holder didn't set the key in time, passes the lease to the first waiter."""
+    lease = self._pop_lease(key)
+    if not lease.waiters:
+      return
+    waiter = lease.waiters.pop(0)
+    self._end_wait(waiter, key)
+    self._grant_lease(key, waiter.addr_id, lease.timeout, time.time()).waiters = lease.waiters
+    waiter.add(_pack_lease_item(key, STATUS_LEASE, 0, ""))
+
+  def _release_lease(self, key, value, valid_until):
+    """The key has been set, passes its value to the waiters."""
+    lease = self._pop_lease(key)
+    if lease is None:
+      return
+    item = _pack_lease_item(key, STATUS_HIT, valid_until, value)
+    for waiter in lease.waiters:
+      self._end_wait(waiter, key)
+      waiter.add(item)
+
+  def close_connection(self, addr_id):
+    """Drops the waits of the connection, which is gone, and passes on the leases it holds."""
+    for response, keys in self._waiting_responses.pop(addr_id, {}).iteritems():
+      for key in keys:
+        self._leases[key].waiters.remove(response)
+    for key in list(self._held_leases.get(addr_id, ())):
+      self._expire_lease(key)
+
+  def _handle_lease_get(self, payload, fields_offset, items_offset, now, callback):
+    addr_id = bytes(payload[fields_offset:fields_offset + 6])
+    fields_offset += 6
+    items_offset += 6
+    refresh_ahead, lease_timeout = _LEASE_FIELDS.unpack_from(payload, fields_offset)
+    lease_timeout /= 1000.0
+    response = _PendingResponse(addr_id, payload[:_HEADER.size], callback)
+    keys = set()
+    for key, start, end in _iter_items(OP_LEASE_GET, payload, items_offset):
+      if key in keys:
+        continue  # a key asked twice would wait for its own lease
+      keys.add(key)
+      result = self._store.get(key, now)
+      lease = self._leases.get(key)
+      if result is not None:
+        value, valid_until = result
+        status = STATUS_HIT
+        if valid_until and lease is None and valid_until - now <= refresh_ahead:
+          self._grant_lease(key, addr_id, lease_timeout, now)
+          status = STATUS_REFRESH
+        response.items.append(_pack_lease_item(key, status, valid_until, value))
+      elif lease is None:
+        self._grant_lease(key, addr_id, lease_timeout, now)
+        response.items.append(_pack_lease_item(key, STATUS_LEASE, 0, ""))
+      else:
+        self._wait_lease(lease, key, response)
+    if not response.waiting_num:
+      response.send()
+
+  def handle(self, payload, callback):
+    op, request_id = _HEADER.unpack_from(payload, 0)
+    fields_offset = _HEADER.size
+    items_offset = fields_offset + _OP_FIELDS_SIZES[op]
+    now = time.time()
+    store = self._store
+    results = []
+    if op == OP_LEASE_GET:
+      self._handle_lease_get(payload, fields_offset, items_offset, now, callback)
+      return
+    if op == OP_GET:
+      fuzzy_range = _UINT32.unpack_from(payload, fields_offset)[0]
+      for key, start, end in _iter_items(op, payload, items_offset):
+        result = store.get(key, now)
+        if result is None:
+          continue
+        value, valid_until = result
+        if fuzzy_range and valid_until and is_fuzzy_expired(now, valid_until, fuzzy_range):
+          continue
+        results.append(_pack_key(key) + struct.pack("<II", valid_until, len(value)) + value)
+    elif op == OP_SET:
+      ttl = _UINT32.unpack_from(payload, fields_offset)[0]
+      for key, start, end in _iter_items(op, payload, items_offset):
+        value = payload[start + 2 + len(key) + 4:end]
+        if not store.set(key, value, ttl, now):
+          results.append(_pack_key(key))
+        elif self._leases:
+          self._release_lease(key, value, int(now) + ttl if ttl else 0)
+    elif op == OP_REMOVE:
+      for key, start, end in _iter_items(op, payload, items_offset):
+        if not store.remove(key):
+          results.append(_pack_key(key))
+    elif op == OP_STATS:
+      for name, value in store.stats().iteritems():
+        value = str(value)
+        results.append(_pack_key("%d:%s" % (os.getpid(), name)) + struct.pack("<II", 0, len(value)) + value)
+    callback(_HEADER.pack(op, request_id) + _UINT32.pack(len(results)) + "".join(results))
+
+class CacheServer(SocketServer):
+  """The cache server, which shards the keys over its workers."""
+
+  def __init__(self, port, capacity=65536, max_bytes=268435456, **kwargs):
+    """Initiate the cache server.
+
+    Args:
+      port: The port to listen.
+      capacity: Maximum number of items of each shard.
+      max_bytes: Maximum total size of the keys and values of each shard.
+      kwargs: The other arguments of SocketServer.
+    """
+    service = CacheService(capacity, max_bytes)
+    SocketServer.__init__(self, port, service.handle, **kwargs)
+    for worker_process in self._worker_processes.itervalues():
+      worker_process.close_handler = service.close_connection
+    self._shards = HashRing(self._ipc_channels)  # key -> worker_id of the live workers
+    self._fanouts = {}  # addr_id -> {fanout_id: [request_id, op, remaining, item_num, bodies]}
+    self._next_fanout_id = 0
+
+  def _inbound_callback(self, addr_id, buf, offset, num_bytes, deadline):
+    if deadline is not None and deadline < time.time():
+      return  # drops the request as the client no longer waits for it.
+    op, request_id = _HEADER.unpack_from(buf, offset)
+    items_offset = offset + _HEADER.size + _OP_FIELDS_SIZES[op]
+    shard_items = {}  # worker_id -> items
+    for key, start, end in _iter_items(op, buf, items_offset):
+      shard_items.setdefault(self._shards.get(key), []).append((start, end))
+    if op == OP_STATS:
+      shard_items = dict((worker_id, []) for worker_id in self._ipc_channels)
+    fanout_id = self._next_fanout_id
+    self._next_fanout_id = (fanout_id + 1) & 0xffffffff
+    self._fanouts.setdefault(addr_id, {})[fanout_id] = [request_id, op, max(len(shard_items), 1), 0, []]
+    if not shard_items:
+      shard_items[self._shards.get("")] = []  # lets a worker answer the empty request
+    prefix = bytearray(buf[offset:items_offset])
+    _HEADER.pack_into(prefix, 0, op, fanout_id)
+    if op == OP_LEASE_GET:
+      prefix[_HEADER.size:_HEADER.size] = addr_id  # the worker tracks the leases by the connection
+    for worker_id, items in shard_items.iteritems():
+      if len(shard_items) == 1:
+        sub_request = prefix + buf[items_offset:offset + num_bytes]
+      else:
+        sub_request = prefix + _UINT32.pack(len(items)) + "".join(str(buf[start:end]) for start, end in items)
+      self._send_to_worker(worker_id, addr_id, sub_request, 0, len(sub_request), deadline)
+
+  def _outbound_callback(self, addr_id, buf, offset, num_bytes, deadline):
+    fanouts = self._fanouts.get(addr_id)
+    if not fanouts:
+      return  # discards the response if the sock already closed.
+    op, fanout_id = _HEADER.unpack_from(buf, offset)
+    fanout = fanouts.get(fanout_id)
+    if fanout is None:
+      return
+    request_id, op, remaining, item_num, bodies = fanout
+    if remaining == 1 and not bodies:
+      # the only response, forwards it directly.
+      del fanouts[fanout_id]
+      _HEADER.pack_into(buf, offset, op, request_id)
+      SocketServer._outbound_callback(self, addr_id, buf, offset, num_bytes, deadline)
+      return
+    items_offset = offset + _HEADER.size
+    fanout[3] = item_num + _UINT32.unpack_from(buf, items_offset)[0]
+    bodies.append(str(buf[items_offset + 4:offset + num_bytes]))
+    fanout[2] = remaining - 1
+    if remaining > 1:
+      return
+    del fanouts[fanout_id]
+    response = _HEADER.pack(op, request_id) + _UINT32.pack(fanout[3]) + "".join(bodies)
+    SocketServer._outbound_callback(self, addr_id, response, 0, len(response), deadline)
+
+  def close_net_channel(self, addr_id):
+    SocketServer.close_net_channel(self, addr_id)
+    self._fanouts.pop(addr_id, None)
+
+  def destory_worker(self, worker_id):
+    SocketServer.destory_worker(self, worker_id)
+    self._shards.remove(worker_id)  # its keys move to the live workers
+
+def main():
+  # only for test
+  server = CacheServer(20001, worker_num = 4, idle_timeout = 60)
+  server.start()
+
+if __name__ == '__main__':
+  main()
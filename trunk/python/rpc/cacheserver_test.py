@@ -0,0 +1,97 @@
+import struct
+import unittest
+from cacheserver import CacheService, OP_LEASE_GET, OP_REMOVE, OP_SET, STATUS_HIT, STATUS_LEASE
+from timerwheel import TimerWheel
+
+class _Loop(object):
+  """The IO loop interface of TimerWheel, whose timeouts never run."""
+
+  def add_timeout(self, deadline, callback):
+    return callback
+
+  def remove_timeout(self, timeout):
+    pass
+
+# the workers get the payloads as bytes.
+def _lease_get(addr_id, keys, lease_timeout=1000):
+  items = "".join(struct.pack("<H", len(key)) + key for key in keys)
+  return struct.pack("<BI", OP_LEASE_GET, 1) + addr_id + struct.pack("<III", 10, lease_timeout, len(keys)) + items
+
+def _set(key, value):
+  return struct.pack("<BIIIH", OP_SET, 2, 0, 1, len(key)) + key + struct.pack("<I", len(value)) + value
+
+def _remove(keys):
+  return struct.pack("<BII", OP_REMOVE, 3, len(keys)) + "".join(struct.pack("<H", len(key)) + key for key in keys)
+
+def _parse_lease_items(response):
+  item_num = struct.unpack_from("<I", response, 5)[0]
+  pos = 9
+  items = {}
+  for _ in xrange(item_num):
+    key_len = struct.unpack_from("<H", response, pos)[0]
+    key = response[pos + 2:pos + 2 + key_len]
+    pos += 2 + key_len
+    status, valid_until, value_len = struct.unpack_from("<BII", response, pos)
+    items[key] = (status, response[pos + 9:pos + 9 + value_len])
+    pos += 9 + value_len
+  return items
+
+class CacheServiceTest(unittest.TestCase):
+  def test_remove_reports_the_missing_keys(self):
+    service = CacheService(capacity=64)
+    responses = []
+    service.handle(_set("k", "v"), responses.append)
+    service.handle(_remove(["k", "j"]), responses.append)
+    self.assertEqual(struct.pack("<BII", OP_REMOVE, 3, 1) + "\1\0j", responses[-1])
+
+class LeaseTest(unittest.TestCase):
+  def setUp(self):
+    self.service = CacheService(capacity=64)
+    self.service._timer_wheel = TimerWheel(_Loop())
+    self.responses = {}
+
+  def _request(self, addr_id, payload):
+    self.service.handle(payload, lambda response: self.responses.setdefault(addr_id, []).append(response))
+
+  def test_waiter_gets_the_value(self):
+    self._request("client", _lease_get("client", ["k"]))
+    self.assertEqual({"k": (STATUS_LEASE, "")}, _parse_lease_items(self.responses["client"][0]))
+    self._request("waiter", _lease_get("waiter", ["k"]))
+    self.assertFalse("waiter" in self.responses)
+    self._request("client", _set("k", "v"))
+    self.assertEqual({"k": (STATUS_HIT, "v")}, _parse_lease_items(self.responses["waiter"][0]))
+
+  def test_duplicated_keys_do_not_wait_for_themselves(self):
+    self._request("client", _lease_get("client", ["k", "k"]))
+    self.assertEqual({"k": (STATUS_LEASE, "")}, _parse_lease_items(self.responses["client"][0]))
+    self.assertEqual(1, struct.unpack_from("<I", self.responses["client"][0], 5)[0])
+
+  def test_closed_holder_passes_the_lease(self):
+    self._request("client", _lease_get("client", ["k"]))
+    self._request("waiter", _lease_get("waiter", ["k"]))
+    self.service.close_connection("client")
+    self.assertEqual({"k": (STATUS_LEASE, "")}, _parse_lease_items(self.responses["waiter"][0]))
+    self.assertEqual("waiter", self.service._leases["k"].holder)
+    self.assertFalse("client" in self.service._held_leases)
+
+  def test_closed_waiter_stops_waiting(self):
+    self._request("client", _lease_get("client", ["k", "j"]))
+    self._request("waiter", _lease_get("waiter", ["k", "j"]))
+    self.service.close_connection("waiter")
+    self.assertEqual([], self.service._leases["k"].waiters)
+    self.assertEqual([], self.service._leases["j"].waiters)
+    self.assertEqual({}, self.service._waiting_responses)
+    self._request("client", _set("k", "v"))
+    self.assertFalse("waiter" in self.responses)
+
+  def test_expired_lease_passes_to_the_waiter(self):
+    self._request("client", _lease_get("client", ["k"]))
+    self._request("waiter", _lease_get("waiter", ["k"]))
+    self.service._expire_lease("k")
+    self.assertEqual({"k": (STATUS_LEASE, "")}, _parse_lease_items(self.responses["waiter"][0]))
+    self.service.close_connection("waiter")
+    self.assertEqual({}, self.service._leases)
+    self.assertEqual({}, self.service._held_leases)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,252 @@
+"""An in-memory cache store, whose get / set / evict operations are all O(1).
+
+The items are kept in a dict, linked into intrusive LRU lists, and hashed by
+their expiry second into a HashedWheel, which drops the expired items as the
+time goes by, so that the memory stays stable under heavy TTL churn.
+
+The eviction follows W-TinyLFU: new items enter a small LRU window, and the
+ones falling out of the window compete with the eviction victim of the main
+segmented LRU (probation + protected) by their access frequency, estimated
+by a count-min sketch.  A scan of one-off keys therefore can't flush the
+frequently used items out of the cache.
+"""
+
+import random
+import time
+from timerwheel import HashedWheel
+
+def is_fuzzy_expired(cur, expire_until, fuzzy_range=10):
+  """Returns True if the item should be treated as expired, to avoid updating at the same time.
+
+  The same as Zopt\\Cache\\isFuzzyExpired in php/cache/cache.php: the item is
+  randomly reported as expired within fuzzy_range seconds before it expires.
+  """
+  return not ((cur < expire_until - fuzzy_range) or (cur + random.randint(0, fuzzy_range) < expire_until))
+
+# The LRU segments.
+_WINDOW = 0
+_PROBATION = 1
+_PROTECTED = 2
+
+class _Entry(object):
+  """A cache item, which is also a node of the LRU list and an item of the expiry wheel."""
+
+  __slots__ = ("key", "value", "valid_until", "segment", "prev", "next", "expires", "slot")
+
+  def __init__(self, key, value, valid_until):
+    self.key = key
+    self.value = value
+    self.valid_until = valid_until
+    self.segment = _WINDOW
+    self.prev = None
+    self.next = None
+    self.expires = 0
+    self.slot = None
+
+class _FrequencySketch(object):
+  """A count-min sketch estimating the access frequency of keys, with 4 rows of counters up to 15.
+
+  All counters are halved every sample_size increments, so that the estimate
+  follows the recent popularity.
+  """
+
+  def __init__(self, capacity):
+    width = 16
+    while width < capacity:
+      width *= 2
+    self._mask = width - 1
+    self._counters = [bytearray(width) for _ in xrange(4)]
+    self._sample_size = 10 * max(capacity, 1)
+    self._increment_num = 0
+
+  def _indexes(self, key):
+    h = hash(key)
+    mask = self._mask
+    return (h & mask, (h >> 8) & mask, ((h * 0x9e3779b1) >> 16) & mask, ((h * 0x85ebca6b) >> 24) & mask)
+
+  def frequency(self, key):
+    return min(row[index] for row, index in zip(self._counters, self._indexes(key)))
+
+  def increment(self, key):
+    for row, index in zip(self._counters, self._indexes(key)):
+      if row[index] < 15:
+        row[index] += 1
+    self._increment_num += 1
+    if self._increment_num >= self._sample_size:
+      self._increment_num /= 2
+      self._counters = [bytearray(counter >> 1 for counter in row) for row in self._counters]
+
+class CacheStore(object):
+  def __init__(self, capacity=65536, max_bytes=268435456, admission=True):
+    """Initiate the cache store.
+
+    Args:
+      capacity: Maximum number of items.
+      max_bytes: Maximum total size of the keys and values, default set to be 256M bytes.
+      admission: Admits the new items into the main segments by their frequency
+          (TinyLFU), otherwise the store works as a segmented LRU.
+    """
+    self.capacity = capacity
+    self.max_bytes = max_bytes
+    self._window_capacity = max(1, capacity / 100)
+    self._main_capacity = max(1, capacity - self._window_capacity)
+    self._protected_capacity = self._main_capacity * 4 / 5
+    self._sketch = _FrequencySketch(capacity) if admission else None
+    self._entries = {}
+    self._bytes = 0
+    # the sentinels of the circular LRU lists, the most recently used item follows them.
+    self._lists = []
+    for _ in (_WINDOW, _PROBATION, _PROTECTED):
+      head = _Entry(None, None, 0)
+      head.prev = head.next = head
+      self._lists.append(head)
+    self._sizes = [0, 0, 0]
+    self._expiry_wheel = HashedWheel()
+    self._expiry_wheel.current_tick = int(time.time())  # one tick per second
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+    self.rejections = 0  # new items not admitted by TinyLFU
+
+  def __len__(self):
+    return len(self._entries)
+
+  def stats(self):
+    """Returns the statistics of this store."""
+    return {"items": len(self._entries), "bytes": self._bytes,
+            "hits": self.hits, "misses": self.misses,
+            "evictions": self.evictions, "expirations": self.expirations,
+            "rejections": self.rejections}
+
+  def _unlink(self, entry):
+    entry.prev.next = entry.next
+    entry.next.prev = entry.prev
+    self._sizes[entry.segment] -= 1
+
+  def _link_front(self, entry, segment):
+    head = self._lists[segment]
+    entry.segment = segment
+    entry.prev = head
+    entry.next = head.next
+    head.next.prev = entry
+    head.next = entry
+    self._sizes[segment] += 1
+
+  def _delete(self, entry):
+    self._unlink(entry)
+    self._expiry_wheel.remove(entry)
+    del self._entries[entry.key]
+    self._bytes -= len(entry.key) + len(entry.value)
+
+  def _expire(self, now):
+    """Drops the items expired before now."""
+    wheel = self._expiry_wheel
+    if not len(wheel):
+      wheel.current_tick = int(now)
+      return
+    while wheel.current_tick < int(now):
+      for entry in wheel.tick():
+        self._delete(entry)
+        self.expirations += 1
+
+  def _evict(self):
+    """Evicts items until the store fits into its capacity."""
+    window = self._lists[_WINDOW]
+    probation = self._lists[_PROBATION]
+    while self._sizes[_WINDOW] > self._window_capacity:
+      # the window's LRU item becomes the admission candidate on the probation's MRU end.
+      candidate = window.prev
+      self._unlink(candidate)
+      self._link_front(candidate, _PROBATION)
+    while (self._sizes[_PROBATION] + self._sizes[_PROTECTED] > self._main_capacity or
+           self._bytes > self.max_bytes):
+      if self._sizes[_PROBATION]:
+        victim = probation.prev
+        candidate = probation.next
+      elif self._sizes[_PROTECTED]:
+        victim = candidate = self._lists[_PROTECTED].prev
+      else:
+        victim = candidate = window.prev
+      if (candidate is not victim and candidate.segment == _PROBATION and self._sketch and
+          self._sketch.frequency(candidate.key) <= self._sketch.frequency(victim.key)):
+        victim = candidate
+        self.rejections += 1
+      self._delete(victim)
+      self.evictions += 1
+
+  def _touch(self, entry):
+    """Moves an accessed item forward in the LRU segments."""
+    segment = entry.segment
+    self._unlink(entry)
+    if segment == _WINDOW:
+      self._link_front(entry, _WINDOW)
+      return
+    self._link_front(entry, _PROTECTED)
+    if self._sizes[_PROTECTED] > self._protected_capacity:
+      demoted = self._lists[_PROTECTED].prev
+      self._unlink(demoted)
+      self._link_front(demoted, _PROBATION)
+
+  def get(self, key, now=None):
+    """Returns the (value, valid_until) tuple of the item, or None if it's not found or expired.
+
+    Args:
+      key: Key of the item.
+      now: The current epoch time in seconds, default to time.time().
+    """
+    now = now or time.time()
+    self._expire(now)
+    if self._sketch:
+      self._sketch.increment(key)
+    entry = self._entries.get(key)
+    if entry is None or (entry.valid_until and entry.valid_until < now):
+      self.misses += 1
+      return None
+    self.hits += 1
+    self._touch(entry)
+    return (entry.value, entry.valid_until)
+
+  def set(self, key, value, ttl=0, now=None):
+    """Sets the item, returns False if it's too large to be cached, which removes its old value.
+
+    Args:
+      key: Key of the item.
+      value: Value of the item, a byte string.
+      ttl: Seconds that the item will exist, 0 means persistent until evicted.
+      now: The current epoch time in seconds, default to time.time().
+    """
+    now = now or time.time()
+    self._expire(now)
+    size = len(key) + len(value)
+    if size > self.max_bytes:
+      self.remove(key)  # or the stale value would still be served
+      return False
+    if self._sketch:
+      self._sketch.increment(key)
+    valid_until = int(now) + ttl if ttl else 0
+    entry = self._entries.get(key)
+    if entry is not None:
+      self._bytes += size - len(entry.key) - len(entry.value)
+      entry.value = value
+      entry.valid_until = valid_until
+      self._expiry_wheel.remove(entry)
+      self._touch(entry)
+    else:
+      entry = _Entry(key, value, valid_until)
+      self._entries[key] = entry
+      self._bytes += size
+      self._link_front(entry, _WINDOW)
+    if valid_until:
+      entry.expires = valid_until + 1  # expired once the clock passes valid_until
+      self._expiry_wheel.add(entry)
+    self._evict()
+    return True
+
+  def remove(self, key):
+    """Removes the item, returns False if it's not found."""
+    entry = self._entries.get(key)
+    if entry is None:
+      return False
+    self._delete(entry)
+    return True
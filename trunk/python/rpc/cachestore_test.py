@@ -0,0 +1,71 @@
+import unittest
+from cachestore import CacheStore, is_fuzzy_expired
+
+NOW = 1000000
+
+class CacheStoreTest(unittest.TestCase):
+  def test_get_set_remove(self):
+    store = CacheStore(16)
+    self.assertTrue(store.set("k", "v", 0, NOW))
+    self.assertEqual(("v", 0), store.get("k", NOW))
+    self.assertTrue(store.set("k", "w", 10, NOW))
+    self.assertEqual(("w", NOW + 10), store.get("k", NOW))
+    self.assertTrue(store.remove("k"))
+    self.assertFalse(store.remove("k"))
+    self.assertEqual(None, store.get("k", NOW))
+    self.assertEqual(0, store.stats()["bytes"])
+
+  def test_expiry(self):
+    store = CacheStore(16)
+    store.set("short", "v", 5, NOW)
+    store.set("long", "v", 50, NOW)
+    store.set("persistent", "v", 0, NOW)
+    self.assertEqual(("v", NOW + 5), store.get("short", NOW + 5))
+    self.assertEqual(None, store.get("short", NOW + 6))
+    self.assertEqual(2, len(store))  # dropped by the expiry wheel
+    self.assertEqual(None, store.get("long", NOW + 100))
+    self.assertEqual(("v", 0), store.get("persistent", NOW + 100))
+    self.assertEqual(2, store.expirations)
+
+  def test_oversized_value_removes_the_old_one(self):
+    store = CacheStore(16, max_bytes=100)
+    store.set("k", "v", 0, NOW)
+    self.assertFalse(store.set("k", "x" * 100, 0, NOW))
+    self.assertEqual(None, store.get("k", NOW))
+    self.assertEqual(0, store.stats()["bytes"])
+
+  def test_evicts_to_max_bytes(self):
+    store = CacheStore(100, max_bytes=100, admission=False)
+    for i in xrange(10):
+      store.set("k%d" % i, "x" * 18, 0, NOW)
+    self.assertTrue(store.stats()["bytes"] <= 100)
+    self.assertEqual(("x" * 18, 0), store.get("k9", NOW))
+    self.assertEqual(None, store.get("k0", NOW))
+
+  def test_evicts_to_capacity(self):
+    store = CacheStore(100, admission=False)
+    for i in xrange(300):
+      store.set("k%d" % i, "v", 0, NOW)
+    self.assertEqual(100, len(store))
+    self.assertEqual(200, store.evictions)
+
+  def test_frequent_items_survive_a_scan(self):
+    store = CacheStore(100)
+    hot = ["hot%d" % i for i in xrange(50)]
+    for key in hot:
+      store.set(key, "v", 0, NOW)
+    for _ in xrange(5):
+      for key in hot:
+        store.get(key, NOW)
+    for i in xrange(1000):
+      store.set("scan%d" % i, "v", 0, NOW)
+    # the sketch may overestimate a few scanned keys.
+    self.assertTrue(sum(1 for key in hot if store.get(key, NOW) is not None) >= 45)
+    self.assertTrue(store.rejections > store.evictions / 2)
+
+  def test_fuzzy_expired(self):
+    self.assertFalse(is_fuzzy_expired(NOW, NOW + 20, 10))
+    self.assertTrue(is_fuzzy_expired(NOW, NOW, 10))
+
+if __name__ == '__main__':
+  unittest.main()
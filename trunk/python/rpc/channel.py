@@ -1,8 +1,64 @@
+import logging
 import struct
+import time
+import compression
 import iostream
 
 """Channels used in socketserver"""
 
+# The frame header is a little-endian signed 32-bit integer.
+# If the header is < 0, then the frame is a control message of length -header.
+# If the header is > 0, then its low 24 bits are the payload length, and its
+# bits 24-30 are the frame flags, which declare the optional fields placed
+# between the header and the payload.
+LENGTH_MASK = 0x00ffffff
+FLAG_DEADLINE = 0x01000000  # a deadline field follows the header
+# The payload is compressed, and | 1 byte codec | 4 bytes raw length | follows
+# the other optional fields; the header length is the compressed length.
+FLAG_COMPRESSED = 0x02000000
+_COMPRESSION_FIELD = struct.Struct("<BI")
+# The frame is a chunk of a streamed message, and | 1 byte chunk flags |
+# follows the other optional fields.  The chunks of a message come in order,
+# and a message ends with the chunk flagged CHUNK_LAST, so that a message of
+# any size travels in frames of bounded size.
+FLAG_CHUNK = 0x04000000
+CHUNK_LAST = 0x01
+CHUNK_ABORTED = 0x02  # the sender failed to produce the rest of the message, always with CHUNK_LAST
+_CHUNK_FIELD = struct.Struct("<B")
+# Bits 27-28 are the priority class of a data frame, see scheduler.py, and
+# PRIORITY_NORMAL is the class of the frames without one.  There is no field.
+PRIORITY_SHIFT = 27
+PRIORITY_MASK = 0x18000000
+PRIORITY_NORMAL = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BATCH = 2
+
+# Control message types, stored in the first byte of a control message.
+CONTROL_CANCEL = 1  # | 1 byte type | 6 bytes addr_id |, acceptor -> worker
+# | 1 byte type | 6 bytes addr_id |, acceptor -> worker, the fd of the connection
+# is passed on the handoff socket, in the same order as these messages.
+CONTROL_HANDOFF = 2
+CONTROL_CLOSED = 3  # | 1 byte type | 6 bytes addr_id |, worker -> acceptor, a handed-off connection closed
+# | 1 byte type | 1 byte codec mask |, either peer, the codecs the sender decodes,
+# so that the receiver may compress its frames, see compression.py.
+CONTROL_COMPRESSION = 4
+# | 1 byte type | 6 bytes addr_id |, between the acceptor and a worker, in the
+# opposite direction of a stream of addr_id: one of its chunks is consumed, so
+# that the sender may send one more.
+CONTROL_CREDIT = 5
+# | 1 byte type | opaque data |, a health check answered by the channel itself
+# with CONTROL_PONG and the same data, so that it never waits behind the requests.
+CONTROL_PING = 6
+CONTROL_PONG = 7
+# | 1 byte type | 4 bytes count |, worker -> acceptor, the number of the requests
+# the worker took from its queue since the last report, see SocketServer.
+CONTROL_DEQUEUED = 8
+# | 1 byte type | the first bytes of the request payload |, acceptor -> client, the
+# request is shed without being served, as the server is overloaded.  The payload
+# head, e.g. | op | request_id | of the json services, tells which request it was.
+CONTROL_OVERLOADED = 9
+OVERLOADED_PAYLOAD_HEAD = 16
+
 def _callback_to_read_handler(channel_obj, callback):
   """Method decoration, convert a callback into channel's read handler.
 
@@ -10,7 +66,7 @@ def _callback_to_read_handler(channel_obj, callback):
     channel_obj: The channel object.
     callback: The function will be called in the handler.
   """
-  def _handler(channel_obj, *args, **kwargs):
+  def _handler(*args, **kwargs):
     if callback:
       try:
         callback(*args, **kwargs)
@@ -23,53 +79,126 @@ def _callback_to_read_handler(channel_obj, callback):
         # Re-raise the exception so that IOLoop.handle_callback_exception
         # can see it and log the error
         raise
-    channel_obj.read()
+    if not channel_obj.closed():
+      channel_obj.read()
   return _handler
 
 def _read_handler_to_ipc(handler):
-  def _ipc_handler(buf, offset, num_bytes):
+  def _ipc_handler(buf, offset, num_bytes, *args):
     if handler:
-      handler(buf[offset:offset+6], buf, offset+6, num_bytes-6)
+      handler(bytes(buf[offset:offset+6]), buf, offset+6, num_bytes-6, *args)
   return _ipc_handler
 
+def pack_control(control_type, addr_id):
+  """Builds the control message of the given type about the connection addr_id."""
+  return bytearray([control_type]) + addr_id
+
+def pack_cancel(addr_id):
+  """Builds the control message which cancels all queued requests of addr_id."""
+  return pack_control(CONTROL_CANCEL, addr_id)
+
 class NetworkChannel(object):
   """This class handles network packages."""
 
-  def __init__(self, sock, data_callback, control_callback=None, close_callback=None, io_loop=None, name=None):
+  # Peers do not share clocks, so the deadline travels as a relative timeout in milliseconds.
+  _deadline_parser = struct.Struct("<I")
+
+  def __init__(self, sock, data_callback, control_callback=None, close_callback=None, io_loop=None, name=None,
+               stream=None):
     """Initiate the network channel for socket server to receive/send messages.
 
     Args:
       sock: The socket for receiving / sending messages.
       data_callback: The handler for data messages.
-          Function fingerprint: callback(buf, offset, num_bytes)
+          Function fingerprint: callback(buf, offset, num_bytes, deadline)
+          deadline is the absolute time (as time.time()) after which the
+          sender no longer waits for the result, or None.
       control_callback: The handler for control messages.
           Function fingerprint: callback(buf, offset, num_bytes)
       close_callback: The callback method triggered when this channel closed.
           Function fingerprint: callback()
       io_loop: The IO loop, on which the read/write operations depends; default using global IOLoop instance.
       name: The name of this object, could be used in debug info output.
+      stream: The stream to work on instead of an IOStream of sock, which
+          provides read / write / close / set_close_callback / max_buf_size the same as IOStream,
+          e.g. aioprotocol.TransportStream.
     """
-    self._stream = iostream.IOStream(sock, io_loop, name)
+    self._stream = stream or iostream.IOStream(sock, io_loop, name)
     self._stream.set_close_callback(close_callback)
     self._data_handler = _callback_to_read_handler(self, data_callback)
-    self._control_handler = _callback_to_read_handler(self, control_callback)
+    self._control_callback = control_callback
+    self._control_handler = _callback_to_read_handler(self, self._handle_control)
     self._name = name
-    self._header_parser = struct.struct("<i")
+    self._header_parser = struct.Struct("<i")
     self._header_buf = bytearray(4)
+    self._deadline_buf = bytearray(self._deadline_parser.size)
+    self._compression_buf = bytearray(_COMPRESSION_FIELD.size)
+    self._payload_length = 0
+    self._flags = 0  # the flags of the current frame whose fields are not read yet
+    self.priority = PRIORITY_NORMAL  # the priority class of the data frame being handled
+    self._deadline = None
+    self._compression = None  # (codec, raw length) of the current frame
+    self._compressor = None
+    self._peer_codecs = 0
+    self._chunk_flags = None  # the chunk flags of the current frame, None if it isn't a chunk
+    self._chunk_handler = None
+    self._chunk_buf = bytearray(_CHUNK_FIELD.size)
+    self._paused = False
+    self._read_paused = False  # a read was requested while paused
+
+  def set_compressor(self, compressor):
+    """Compresses the data frames sent on this channel, once the peer accepts the codec of the compressor."""
+    self._compressor = compressor
+
+  def set_chunk_callback(self, chunk_callback):
+    """Accepts the streamed messages, whose chunks are passed to chunk_callback as they arrive.
+
+    Without a chunk callback, the channel closes on the first chunk.
+
+    Args:
+      chunk_callback: The handler for the chunks.
+          Function fingerprint: callback(buf, offset, num_bytes, deadline, chunk_flags)
+    """
+    self._chunk_handler = _callback_to_read_handler(self, chunk_callback)
+
+  def pause_reading(self):
+    """Stops reading the frames after the current one until resume_reading, e.g. while the chunks are not consumed."""
+    self._paused = True
+
+  def resume_reading(self):
+    self._paused = False
+    if self._read_paused:
+      self._read_paused = False
+      self.read()
+
+  def accept_compression(self):
+    """Tells the peer the codecs this channel decodes, so that it may compress the frames it sends."""
+    msg = bytearray([CONTROL_COMPRESSION, compression.supported_codecs()])
+    self.write(msg, 0, len(msg), False)
 
   def close(self):
     """Close the channel."""
     self._stream.close()
 
+  def closed(self):
+    """Returns True if the channel has been closed."""
+    return not self._stream.socket
+
+  def set_timeouts(self, timer_wheel, idle_timeout=None, read_timeout=None, write_timeout=None):
+    """Closes the channel when it hangs longer than the given timeouts, see IOStream.set_timeouts."""
+    self._stream.set_timeouts(timer_wheel, idle_timeout, read_timeout, write_timeout)
+
   def read(self):
     """Start the channel reading.
 
     The data receiving / sending on this channel follows the format:
-    | 4 bytes header | data_payload / control_message |
-    If the header is > 0, then len(data_payload) = header.
-    If the header is < 0, then len(control_message) = -header.
+    | 4 bytes header | optional fields | data_payload / control_message |
+    See LENGTH_MASK and FLAG_* for the header layout.
     """
-    self._stream.read_bytes(4, self._handle_header)
+    if self._paused:
+      self._read_paused = True
+      return
+    self._stream.read(4, self._handle_header)
 
   def _handle_header(self, buf, offset, num_bytes):
     """Handle the data header, and start reading the true payload data or control message.
@@ -79,18 +208,199 @@ class NetworkChannel(object):
       offset: The offset that header starts on the buffer.
       num_bytes: Header length, should be 4 in this case.
     """
-    assert num_bytes is 4, "%s: Header length is wrong: %d!" % (self._name, num_bytes)
-    payload_length = self._header_parser.unpack_from(buf, offset)[0]
-    assert payload_length is not 0, "%s: The payload length should not be 0!" % self._name
-    handler = self._data_handler if payload_length > 0 else self._control_handler
-    self._stream.read_bytes(abs(payload_length), handler)
-
-  def write(self, buf, offset, num_bytes, is_data=True, callback=None):
-    """Write payload data or control message to channel."""
-    header = num_bytes if is_data else -num_bytes
+    assert num_bytes == 4, "%s: Header length is wrong: %d!" % (self._name, num_bytes)
+    header = self._header_parser.unpack_from(buf, offset)[0]
+    assert header != 0, "%s: The payload length should not be 0!" % self._name
+    if header < 0:
+      self._stream.read(-header, self._control_handler)
+      return
+    self._payload_length = header & LENGTH_MASK
+    self._flags = header
+    self.priority = (header & PRIORITY_MASK) >> PRIORITY_SHIFT
+    self._deadline = None
+    self._compression = None
+    self._chunk_flags = None
+    self._read_field()
+
+  def _read_field(self):
+    """Start reading the next optional field declared by the header, or the payload after all of them."""
+    if self._flags & FLAG_DEADLINE:
+      self._stream.read(self._deadline_parser.size, self._handle_deadline)
+    elif self._flags & FLAG_COMPRESSED:
+      self._stream.read(_COMPRESSION_FIELD.size, self._handle_compression)
+    elif self._flags & FLAG_CHUNK:
+      self._stream.read(_CHUNK_FIELD.size, self._handle_chunk)
+    else:
+      self._stream.read(self._payload_length, self._handle_data)
+
+  def _handle_deadline(self, buf, offset, num_bytes):
+    """Handle the deadline field, and start reading the next field."""
+    self._deadline = self._unpack_deadline(buf, offset)
+    self._flags &= ~FLAG_DEADLINE
+    self._read_field()
+
+  def _handle_compression(self, buf, offset, num_bytes):
+    """Handle the compression field, and start reading the next field."""
+    self._compression = _COMPRESSION_FIELD.unpack_from(buf, offset)
+    # the raw payload is bounded as a raw frame would be, so that a small frame can't inflate
+    # beyond the read buffer, nor beyond what the acceptor can pass on to a worker.
+    max_raw_length = min(LENGTH_MASK - 6, self._stream.max_buf_size)
+    if not 0 < self._compression[1] <= max_raw_length:
+      logging.warning("%s: Compressed frame of invalid raw length %d", self._name, self._compression[1])
+      self.close()
+      return
+    self._flags &= ~FLAG_COMPRESSED
+    self._read_field()
+
+  def _handle_chunk(self, buf, offset, num_bytes):
+    """Handle the chunk field, and start reading the next field."""
+    self._chunk_flags = buf[offset]
+    self._flags &= ~FLAG_CHUNK
+    self._read_field()
+
+  def _handle_data(self, buf, offset, num_bytes):
+    if self._compression is not None:
+      codec, raw_length = self._compression
+      try:
+        # the raw payload is handed to the handler as is, instead of being copied back into the stream buffer.
+        buf = compression.decode(codec, buf, offset, num_bytes, raw_length)
+      except ValueError as e:
+        logging.warning("%s: Broken compressed frame: %s", self._name, e)
+        self.close()
+        return
+      offset, num_bytes = 0, raw_length
+    if self._chunk_flags is None:
+      self._data_handler(buf, offset, num_bytes, self._deadline)
+    elif self._chunk_handler:
+      self._chunk_handler(buf, offset, num_bytes, self._deadline, self._chunk_flags)
+    else:
+      logging.warning("%s: Streamed messages are not accepted", self._name)
+      self.close()
+
+  def _handle_control(self, buf, offset, num_bytes):
+    if num_bytes == 2 and buf[offset] == CONTROL_COMPRESSION:
+      self._peer_codecs = buf[offset + 1]
+    elif buf[offset] == CONTROL_PING:
+      pong = bytearray(buf[offset:offset + num_bytes])
+      pong[0] = CONTROL_PONG
+      self.write(pong, 0, len(pong), False)
+    elif self._control_callback:
+      self._control_callback(buf, offset, num_bytes)
+
+  def _pack_deadline(self, deadline):
+    timeout = max(0, int((deadline - time.time()) * 1000))
+    self._deadline_parser.pack_into(self._deadline_buf, 0, timeout)
+
+  def _unpack_deadline(self, buf, offset):
+    return time.time() + self._deadline_parser.unpack_from(buf, offset)[0] / 1000.0
+
+  def _write_header(self, header, deadline, raw_length=None, chunk_flags=None, priority=PRIORITY_NORMAL):
+    """Writes the header and the optional fields, raw_length is set for a compressed payload, chunk_flags for a chunk."""
+    header |= priority << PRIORITY_SHIFT
+    if deadline is not None:
+      header |= FLAG_DEADLINE
+    if raw_length is not None:
+      header |= FLAG_COMPRESSED
+    if chunk_flags is not None:
+      header |= FLAG_CHUNK
     self._header_parser.pack_into(self._header_buf, 0, header)
     self._stream.write(self._header_buf, 0, 4)
-    self._stream.write(buf, offset, num, callback)
+    if deadline is not None:
+      self._pack_deadline(deadline)
+      self._stream.write(self._deadline_buf, 0, self._deadline_parser.size)
+    if raw_length is not None:
+      _COMPRESSION_FIELD.pack_into(self._compression_buf, 0, self._compressor.codec, raw_length)
+      self._stream.write(self._compression_buf, 0, _COMPRESSION_FIELD.size)
+    if chunk_flags is not None:
+      _CHUNK_FIELD.pack_into(self._chunk_buf, 0, chunk_flags)
+      self._stream.write(self._chunk_buf, 0, _CHUNK_FIELD.size)
+
+  def write(self, buf, offset, num_bytes, is_data=True, callback=0, deadline=None, chunk_flags=None,
+            priority=PRIORITY_NORMAL):
+    """Write payload data or control message to channel.
+
+    Args:
+      deadline: The absolute time after which the result is useless, only
+          valid for data messages.  None means no deadline.
+      chunk_flags: The CHUNK_* flags if the data is a chunk of a streamed message, 0 for a middle chunk.
+      priority: The priority class of the data message.
+
+    Raises:
+      ValueError: The data message is longer than LENGTH_MASK, which the header can't hold.
+    """
+    if is_data:
+      if num_bytes > LENGTH_MASK:
+        raise ValueError("%s: Payload of %d bytes is too large" % (self._name, num_bytes))
+      if self._compressor and self._peer_codecs & self._compressor.codec_mask:
+        data = self._compressor.compress(buf, offset, num_bytes)
+        if data is not None:
+          self._write_header(len(data), deadline, num_bytes, chunk_flags, priority)
+          self._stream.write(data, 0, len(data), callback)
+          return
+      self._write_header(num_bytes, deadline, None, chunk_flags, priority)
+    else:
+      self._write_header(-num_bytes, None)
+    self._stream.write(buf, offset, num_bytes, callback)
+
+class IpcChannel(NetworkChannel):
+  """This class handles packages between the socket server and its workers.
+
+  Each data message is prefixed by the 6 bytes addr_id of the network
+  connection it belongs to.
+  """
+
+  # Both ends run on the same host, so the deadline travels as an absolute time.
+  _deadline_parser = struct.Struct("<d")
+
+  def __init__(self, sock, worker_id, data_callback, control_callback=None, close_callback=None, io_loop=None):
+    """Initiate the ipc channel.
+
+    Args:
+      sock: One end of the socket pair between the server and the worker.
+      worker_id: The id of the worker on the other end.
+      data_callback: The handler for data messages.
+          Function fingerprint: callback(addr_id, buf, offset, num_bytes, deadline)
+      control_callback: The handler for control messages.
+          Function fingerprint: callback(buf, offset, num_bytes)
+      close_callback: The callback method triggered when this channel closed.
+          Function fingerprint: callback()
+      io_loop: The IO loop, on which the read/write operations depends.
+    """
+    NetworkChannel.__init__(self, sock, _read_handler_to_ipc(data_callback),
+                            control_callback, close_callback, io_loop,
+                            "IpcChannel-%d" % worker_id)
+    self._worker_id = worker_id
+
+  def _pack_deadline(self, deadline):
+    self._deadline_parser.pack_into(self._deadline_buf, 0, deadline)
+
+  def _unpack_deadline(self, buf, offset):
+    return self._deadline_parser.unpack_from(buf, offset)[0]
+
+  def set_chunk_callback(self, chunk_callback):
+    """Accepts the streamed messages, see NetworkChannel.set_chunk_callback.
+
+    Args:
+      chunk_callback: The handler for the chunks.
+          Function fingerprint: callback(addr_id, buf, offset, num_bytes, deadline, chunk_flags)
+    """
+    NetworkChannel.set_chunk_callback(self, _read_handler_to_ipc(chunk_callback))
+
+  def write(self, addr_id, buf, offset, num_bytes, deadline=None, callback=0, chunk_flags=None):
+    """Write payload data of the given connection to channel, chunk_flags is set for a chunk.
+
+    Raises:
+      ValueError: The payload and the addr_id are longer than LENGTH_MASK, which the header can't hold.
+    """
+    if num_bytes + 6 > LENGTH_MASK:
+      raise ValueError("%s: Payload of %d bytes is too large" % (self._name, num_bytes))
+    self._write_header(num_bytes + 6, deadline, None, chunk_flags)
+    self._stream.write(addr_id, 0, 6)
+    self._stream.write(buf, offset, num_bytes, callback)
+
+  def write_control(self, buf, offset, num_bytes, callback=0):
+    """Write control message to channel."""
+    NetworkChannel.write(self, buf, offset, num_bytes, False, callback)
 
 class TestNetworkChannel(object):
   """This class is the network channel for HTTP benchmark test."""
@@ -105,9 +415,8 @@ class TestNetworkChannel(object):
     self._stream.close()
 
   def read(self):
-    self._stream.read_bytes(113, self._data_handler)
-
-  def write(self, buf, offset, num_bytes, is_data=True, callback=None):
-    self._stream.write(buf, offset, num, callback)
+    self._stream.read(113, self._data_handler)
 
+  def write(self, buf, offset, num_bytes, is_data=True, callback=0):
+    self._stream.write(buf, offset, num_bytes, callback)
 
@@ -0,0 +1,126 @@
+import socket
+import struct
+import time
+import unittest
+from channel import NetworkChannel, IpcChannel, LENGTH_MASK, FLAG_DEADLINE, FLAG_CHUNK, PRIORITY_MASK, \
+    PRIORITY_SHIFT, PRIORITY_BATCH, CHUNK_LAST, CONTROL_CANCEL, CONTROL_PING, CONTROL_PONG, pack_cancel
+
+class _Stream(object):
+  """The IOStream interface of NetworkChannel, which runs the reads on the data fed by the test."""
+
+  max_buf_size = 16777216
+
+  def __init__(self):
+    self.socket = True
+    self.written = bytearray()
+    self._buf = bytearray()
+    self._reads = []
+    self._close_callback = None
+
+  def set_close_callback(self, callback):
+    self._close_callback = callback
+
+  def read(self, num_bytes, callback):
+    self._reads.append((num_bytes, callback))
+
+  def write(self, buf, offset, num_bytes, callback=0):
+    self.written += buf[offset:offset + num_bytes]
+
+  def close(self):
+    self.socket = None
+
+  def feed(self, data):
+    self._buf += data
+    while self.socket and self._reads and len(self._buf) >= self._reads[0][0]:
+      num_bytes, callback = self._reads.pop(0)
+      buf = self._buf[:num_bytes]
+      del self._buf[:num_bytes]
+      callback(buf, 0, num_bytes)
+
+class NetworkChannelTest(unittest.TestCase):
+  def setUp(self):
+    self.stream = _Stream()
+    self.frames = []
+    self.controls = []
+    self.chunks = []
+    self.channel = NetworkChannel(None, self._on_data, self._on_control, stream=self.stream)
+    self.channel.set_chunk_callback(lambda buf, offset, num_bytes, deadline, chunk_flags:
+                                    self.chunks.append((bytes(buf[offset:offset + num_bytes]), chunk_flags)))
+    self.channel.read()
+
+  def _on_data(self, buf, offset, num_bytes, deadline):
+    self.frames.append((bytes(buf[offset:offset + num_bytes]), deadline, self.channel.priority))
+
+  def _on_control(self, buf, offset, num_bytes):
+    self.controls.append(bytes(buf[offset:offset + num_bytes]))
+
+  def test_plain_frame(self):
+    self.channel.write(bytearray("hello"), 0, 5)
+    self.assertEqual(struct.pack("<i", 5) + "hello", bytes(self.stream.written))
+    self.stream.feed(self.stream.written)
+    self.assertEqual([("hello", None, 0)], self.frames)
+
+  def test_deadline_travels_as_relative_milliseconds(self):
+    self.channel.write(bytearray("x"), 0, 1, deadline=time.time() + 2)
+    header, timeout = struct.unpack_from("<iI", self.stream.written)
+    self.assertEqual(1 | FLAG_DEADLINE, header)
+    self.assertTrue(1900 <= timeout <= 2000)
+    self.stream.feed(self.stream.written)
+    deadline = self.frames[0][1]
+    self.assertTrue(time.time() + 1.8 < deadline <= time.time() + 2)
+
+  def test_priority_bits(self):
+    self.channel.write(bytearray("x"), 0, 1, priority=PRIORITY_BATCH)
+    header = struct.unpack_from("<i", self.stream.written)[0]
+    self.assertEqual(PRIORITY_BATCH, (header & PRIORITY_MASK) >> PRIORITY_SHIFT)
+    self.assertEqual(1, header & LENGTH_MASK)
+    self.stream.feed(self.stream.written)
+    self.assertEqual([("x", None, PRIORITY_BATCH)], self.frames)
+
+  def test_chunk_frame(self):
+    self.channel.write(bytearray("tail"), 0, 4, chunk_flags=CHUNK_LAST)
+    header, chunk_flags = struct.unpack_from("<iB", self.stream.written)
+    self.assertEqual(4 | FLAG_CHUNK, header)
+    self.assertEqual(CHUNK_LAST, chunk_flags)
+    self.stream.feed(self.stream.written)
+    self.assertEqual([("tail", CHUNK_LAST)], self.chunks)
+
+  def test_control_frames(self):
+    msg = pack_cancel("abcdef")
+    self.channel.write(msg, 0, len(msg), False)
+    self.assertEqual(struct.pack("<iB", -7, CONTROL_CANCEL) + "abcdef", bytes(self.stream.written))
+    self.stream.feed(self.stream.written)
+    self.assertEqual([chr(CONTROL_CANCEL) + "abcdef"], self.controls)
+
+  def test_ping_is_answered_by_the_channel(self):
+    self.stream.feed(struct.pack("<iB", -5, CONTROL_PING) + "abcd")
+    self.assertEqual(struct.pack("<iB", -5, CONTROL_PONG) + "abcd", bytes(self.stream.written))
+    self.assertEqual([], self.controls)
+
+  def test_rejects_payload_beyond_length_mask(self):
+    self.assertRaises(ValueError, self.channel.write, bytearray(), 0, LENGTH_MASK + 1)
+    self.assertEqual("", bytes(self.stream.written))
+
+class IpcChannelTest(unittest.TestCase):
+  def setUp(self):
+    self.sockets = socket.socketpair()
+    self.channel = IpcChannel(self.sockets[0], 0, None)
+    self.channel._stream = self.stream = _Stream()
+
+  def tearDown(self):
+    for sock in self.sockets:
+      sock.close()
+
+  def test_prefixes_the_addr_id_with_an_absolute_deadline(self):
+    deadline = time.time() + 1
+    self.channel.write("abcdef", bytearray("x"), 0, 1, deadline)
+    header, packed_deadline = struct.unpack_from("<id", self.stream.written)
+    self.assertEqual(7 | FLAG_DEADLINE, header)
+    self.assertEqual(deadline, packed_deadline)
+    self.assertEqual("abcdefx", bytes(self.stream.written[12:]))
+
+  def test_rejects_payload_beyond_length_mask(self):
+    self.assertRaises(ValueError, self.channel.write, "abcdef", bytearray(), 0, LENGTH_MASK - 5)
+
+if __name__ == '__main__':
+  unittest.main()
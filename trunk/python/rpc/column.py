@@ -0,0 +1,34 @@
+import numpy as np
+
+"""The growable columns of NumPy arrays, which the vectorized services keep their data in."""
+
+class Column(object):
+  """A growable NumPy array, which doubles its capacity when full."""
+
+  def __init__(self, dtype, capacity=1024):
+    self._array = np.zeros(capacity, dtype)
+    self.size = 0
+
+  def __len__(self):
+    return self.size
+
+  def extend(self, values):
+    new_size = self.size + len(values)
+    if new_size > len(self._array):
+      capacity = len(self._array)
+      while capacity < new_size:
+        capacity *= 2
+      array = np.zeros(capacity, self._array.dtype)
+      array[:self.size] = self._array[:self.size]
+      self._array = array
+    self._array[self.size:new_size] = values
+    self.size = new_size
+
+  def resize(self, size):
+    """Grows the array to at least size elements, the new ones are zeros."""
+    if size > self.size:
+      self.extend(np.zeros(size - self.size, self._array.dtype))
+
+  @property
+  def values(self):
+    return self._array[:self.size]
@@ -0,0 +1,126 @@
+"""The codecs of the compressed frames of NetworkChannel, and the adaptive compressor deciding which frames to compress.
+
+A compressed frame carries FLAG_COMPRESSED, and the field
+| 1 byte codec | 4 bytes raw length | follows the other optional fields, see
+channel.py.  Every channel decodes the compressed frames, while a channel
+compresses its frames only after the peer sends CONTROL_COMPRESSION with the
+codecs it decodes, so that the old clients keep getting raw frames.
+
+The compressor is shared by all the channels of a process.  The small frames
+stay raw, as their compression saves less than the framing costs.  In the
+adaptive mode, the compressor measures the saving of the frames it
+compresses, and mostly stops compressing when the payloads turn out not
+compressible, only probing one frame in probe_interval.  It also samples the
+cpu usage of the process, and stops compressing while the process is cpu
+bound, where the compression would cost more than the bandwidth it saves.
+"""
+
+import os
+import time
+import zlib
+
+try:
+  import lz4.block as _lz4
+except ImportError:
+  _lz4 = None
+
+CODEC_ZLIB = 1
+CODEC_LZ4 = 2
+
+def _zlib_decode(data, raw_length):
+  decompressor = zlib.decompressobj()
+  raw = decompressor.decompress(data, raw_length)  # bounded, against the compression bombs
+  if len(raw) != raw_length or decompressor.unconsumed_tail:
+    raise ValueError("Mismatched raw length")
+  return raw
+
+_ENCODERS = {CODEC_ZLIB: lambda data, level: zlib.compress(data, level)}
+_DECODERS = {CODEC_ZLIB: _zlib_decode}
+if _lz4:
+  _ENCODERS[CODEC_LZ4] = lambda data, level: _lz4.compress(data, store_size=False)
+  _DECODERS[CODEC_LZ4] = lambda data, raw_length: _lz4.decompress(data, uncompressed_size=raw_length)
+
+def supported_codecs():
+  """Returns the bit mask of the codecs this process decodes, bit (1 << codec) for each codec."""
+  mask = 0
+  for codec in _DECODERS:
+    mask |= 1 << codec
+  return mask
+
+def decode(codec, buf, offset, num_bytes, raw_length):
+  """Returns the raw payload of a compressed frame, raises ValueError if it's broken."""
+  if raw_length <= 0:
+    raise ValueError("Invalid raw length %d" % raw_length)  # zlib takes a max length of 0 as unbounded
+  decoder = _DECODERS.get(codec)
+  if decoder is None:
+    raise ValueError("Unsupported codec %d" % codec)
+  try:
+    return decoder(bytes(buf[offset:offset + num_bytes]), raw_length)
+  except ValueError:
+    raise
+  except Exception as e:  # zlib.error, lz4 errors
+    raise ValueError(str(e))
+
+class Compressor(object):
+  def __init__(self, codec=CODEC_ZLIB, level=1, min_size=1024, adaptive=True, min_saving=0.1,
+               probe_interval=16, max_cpu_usage=0.8, sample_interval=1.0):
+    """Initiate the compressor.
+
+    Args:
+      codec: The codec of the compressed frames, CODEC_LZ4 needs the lz4 module.
+      level: The compression level of zlib.
+      min_size: Frames smaller than this many bytes are sent raw.
+      adaptive: Stops compressing when it doesn't pay, see the module doc.
+      min_saving: The fraction of bytes the compression should save on average.
+      probe_interval: One frame in these many is still compressed while the saving is too low.
+      max_cpu_usage: The cpu usage of the process, user + system over wall time,
+          above which the compression stops.
+      sample_interval: Seconds between the samples of the cpu usage.
+    """
+    if codec not in _ENCODERS:
+      raise ValueError("Unsupported codec %d" % codec)
+    self.codec = codec
+    self.codec_mask = 1 << codec
+    self._level = level
+    self._min_size = min_size
+    self._adaptive = adaptive
+    self._max_ratio = 1.0 - min_saving
+    self._probe_interval = probe_interval
+    self._max_cpu_usage = max_cpu_usage
+    self._sample_interval = sample_interval
+    self._ratio = 0.0  # moving average of compressed / raw bytes
+    self._skipped = 0  # frames skipped since the last probe
+    self._cpu_bound = False
+    self._sample_time = time.time()
+    self._sample_cpu = sum(os.times()[:2])
+    self.raw_bytes = 0  # raw bytes of the compressed frames
+    self.compressed_bytes = 0
+
+  def _sample(self, now):
+    cpu = sum(os.times()[:2])
+    self._cpu_bound = (cpu - self._sample_cpu) > self._max_cpu_usage * (now - self._sample_time)
+    self._sample_time = now
+    self._sample_cpu = cpu
+
+  def compress(self, buf, offset, num_bytes):
+    """Returns the compressed payload, or None if the frame should be sent raw."""
+    if num_bytes < self._min_size:
+      return None
+    if self._adaptive:
+      now = time.time()
+      if now - self._sample_time >= self._sample_interval:
+        self._sample(now)
+      if self._cpu_bound:
+        return None
+      if self._ratio > self._max_ratio:
+        self._skipped += 1
+        if self._skipped < self._probe_interval:
+          return None
+      self._skipped = 0
+    data = _ENCODERS[self.codec](bytes(buf[offset:offset + num_bytes]), self._level)
+    self._ratio = 0.9 * self._ratio + 0.1 * len(data) / num_bytes
+    if len(data) >= num_bytes:
+      return None
+    self.raw_bytes += num_bytes
+    self.compressed_bytes += len(data)
+    return data
@@ -0,0 +1,127 @@
+import os
+import struct
+import unittest
+import zlib
+import channel
+import compression
+from compression import Compressor, CODEC_ZLIB, CODEC_LZ4
+
+class _Stream(object):
+  """The IOStream interface of NetworkChannel, which runs the reads on the data fed by the test."""
+
+  max_buf_size = 16777216
+
+  def __init__(self):
+    self.socket = True
+    self.written = bytearray()
+    self._buf = bytearray()
+    self._reads = []
+    self._close_callback = None
+
+  def set_close_callback(self, callback):
+    self._close_callback = callback
+
+  def read(self, num_bytes, callback):
+    self._reads.append((num_bytes, callback))
+
+  def write(self, buf, offset, num_bytes, callback=0):
+    self.written += buf[offset:offset + num_bytes]
+
+  def close(self):
+    self.socket = None
+
+  def feed(self, data):
+    self._buf += data
+    while self.socket and self._reads and len(self._buf) >= self._reads[0][0]:
+      num_bytes, callback = self._reads.pop(0)
+      buf = self._buf[:num_bytes]
+      del self._buf[:num_bytes]
+      callback(buf, 0, num_bytes)
+
+class DecodeTest(unittest.TestCase):
+  def test_zlib_round_trip(self):
+    raw = "abc" * 1000
+    data = zlib.compress(raw)
+    self.assertEqual(raw, compression.decode(CODEC_ZLIB, bytearray(data), 0, len(data), len(raw)))
+
+  def test_rejects_zero_raw_length(self):
+    data = zlib.compress("\0" * 1000000)
+    self.assertRaises(ValueError, compression.decode, CODEC_ZLIB, data, 0, len(data), 0)
+
+  def test_rejects_mismatched_raw_length(self):
+    data = zlib.compress("\0" * 1000000)
+    self.assertRaises(ValueError, compression.decode, CODEC_ZLIB, data, 0, len(data), 1000)
+    self.assertRaises(ValueError, compression.decode, CODEC_ZLIB, data, 0, len(data), 2000000)
+
+  def test_rejects_broken_data(self):
+    self.assertRaises(ValueError, compression.decode, CODEC_ZLIB, "not zlib", 0, 8, 100)
+
+  def test_rejects_unsupported_codec(self):
+    self.assertRaises(ValueError, compression.decode, 7, "x", 0, 1, 1)
+
+  @unittest.skipIf(CODEC_LZ4 not in compression._DECODERS, "the lz4 module is missing")
+  def test_lz4_rejects_zero_raw_length(self):
+    data = compression._ENCODERS[CODEC_LZ4]("\0" * 100000, 0)
+    self.assertRaises(ValueError, compression.decode, CODEC_LZ4, data, 0, len(data), 0)
+
+  def test_supported_codecs(self):
+    self.assertTrue(compression.supported_codecs() & (1 << CODEC_ZLIB))
+
+class CompressorTest(unittest.TestCase):
+  def test_small_frames_stay_raw(self):
+    compressor = Compressor(min_size=1024)
+    self.assertEqual(None, compressor.compress("a" * 1000, 0, 1000))
+    self.assertNotEqual(None, compressor.compress("a" * 2000, 0, 2000))
+
+  def test_adaptive_probes_incompressible_payloads(self):
+    compressor = Compressor(min_size=16, probe_interval=4, max_cpu_usage=float("inf"))
+    noise = os.urandom(4096)
+    compressed = [compressor.compress(noise, 0, len(noise)) for _ in xrange(40)]
+    self.assertEqual([None] * 40, compressed)
+    self.assertEqual(0, compressor.raw_bytes)
+    payload = "a" * 4096
+    results = [compressor.compress(payload, 0, len(payload)) for _ in xrange(8)]
+    self.assertTrue(any(result is not None for result in results))  # probed again
+
+class ChannelTest(unittest.TestCase):
+  def _channel(self):
+    stream = _Stream()
+    frames = []
+    net_channel = channel.NetworkChannel(None, lambda buf, offset, num_bytes, deadline:
+                                         frames.append(bytes(buf[offset:offset + num_bytes])), stream=stream)
+    net_channel.read()
+    return net_channel, stream, frames
+
+  def _frame(self, data, raw_length):
+    return struct.pack("<iBI", len(data) | channel.FLAG_COMPRESSED, CODEC_ZLIB, raw_length) + data
+
+  def test_compressed_frame(self):
+    net_channel, stream, frames = self._channel()
+    stream.feed(self._frame(zlib.compress("hello"), 5))
+    self.assertEqual(["hello"], frames)
+    self.assertFalse(net_channel.closed())
+
+  def test_closes_on_zero_raw_length(self):
+    net_channel, stream, frames = self._channel()
+    stream.feed(self._frame(zlib.compress("\0" * 100000), 0))
+    self.assertEqual([], frames)
+    self.assertTrue(net_channel.closed())
+
+  def test_closes_on_raw_length_beyond_the_buffer(self):
+    net_channel, stream, frames = self._channel()
+    stream.feed(self._frame(zlib.compress("\0" * 1000), 0xffffffff))
+    self.assertTrue(net_channel.closed())
+
+  def test_compresses_for_accepting_peer(self):
+    net_channel, stream, frames = self._channel()
+    net_channel.set_compressor(Compressor(min_size=16))
+    stream.feed(struct.pack("<iBB", -2, channel.CONTROL_COMPRESSION, compression.supported_codecs()))
+    payload = bytearray("a" * 1000)
+    net_channel.write(payload, 0, len(payload))
+    header, codec, raw_length = struct.unpack_from("<iBI", stream.written)
+    self.assertTrue(header & channel.FLAG_COMPRESSED)
+    self.assertEqual((CODEC_ZLIB, 1000), (codec, raw_length))
+    self.assertEqual(str(payload), zlib.decompress(bytes(stream.written[9:])))
+
+if __name__ == '__main__':
+  unittest.main()
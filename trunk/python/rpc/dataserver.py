@@ -0,0 +1,223 @@
+import functools
+import json
+import logging
+import sqlite3
+import struct
+import time
+from tornado import ioloop
+from hashring import HashRing
+from socketserver import SocketServer
+from sqlstore import ShardSqlStore, DataStoreError, init_shard_db
+from timerwheel import TimerWheel
+
+"""The data store proxy, which serves Zopt\\Storage\\RpcDataStoreClient.
+
+The workers hold pooled connections to all the shard databases, so that the
+clients talk to one persistent endpoint instead of connecting to every shard
+on each request.  The requests and responses carry json bodies:
+
+Request = | 1 byte op | 4 bytes request_id | json arguments |
+Response = | 1 byte op | 4 bytes request_id | 1 byte status | json result |
+  status: STATUS_OK, or STATUS_ERROR with the error message as the result.
+
+  OP_GET_TABLE_NAMES: {} -> [table, ...]
+  OP_CREATE_TABLE:    {"table"} -> bool
+  OP_DELETE_TABLE:    {"table"} -> bool
+  OP_CREATE_FAMILY:   {"table", "family"} -> bool
+  OP_DELETE_FAMILY:   {"table", "family"} -> bool
+  OP_GET_ROWS:        {"table", "rowKeys", "columns"} -> {rowKey: {column: value}}
+  OP_MUTATE_ROWS:     {"table", "mutations": {rowKey: [[isDelete, column, value], ...]}}
+                      -> {rowKey: {column: value}}
+  OP_DELETE_ROWS:     {"table", "rowKeys"} -> [deleted rowKey, ...]
+  OP_OPEN_SCANNER:    {"table", "startRowKey", "stopRowKey", "columns", "batchSize"} -> scannerId
+  OP_SCAN:            {"scannerId", "count"} -> {"rows": [[rowKey, {column: value}], ...], "done"}
+  OP_CLOSE_SCANNER:   {"scannerId"} -> bool
+
+The scanners are the cursors kept in the workers: the client pulls the rows
+chunk by chunk, which bounds the rows buffered for a scan on both sides, and
+the worker reads ahead the next chunk after sending one.  All the scanner
+requests of a connection go to the same worker, chosen by a consistent hash
+ring over the live workers so that the death of a worker only moves its own
+connections, and tagged by the acceptor with the addr_id of the connection
+after the header, so that a scanner is only found by the connection which
+opened it.  The scanners of a connection are
+closed with it, and a scanner idle for scanner_timeout seconds is closed.
+"""
+
+OP_GET_TABLE_NAMES = 1
+OP_CREATE_TABLE = 2
+OP_DELETE_TABLE = 3
+OP_CREATE_FAMILY = 4
+OP_DELETE_FAMILY = 5
+OP_GET_ROWS = 6
+OP_MUTATE_ROWS = 7
+OP_DELETE_ROWS = 8
+OP_OPEN_SCANNER = 9
+OP_SCAN = 10
+OP_CLOSE_SCANNER = 11
+
+_SCANNER_OPS = (OP_OPEN_SCANNER, OP_SCAN, OP_CLOSE_SCANNER)
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+_HEADER = struct.Struct("<BI")
+_STATUS = struct.Struct("<B")
+
+class DataService(object):
+  """The payload handler of the workers."""
+
+  def __init__(self, shards, meta_ttl=60, scanner_timeout=60):
+    # the connections are opened lazily, i.e. after the workers fork.
+    self._store = ShardSqlStore(shards, meta_ttl)
+    self._scanner_timeout = scanner_timeout
+    self._scanners = {}  # (addr_id, scanner_id) -> [scanner, timer]
+    self._connection_scanners = {}  # addr_id -> set of its scanner_ids
+    self._next_scanner_id = 1
+    self._timer_wheel = None  # created in the worker process, on the worker's io loop
+
+  def _open_scanner(self, addr_id, args):
+    scanner = self._store.open_scanner(args["table"], args.get("startRowKey") or "", args.get("stopRowKey"),
+                                       args.get("columns"), args.get("batchSize") or 256)
+    scanner_id = self._next_scanner_id
+    self._next_scanner_id = (scanner_id + 1) & 0x7fffffff or 1
+    self._scanners[(addr_id, scanner_id)] = [scanner, None]
+    self._connection_scanners.setdefault(addr_id, set()).add(scanner_id)
+    self._touch_scanner((addr_id, scanner_id))
+    return scanner_id
+
+  def _touch_scanner(self, key):
+    """Pushes back the idle timeout of the scanner of the key (addr_id, scanner_id)."""
+    if self._timer_wheel is None:
+      self._timer_wheel = TimerWheel(ioloop.IOLoop.instance())
+    entry = self._scanners[key]
+    if entry[1] is not None:
+      self._timer_wheel.remove_timeout(entry[1])
+    entry[1] = self._timer_wheel.add_timeout(time.time() + self._scanner_timeout,
+                                             functools.partial(self._close_scanner, key))
+
+  def _close_scanner(self, key):
+    entry = self._scanners.pop(key, None)
+    if entry is None:
+      return False
+    self._timer_wheel.remove_timeout(entry[1])
+    addr_id, scanner_id = key
+    scanner_ids = self._connection_scanners[addr_id]
+    scanner_ids.discard(scanner_id)
+    if not scanner_ids:
+      del self._connection_scanners[addr_id]
+    return True
+
+  def close_connection(self, addr_id):
+    """Closes the scanners of the connection, which is gone."""
+    for scanner_id in list(self._connection_scanners.get(addr_id, ())):
+      self._close_scanner((addr_id, scanner_id))
+
+  def _scan(self, addr_id, args):
+    scanner_id = args["scannerId"]
+    key = (addr_id, scanner_id)
+    entry = self._scanners.get(key)
+    if entry is None:
+      raise DataStoreError("Scanner %d is not found." % scanner_id)
+    scanner = entry[0]
+    rows = scanner.next(args.get("count") or 256)
+    if scanner.done:
+      self._close_scanner(key)
+    else:
+      self._touch_scanner(key)
+      # reads ahead after the response is sent, while the client consumes it.
+      ioloop.IOLoop.instance().add_callback(functools.partial(self._prefetch, key))
+    return {"rows": rows, "done": scanner.done}
+
+  def _prefetch(self, key):
+    entry = self._scanners.get(key)
+    if entry is not None:
+      entry[0].prefetch()
+
+  def _call(self, op, addr_id, args):
+    store = self._store
+    if op == OP_GET_TABLE_NAMES:
+      return store.get_table_names()
+    elif op == OP_CREATE_TABLE:
+      return store.create_table(args["table"])
+    elif op == OP_DELETE_TABLE:
+      return store.delete_table(args["table"])
+    elif op == OP_CREATE_FAMILY:
+      return store.create_family(args["table"], args["family"])
+    elif op == OP_DELETE_FAMILY:
+      return store.delete_family(args["table"], args["family"])
+    elif op == OP_GET_ROWS:
+      return store.get_rows(args["table"], args["rowKeys"], args.get("columns"))
+    elif op == OP_MUTATE_ROWS:
+      return store.mutate_rows(args["table"], args["mutations"])
+    elif op == OP_DELETE_ROWS:
+      return store.delete_rows(args["table"], args["rowKeys"])
+    elif op == OP_OPEN_SCANNER:
+      return self._open_scanner(addr_id, args)
+    elif op == OP_SCAN:
+      return self._scan(addr_id, args)
+    elif op == OP_CLOSE_SCANNER:
+      return self._close_scanner((addr_id, args["scannerId"]))
+    raise DataStoreError("Unknown op: %d." % op)
+
+  def handle(self, payload, callback):
+    op, request_id = _HEADER.unpack_from(payload, 0)
+    addr_id, args_offset = None, _HEADER.size
+    if op in _SCANNER_OPS:
+      addr_id, args_offset = bytes(payload[_HEADER.size:_HEADER.size + 6]), _HEADER.size + 6
+    try:
+      args = json.loads(str(payload[args_offset:]) or "{}")
+      status, result = STATUS_OK, self._call(op, addr_id, args)
+    except DataStoreError as e:
+      status, result = STATUS_ERROR, str(e)
+    except Exception as e:
+      logging.exception("Failed to serve op %d", op)
+      status, result = STATUS_ERROR, "%s: %s" % (e.__class__.__name__, e)
+    callback(_HEADER.pack(op, request_id) + _STATUS.pack(status) + json.dumps(result))
+
+class DataServer(SocketServer):
+  """The data store proxy."""
+
+  def __init__(self, port, shards, meta_ttl=60, scanner_timeout=60, **kwargs):
+    """Initiate the data server.
+
+    Args:
+      port: The port to listen.
+      shards: The connect functions of the shard databases by the shard ids, see ShardSqlStore.
+      meta_ttl: Seconds the meta data is cached in each worker.
+      scanner_timeout: Seconds an idle scanner is kept open.
+      kwargs: The other arguments of SocketServer.
+    """
+    service = DataService(shards, meta_ttl, scanner_timeout)
+    SocketServer.__init__(self, port, service.handle, **kwargs)
+    for worker_process in self._worker_processes.itervalues():
+      worker_process.close_handler = service.close_connection
+    self._scanner_workers = HashRing(self._ipc_channels)  # addr_id -> worker_id of the live workers
+
+  def _inbound_callback(self, addr_id, buf, offset, num_bytes, deadline):
+    if _HEADER.unpack_from(buf, offset)[0] not in _SCANNER_OPS:
+      SocketServer._inbound_callback(self, addr_id, buf, offset, num_bytes, deadline)
+      return
+    if deadline is not None and deadline < time.time():
+      return  # drops the request as the client no longer waits for it.
+    # the scanners live in the worker which opened them, under the addr_id of the connection.
+    worker_id = self._scanner_workers.get(addr_id)
+    payload = buf[offset:offset + _HEADER.size] + addr_id + buf[offset + _HEADER.size:offset + num_bytes]
+    self._send_to_worker(worker_id, addr_id, payload, 0, len(payload), deadline)
+
+  def destory_worker(self, worker_id):
+    SocketServer.destory_worker(self, worker_id)
+    self._scanner_workers.remove(worker_id)  # its scanners are gone, the others stay in place
+
+def main():
+  # only for test, with the local sqlite shards.
+  shards = {}
+  for shard_id in (0, 0x40000000, 0x80000000, 0xc0000000):
+    connect = functools.partial(sqlite3.connect, "/tmp/datastore_%08x.db" % shard_id, timeout = 5)
+    init_shard_db(connect())
+    shards[shard_id] = connect
+  server = DataServer(20004, shards, idle_timeout = 60)
+  server.start()
+
+if __name__ == '__main__':
+  main()
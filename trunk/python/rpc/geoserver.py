@@ -0,0 +1,296 @@
+import math
+import struct
+import numpy as np
+from socketserver import SocketServer
+from column import Column
+
+"""The geo server, which finds the nearby points without scanning all of them.
+
+It's the vectorized counterpart of Zopt\\Geo\\Globe in php/geo/globe.php.  The
+points are kept in columnar NumPy arrays, and bucketed by the lat / long grid
+cell they are in.  A radius query only computes the haversine distances of the
+points in the cells overlapping the circle, in one vectorized pass, and a
+k-nearest query widens the radius until it holds k points.
+
+Request = | 1 byte op | 4 bytes request_id | op fields | 4 bytes item_num | items |
+Response = | 1 byte op | 4 bytes request_id | 4 bytes item_num | items |
+
+Requests:
+  OP_PUT:    no op fields
+             item = | 2 bytes id_len | id | 8 bytes double latitude | 8 bytes double longitude |
+  OP_REMOVE: no op fields
+             item = | 2 bytes id_len | id |
+  OP_RADIUS: op fields = | 8 bytes double latitude | 8 bytes double longitude |
+                         8 bytes double radius in meters | 4 bytes limit, 0 for no limit |
+             no items
+  OP_NEAREST:
+             op fields = | 8 bytes double latitude | 8 bytes double longitude | 4 bytes k |
+             no items
+  OP_DIST:   op fields = | 8 bytes double latitude | 8 bytes double longitude |
+             item = | 2 bytes id_len | id |
+
+Responses:
+  OP_PUT, OP_REMOVE: no items.
+  OP_RADIUS, OP_NEAREST, OP_DIST:
+             item = | 2 bytes id_len | id | 8 bytes double distance in meters |
+             by ascending distance, except OP_DIST in the request order;
+             unknown ids are omitted.
+"""
+
+RADIUS = 6371004  # meters, the same as Zopt\Geo\Globe::RADIUS
+
+OP_PUT = 1
+OP_REMOVE = 2
+OP_RADIUS = 3
+OP_NEAREST = 4
+OP_DIST = 5
+
+_HEADER = struct.Struct("<BI")
+_UINT16 = struct.Struct("<H")
+_UINT32 = struct.Struct("<I")
+_DOUBLE = struct.Struct("<d")
+_LOCATION = struct.Struct("<dd")
+_RADIUS_FIELDS = struct.Struct("<dddI")
+_NEAREST_FIELDS = struct.Struct("<ddI")
+
+def haversine(lat, lon, lats, lons):
+  """Returns the distance arcs from one point to an array of points, all in radians.
+
+  The same as Zopt\\Geo\\Globe::distArc with useHaversine, vectorized over lats / lons.
+  """
+  sin_half_lat_delta = np.sin((lats - lat) * 0.5)
+  sin_half_lon_delta = np.sin((lons - lon) * 0.5)
+  h = sin_half_lat_delta * sin_half_lat_delta + math.cos(lat) * np.cos(lats) * sin_half_lon_delta * sin_half_lon_delta
+  return 2 * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+class GeoIndex(object):
+  """The points bucketed by lat / long grid cells, for the radius and k-nearest queries."""
+
+  def __init__(self, cell_degrees=0.5):
+    """Initiate the index.
+
+    Args:
+      cell_degrees: The size of the grid cells in degrees, the default is about 55 km.
+    """
+    self._cell_degrees = cell_degrees
+    self._lat_cell_num = int(math.ceil(180.0 / cell_degrees))
+    self._lon_cell_num = int(math.ceil(360.0 / cell_degrees))
+    # the points in radians; the slots of the removed points are reused.
+    self._lats = Column(np.float64)
+    self._lons = Column(np.float64)
+    self._live = Column(np.bool_)
+    self._slot_cells = Column(np.int64)
+    self._ids = []  # slot -> id
+    self._slots = {}  # id -> slot
+    self._free_slots = []
+    self._buckets = {}  # cell -> list of slots
+
+  def __len__(self):
+    return len(self._slots)
+
+  def _cells(self, lats, lons):
+    """Returns the cells of the points given in degrees, vectorized."""
+    lat_indexes = np.clip(np.floor((np.asarray(lats) + 90.0) / self._cell_degrees), 0, self._lat_cell_num - 1)
+    lon_indexes = np.floor((np.asarray(lons) + 180.0) / self._cell_degrees) % self._lon_cell_num
+    return (lat_indexes * self._lon_cell_num + lon_indexes).astype(np.int64)
+
+  def _unbucket(self, slot):
+    cell = int(self._slot_cells.values[slot])
+    bucket = self._buckets[cell]
+    bucket.remove(slot)
+    if not bucket:
+      del self._buckets[cell]
+
+  def put(self, point_id, lat, lon):
+    """Inserts or moves a point, given in degrees."""
+    slot = self._slots.get(point_id)
+    if slot is not None:
+      self._unbucket(slot)
+    elif self._free_slots:
+      slot = self._slots[point_id] = self._free_slots.pop()
+      self._ids[slot] = point_id
+    else:
+      slot = self._slots[point_id] = len(self._ids)
+      self._ids.append(point_id)
+      self._lats.resize(slot + 1)
+      self._lons.resize(slot + 1)
+      self._live.resize(slot + 1)
+      self._slot_cells.resize(slot + 1)
+    cell = int(self._cells(lat, lon))
+    self._lats.values[slot] = math.radians(lat)
+    self._lons.values[slot] = math.radians(lon)
+    self._live.values[slot] = True
+    self._slot_cells.values[slot] = cell
+    self._buckets.setdefault(cell, []).append(slot)
+
+  def load(self, point_ids, lats, lons):
+    """Inserts points in bulk, given in degrees as arrays, vectorized for the new ones."""
+    lats = np.asarray(lats, np.float64)
+    lons = np.asarray(lons, np.float64)
+    new = np.fromiter((point_id not in self._slots for point_id in point_ids), np.bool_, len(point_ids))
+    for i in np.flatnonzero(~new):
+      self.put(point_ids[i], lats[i], lons[i])
+    new_indexes = np.flatnonzero(new)
+    start = len(self._ids)
+    for slot, i in enumerate(new_indexes, start):
+      self._ids.append(point_ids[i])
+      self._slots[point_ids[i]] = slot
+    self._lats.extend(np.radians(lats[new_indexes]))
+    self._lons.extend(np.radians(lons[new_indexes]))
+    self._live.extend(np.ones(len(new_indexes), np.bool_))
+    # groups the new slots by cell, to extend each bucket once.
+    cells = self._cells(lats[new_indexes], lons[new_indexes])
+    self._slot_cells.extend(cells)
+    order = np.argsort(cells, kind="mergesort")
+    unique_cells, starts = np.unique(cells[order], return_index=True)
+    slots = order + start
+    for cell, cell_slots in zip(unique_cells, np.split(slots, starts[1:])):
+      self._buckets.setdefault(int(cell), []).extend(cell_slots.tolist())
+
+  def remove(self, point_id):
+    """Removes the point, returns False if it's not found."""
+    slot = self._slots.pop(point_id, None)
+    if slot is None:
+      return False
+    self._unbucket(slot)
+    self._live.values[slot] = False
+    self._ids[slot] = None
+    self._free_slots.append(slot)
+    return True
+
+  def _candidate_slots(self, lat, lon, arc):
+    """Returns the slots of the points in the cells overlapping the circle, lat / lon in degrees."""
+    arc_degrees = math.degrees(arc)
+    lat_min = lat - arc_degrees
+    lat_max = lat + arc_degrees
+    cell_num = self._lat_cell_num * self._lon_cell_num
+    if lat_min > -90.0 and lat_max < 90.0:
+      # the widest longitude delta of the circle, which doesn't cover a pole.
+      lon_degrees = math.degrees(math.asin(min(math.sin(arc) / math.cos(math.radians(lat)), 1.0)))
+      lat_cells = self._cells([lat_min, lat_max], [0.0, 0.0]) // self._lon_cell_num
+      lon_cell_span = int(math.ceil(2 * lon_degrees / self._cell_degrees)) + 1
+      if lon_cell_span < self._lon_cell_num:
+        cell_num = (lat_cells[1] - lat_cells[0] + 1) * lon_cell_span
+    if cell_num >= len(self._buckets):
+      return np.flatnonzero(self._live.values)
+    first_lon_cell = int(self._cells(lat, lon - lon_degrees)) % self._lon_cell_num
+    buckets = self._buckets
+    slots = []
+    for lat_cell in xrange(lat_cells[0], lat_cells[1] + 1):
+      base = lat_cell * self._lon_cell_num
+      for lon_cell in xrange(first_lon_cell, first_lon_cell + lon_cell_span):
+        bucket = buckets.get(base + lon_cell % self._lon_cell_num)
+        if bucket:
+          slots.extend(bucket)
+    return np.array(slots, np.int64)
+
+  def radius(self, lat, lon, radius, limit=0):
+    """Returns the [(id, distance in meters)] of the points within radius meters, nearest first.
+
+    Args:
+      lat: Latitude of the center in degrees.
+      lon: Longitude of the center in degrees.
+      radius: The radius in meters.
+      limit: Maximum number of the points to return, 0 for no limit.
+    """
+    arc = radius / float(RADIUS)
+    slots = self._candidate_slots(lat, lon, min(arc, math.pi))
+    arcs = haversine(math.radians(lat), math.radians(lon), self._lats.values[slots], self._lons.values[slots])
+    within = arcs <= arc
+    slots = slots[within]
+    arcs = arcs[within]
+    if limit and limit < len(arcs):
+      nearest = np.argpartition(arcs, limit - 1)[:limit]
+      slots = slots[nearest]
+      arcs = arcs[nearest]
+    order = np.argsort(arcs, kind="mergesort")
+    return [(self._ids[slot], RADIUS * distance) for slot, distance in zip(slots[order], arcs[order])]
+
+  def nearest(self, lat, lon, k):
+    """Returns the [(id, distance in meters)] of the k nearest points, nearest first.
+
+    The radius starts from one cell and doubles until the circle holds k points,
+    which are then the k nearest ones.
+    """
+    if not k:
+      return []
+    arc = math.radians(self._cell_degrees)
+    while True:
+      results = self.radius(lat, lon, arc * RADIUS, k)
+      if len(results) >= k or arc >= math.pi:
+        return results
+      arc *= 2
+
+  def dists(self, lat, lon, point_ids):
+    """Returns the [(id, distance in meters)] from the location to the points, unknown ids omitted."""
+    known = [point_id for point_id in point_ids if point_id in self._slots]
+    slots = np.fromiter((self._slots[point_id] for point_id in known), np.int64, len(known))
+    arcs = haversine(math.radians(lat), math.radians(lon), self._lats.values[slots], self._lons.values[slots])
+    return zip(known, (RADIUS * arcs).tolist())
+
+def _iter_ids(buf, pos, item_size=0):
+  """Iterates the items of a request, yields (id, pos of the data following the id) tuples."""
+  item_num = _UINT32.unpack_from(buf, pos)[0]
+  pos += 4
+  for _ in xrange(item_num):
+    id_len = _UINT16.unpack_from(buf, pos)[0]
+    yield bytes(buf[pos + 2:pos + 2 + id_len]), pos + 2 + id_len
+    pos += 2 + id_len + item_size
+
+class GeoService(object):
+  """The payload handler of the geo server."""
+
+  def __init__(self, cell_degrees=0.5):
+    self._index = GeoIndex(cell_degrees)
+
+  def handle(self, payload, callback):
+    op, request_id = _HEADER.unpack_from(payload, 0)
+    pos = _HEADER.size
+    index = self._index
+    results = []
+    if op == OP_PUT:
+      point_ids = []
+      locations = []
+      for point_id, location_pos in _iter_ids(payload, pos, _LOCATION.size):
+        point_ids.append(point_id)
+        locations.append(_LOCATION.unpack_from(payload, location_pos))
+      if locations:
+        lats, lons = zip(*locations)
+        index.load(point_ids, lats, lons)
+    elif op == OP_REMOVE:
+      for point_id, _ in _iter_ids(payload, pos):
+        index.remove(point_id)
+    elif op == OP_RADIUS:
+      lat, lon, radius, limit = _RADIUS_FIELDS.unpack_from(payload, pos)
+      results = index.radius(lat, lon, radius, limit)
+    elif op == OP_NEAREST:
+      lat, lon, k = _NEAREST_FIELDS.unpack_from(payload, pos)
+      results = index.nearest(lat, lon, k)
+    elif op == OP_DIST:
+      lat, lon = _LOCATION.unpack_from(payload, pos)
+      results = index.dists(lat, lon, [point_id for point_id, _ in _iter_ids(payload, pos + _LOCATION.size)])
+    items = [_UINT16.pack(len(point_id)) + point_id + _DOUBLE.pack(distance) for point_id, distance in results]
+    callback(_HEADER.pack(op, request_id) + _UINT32.pack(len(items)) + "".join(items))
+
+class GeoServer(SocketServer):
+  """The geo server, whose points are all kept in one worker process."""
+
+  def __init__(self, port, cell_degrees=0.5, **kwargs):
+    """Initiate the geo server.
+
+    Args:
+      port: The port to listen.
+      cell_degrees: The size of the grid cells of the index in degrees.
+      kwargs: The other arguments of SocketServer, except worker_num.
+    """
+    # a query covers the points of any cell, which therefore live in a single worker.
+    kwargs["worker_num"] = 1
+    SocketServer.__init__(self, port, GeoService(cell_degrees).handle, **kwargs)
+
+def main():
+  # only for test
+  server = GeoServer(20003, idle_timeout = 60)
+  server.start()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,43 @@
+"""The consistent hash ring routing the keys over the workers of a server.
+
+Each node owns many points on a ring of the 32-bit crc32 hashes, and a key
+goes to the node of the first point at or after its hash.  When a node is
+removed, e.g. a worker died, only its own keys move to the other nodes,
+spread over all of them, and the keys of the live nodes stay where they are.
+"""
+
+import bisect
+import zlib
+
+class HashRing(object):
+  def __init__(self, nodes, replicas=64):
+    """Initiate the ring.
+
+    Args:
+      nodes: The ids of the nodes, e.g. the worker ids, which are str()'ed for hashing.
+      replicas: Number of the points of each node, more points spread the keys more evenly.
+    """
+    self._points = []  # sorted (hash, node)
+    self._hashes = []  # the hashes of _points, for bisect
+    for node in nodes:
+      self._points.extend((self._hash("%s#%d" % (node, i)), node) for i in xrange(replicas))
+    self._rebuild()
+
+  def _hash(self, key):
+    return zlib.crc32(key) & 0xffffffff
+
+  def _rebuild(self):
+    self._points.sort()
+    self._hashes = [point[0] for point in self._points]
+
+  def remove(self, node):
+    """Removes the node, whose keys move to the others."""
+    self._points = [point for point in self._points if point[1] != node]
+    self._rebuild()
+
+  def get(self, key):
+    """Returns the node of the key, None if the ring is empty."""
+    if not self._points:
+      return None
+    index = bisect.bisect_left(self._hashes, self._hash(key))
+    return self._points[index if index < len(self._points) else 0][1]
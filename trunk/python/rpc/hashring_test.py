@@ -0,0 +1,31 @@
+import unittest
+from hashring import HashRing
+
+class HashRingTest(unittest.TestCase):
+  def test_spreads_the_keys(self):
+    ring = HashRing(xrange(4))
+    counts = {}
+    for i in xrange(4000):
+      node = ring.get("key%d" % i)
+      counts[node] = counts.get(node, 0) + 1
+    self.assertEqual([0, 1, 2, 3], sorted(counts))
+    self.assertTrue(min(counts.values()) > 500, counts)
+
+  def test_removal_only_moves_the_keys_of_the_node(self):
+    ring = HashRing(xrange(4))
+    keys = ["key%d" % i for i in xrange(1000)]
+    before = dict((key, ring.get(key)) for key in keys)
+    ring.remove(2)
+    for key in keys:
+      if before[key] != 2:
+        self.assertEqual(before[key], ring.get(key))
+      else:
+        self.assertNotEqual(2, ring.get(key))
+
+  def test_empty_ring(self):
+    ring = HashRing([0])
+    ring.remove(0)
+    self.assertEqual(None, ring.get("key"))
+
+if __name__ == '__main__':
+  unittest.main()
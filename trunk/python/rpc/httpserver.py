@@ -0,0 +1,393 @@
+import functools
+import httplib
+import logging
+import struct
+import iostream
+from channel import CONTROL_OVERLOADED
+from socketserver import SocketServer
+
+"""The HTTP/1.1 front end of SocketServer.
+
+HttpChannel speaks HTTP/1.1 on the client connections in place of
+NetworkChannel: it parses the request lines and headers in place from the
+IOStream read buffer, reads the Content-Length and chunked bodies, and keeps
+the connections alive.  The requests could be pipelined, and their responses
+are written in the request order.  The responses of the static targets are
+encoded once and written from the cache, without a round trip to the workers;
+the others are handed to the workers with their bodies, as
+
+Request = | 4 bytes seq | 2 bytes request line length | method SP target | body |
+Response = | 4 bytes seq | 2 bytes status | 1 byte content type length | content type | body |
+
+where seq numbers the requests of a connection.  The workers serve them
+through HttpService, so that a handler only sees the method, target and body.
+A request shed by the acceptor, see SocketServer, is answered with 503.
+"""
+
+_REQUEST_HEADER = struct.Struct("<IH")
+_RESPONSE_HEADER = struct.Struct("<IHB")
+
+_PARSED_HEADERS = frozenset(("connection", "content-length", "transfer-encoding", "expect"))
+_MAX_CHUNK_SIZE_LINE = 1024
+_CONTINUE = bytearray("HTTP/1.1 100 Continue\r\n\r\n")
+
+def encode_header(status, content_type, content_length, keep_alive, keep_alive_timeout=None):
+  """Encodes the status line and the headers of a response."""
+  lines = ["HTTP/1.1 %d %s" % (status, httplib.responses.get(status, "Unknown")),
+           "Content-Type: %s" % content_type,
+           "Content-Length: %d" % content_length]
+  if not keep_alive:
+    lines.append("Connection: close")
+  elif keep_alive_timeout:
+    lines.append("Keep-Alive: timeout=%d" % keep_alive_timeout)
+  return bytearray("\r\n".join(lines) + "\r\n\r\n")
+
+def encode_static_response(content_type, body, keep_alive_timeout=None):
+  """Encodes the responses of a static target, by (keep_alive, is_head)."""
+  responses = {}
+  for keep_alive in (True, False):
+    header = encode_header(200, content_type, len(body), keep_alive, keep_alive_timeout)
+    responses[(keep_alive, False)] = header + body
+    responses[(keep_alive, True)] = header
+  return responses
+
+class HttpChannel(object):
+  """This class handles the HTTP/1.1 connections, with the same interface as NetworkChannel."""
+
+  def __init__(self, sock, data_callback, control_callback=None, close_callback=None, io_loop=None, name=None,
+               static_responses=None, max_header_size=8192, max_body_size=1048576, max_pipeline_num=32,
+               keep_alive_timeout=None):
+    """Initiate the http channel.
+
+    Args:
+      sock: The socket of the client connection.
+      data_callback: The handler for the requests to the workers.
+          Function fingerprint: callback(buf, offset, num_bytes, deadline)
+      control_callback: Unused, HTTP has no control message.
+      close_callback: The callback method triggered when this channel closed.
+          Function fingerprint: callback()
+      io_loop: The IO loop, on which the read/write operations depends; default using global IOLoop instance.
+      name: The name of this object, could be used in debug info output.
+      static_responses: The encoded responses of the static targets, see encode_static_response.
+      max_header_size: Maximum size of the request line and headers, the connection is closed beyond it.
+      max_body_size: Maximum size of a request body, answered with 413 beyond it.
+      max_pipeline_num: Maximum number of the requests waiting for their responses, the connection
+          stops reading until some are responded.
+      keep_alive_timeout: Seconds advertised in the Keep-Alive header, usually the idle timeout.
+    """
+    self._stream = iostream.IOStream(sock, io_loop, name or "HttpChannel")
+    self._stream.set_close_callback(close_callback)
+    self._data_callback = data_callback
+    self._static_responses = static_responses or {}
+    self._max_header_size = max_header_size
+    self._max_body_size = max_body_size
+    self._max_pipeline_num = max_pipeline_num
+    self._keep_alive_timeout = keep_alive_timeout
+    self._next_seq = 0  # seq of the next request
+    self._send_seq = 0  # seq of the next response to write
+    self._dispatched = {}  # seq -> (keep_alive, is_head) of the requests waiting for the workers
+    self._ready = {}  # seq -> response pieces waiting for the earlier responses
+    self._reading = False  # a request is being read
+    self._closing = False  # no more request is read, closes after the last response
+    self._pending_read = None  # the next stream read, see _read
+    self._in_read = False
+    # the request being read
+    self._seq = None
+    self._method = None
+    self._target = None
+    self._keep_alive = False
+    self._body = None
+
+  def close(self):
+    """Close the channel."""
+    self._stream.close()
+
+  def closed(self):
+    """Returns True if the channel has been closed."""
+    return not self._stream.socket
+
+  def set_timeouts(self, timer_wheel, idle_timeout=None, read_timeout=None, write_timeout=None):
+    """Closes the channel when it hangs longer than the given timeouts, see IOStream.set_timeouts."""
+    self._stream.set_timeouts(timer_wheel, idle_timeout, read_timeout, write_timeout)
+
+  def read(self):
+    """Start reading the next request, unless too many are waiting for their responses."""
+    if self._reading or self._closing or self.closed():
+      return
+    if self._next_seq - self._send_seq >= self._max_pipeline_num:
+      return  # resumed by _respond
+    self._reading = True
+    self._read(self._handle_head, delimiter="\r\n\r\n", max_bytes=self._max_header_size)
+
+  def _read(self, callback, num_bytes=None, delimiter=None, max_bytes=None):
+    """Reads from the stream.
+
+    The stream calls back at once if the data is already buffered, e.g. for the
+    pipelined requests, so the reads issued from the callbacks are queued and
+    issued by the outermost call, instead of recursing once per request or chunk.
+    """
+    self._pending_read = (callback, num_bytes, delimiter, max_bytes)
+    if self._in_read:
+      return
+    self._in_read = True
+    try:
+      while self._pending_read and not self.closed():
+        callback, num_bytes, delimiter, max_bytes = self._pending_read
+        self._pending_read = None
+        if delimiter is None:
+          self._stream.read(num_bytes, callback)
+        else:
+          self._stream.read_until(delimiter, callback, max_bytes)
+    finally:
+      self._in_read = False
+
+  def _handle_head(self, buf, offset, num_bytes):
+    """Parses the request line and headers in place, and starts reading the body."""
+    end = offset + num_bytes - 2  # every line in [offset, end) ends with CRLF
+    while offset < end and buf[offset] == 13 and buf[offset + 1] == 10:
+      offset += 2  # the empty lines before a request are ignored
+    if offset >= end:
+      self._reading = False
+      self.read()
+      return
+    self._seq = self._next_seq
+    self._next_seq += 1
+    self._keep_alive = False  # until the request is known to be valid
+    self._method = None
+
+    line_end = buf.find("\r\n", offset, end)
+    parts = bytes(buf[offset:line_end]).split(" ")
+    if len(parts) != 3 or not parts[2].startswith("HTTP/1."):
+      self._fail(400)
+      return
+    self._method, self._target, version = parts
+    headers = {}
+    pos = line_end + 2
+    while pos < end:
+      eol = buf.find("\r\n", pos, end)
+      colon = buf.find(":", pos, eol)
+      if colon < 0:
+        self._fail(400)
+        return
+      name = bytes(buf[pos:colon]).strip().lower()
+      if name in _PARSED_HEADERS:
+        headers[name] = bytes(buf[colon + 1:eol]).strip().lower()
+      pos = eol + 2
+
+    connection = headers.get("connection", "")
+    if version == "HTTP/1.0":
+      self._keep_alive = "keep-alive" in connection
+    else:
+      self._keep_alive = "close" not in connection
+
+    if "transfer-encoding" in headers:
+      if headers["transfer-encoding"].split(",")[-1].strip() != "chunked":
+        self._fail(501)
+        return
+      self._body = bytearray()
+      self._continue(headers)
+      self._read(self._handle_chunk_size, delimiter="\r\n", max_bytes=_MAX_CHUNK_SIZE_LINE)
+      return
+    content_length = headers.get("content-length")
+    if content_length:
+      if not content_length.isdigit():
+        self._fail(400)
+        return
+      content_length = int(content_length)
+      if content_length > self._max_body_size:
+        self._fail(413)
+        return
+      if content_length:
+        self._continue(headers)
+        self._read(self._handle_body, num_bytes=content_length)
+        return
+    self._dispatch(buf, offset, 0)
+
+  def _continue(self, headers):
+    """Answers "Expect: 100-continue", if no earlier response is still pending."""
+    if headers.get("expect") == "100-continue" and self._send_seq == self._seq:
+      self._stream.write(_CONTINUE, 0, len(_CONTINUE))
+
+  def _handle_body(self, buf, offset, num_bytes):
+    self._dispatch(buf, offset, num_bytes)
+
+  def _handle_chunk_size(self, buf, offset, num_bytes):
+    try:
+      size = int(bytes(buf[offset:offset + num_bytes - 2]).split(";", 1)[0], 16)
+    except ValueError:
+      size = -1
+    if size < 0:
+      self._fail(400)
+    elif not size:
+      self._read(self._handle_trailer, delimiter="\r\n", max_bytes=self._max_header_size)
+    elif len(self._body) + size > self._max_body_size:
+      self._fail(413)
+    else:
+      self._read(self._handle_chunk, num_bytes=size + 2)
+
+  def _handle_chunk(self, buf, offset, num_bytes):
+    if buf[offset + num_bytes - 2] != 13 or buf[offset + num_bytes - 1] != 10:
+      self._fail(400)
+      return
+    self._body += buf[offset:offset + num_bytes - 2]
+    self._read(self._handle_chunk_size, delimiter="\r\n", max_bytes=_MAX_CHUNK_SIZE_LINE)
+
+  def _handle_trailer(self, buf, offset, num_bytes):
+    if num_bytes > 2:
+      self._read(self._handle_trailer, delimiter="\r\n", max_bytes=self._max_header_size)  # trailers are ignored
+      return
+    body = self._body
+    self._body = None
+    self._dispatch(body, 0, len(body))
+
+  def _dispatch(self, buf, offset, num_bytes):
+    """Answers the request from the static responses, or hands it to the workers."""
+    self._reading = False
+    if not self._keep_alive:
+      self._closing = True
+    is_head = self._method == "HEAD"
+    static_response = self._static_responses.get(self._target) if is_head or self._method == "GET" else None
+    if static_response is not None:
+      response = static_response[(self._keep_alive, is_head)]
+      self._respond(self._seq, [(response, 0, len(response))])
+    else:
+      request_line = "%s %s" % (self._method, self._target)
+      start = _REQUEST_HEADER.size + len(request_line)
+      payload = bytearray(start + num_bytes)
+      _REQUEST_HEADER.pack_into(payload, 0, self._seq, len(request_line))
+      payload[_REQUEST_HEADER.size:start] = request_line
+      payload[start:] = buf[offset:offset + num_bytes]
+      self._dispatched[self._seq] = (self._keep_alive, is_head)
+      self._data_callback(payload, 0, len(payload), None)
+    self.read()
+
+  def _fail(self, status):
+    """Answers the request being read with an error, and closes the connection after it."""
+    self._reading = False
+    self._closing = True
+    self._body = None
+    reason = httplib.responses.get(status, "Unknown")
+    response = encode_header(status, "text/plain", len(reason), False) + reason
+    self._respond(self._seq, [(response, 0, len(response))])
+
+  def write(self, buf, offset, num_bytes, is_data=True, callback=0, deadline=None):
+    """Write the response of a worker, or answer the control message of the acceptor, to the channel."""
+    if not is_data:
+      if buf[offset] == CONTROL_OVERLOADED:
+        # the message carries the head of the shed request, which starts with its seq.
+        self._shed(_REQUEST_HEADER.unpack_from(buf, offset + 1)[0])
+      return
+    seq, status, content_type_length = _RESPONSE_HEADER.unpack_from(buf, offset)
+    if seq not in self._dispatched:
+      logging.warning("HttpChannel: Unknown response %d", seq)
+      return
+    keep_alive, is_head = self._dispatched.pop(seq)
+    start = offset + _RESPONSE_HEADER.size
+    content_type = bytes(buf[start:start + content_type_length])
+    start += content_type_length
+    body_length = offset + num_bytes - start
+    header = encode_header(status, content_type, body_length, keep_alive, self._keep_alive_timeout)
+    pieces = [(header, 0, len(header))]
+    if not is_head:
+      pieces.append((buf, start, body_length))
+    self._respond(seq, pieces)
+
+  def _shed(self, seq):
+    """Answers the request shed by the acceptor with 503."""
+    if seq not in self._dispatched:
+      return
+    keep_alive, is_head = self._dispatched.pop(seq)
+    reason = httplib.responses[503]
+    header = encode_header(503, "text/plain", len(reason), keep_alive, self._keep_alive_timeout)
+    pieces = [(header, 0, len(header))]
+    if not is_head:
+      pieces.append((reason, 0, len(reason)))
+    self._respond(seq, pieces)
+
+  def _respond(self, seq, pieces):
+    """Writes the response, after all the earlier ones.
+
+    Args:
+      seq: The seq of the request.
+      pieces: The (buf, offset, num_bytes) of the response, which are copied if they have to wait.
+    """
+    if self.closed():
+      return
+    if seq != self._send_seq:
+      self._ready[seq] = [(bytes(buf[offset:offset + num_bytes]), 0, num_bytes) for buf, offset, num_bytes in pieces]
+      return
+    while True:
+      self._send_seq += 1
+      last = self._closing and not self._reading and self._send_seq == self._next_seq
+      for i, (buf, offset, num_bytes) in enumerate(pieces):
+        self._stream.write(buf, offset, num_bytes, self.close if last and i == len(pieces) - 1 else 0)
+      pieces = self._ready.pop(self._send_seq, None)
+      if pieces is None:
+        break
+    self.read()  # resumes the reading paused by max_pipeline_num
+
+class HttpService(object):
+  """The payload handler of the workers, which decodes the requests of HttpChannel."""
+
+  def __init__(self, handler, content_type="text/plain; charset=utf-8"):
+    """Initiate the service.
+
+    Args:
+      handler: The function serving a request, which calls back with the response body once.
+          Function fingerprint: handler(method, target, body, callback),
+          and callback(body, status=200, content_type=None) with the default content type.
+      content_type: The default content type of the responses.
+    """
+    self._handler = handler
+    self._content_type = content_type
+
+  def handle(self, payload, callback):
+    seq, request_line_length = _REQUEST_HEADER.unpack_from(payload, 0)
+    start = _REQUEST_HEADER.size
+    method, target = bytes(payload[start:start + request_line_length]).split(" ", 1)
+
+    def respond(body, status=200, content_type=None):
+      content_type = content_type or self._content_type
+      callback(_RESPONSE_HEADER.pack(seq, status, len(content_type)) + content_type + body)
+
+    try:
+      self._handler(method, target, payload[start + request_line_length:], respond)
+    except Exception:
+      logging.exception("Failed to serve %s %s", method, target)
+      respond("", 500)
+
+class HttpServer(SocketServer):
+  """The HTTP/1.1 server, whose requests are served by the workers or the static responses."""
+
+  def __init__(self, port, handler, static_responses=None, max_header_size=8192, max_body_size=1048576,
+               max_pipeline_num=32, **kwargs):
+    """Initiate the http server.
+
+    Args:
+      port: The port to listen.
+      handler: The function serving the requests in the workers, see HttpService.
+      static_responses: The (content_type, body) of the static targets, e.g. {"/": ("text/html", "...")}.
+      max_header_size: Maximum size of the request line and headers.
+      max_body_size: Maximum size of a request body, less than channel.LENGTH_MASK.
+      max_pipeline_num: Maximum number of the pipelined requests waiting for their responses per connection.
+      kwargs: The other arguments of SocketServer.  With priority_weights, all the
+          http requests are of PRIORITY_NORMAL; the shed requests are answered with 503.
+    """
+    SocketServer.__init__(self, port, HttpService(handler).handle, **kwargs)
+    keep_alive_timeout = kwargs.get("idle_timeout")
+    static_responses = dict((target, encode_static_response(content_type, body, keep_alive_timeout))
+                            for target, (content_type, body) in (static_responses or {}).iteritems())
+    self._net_channel_class = functools.partial(HttpChannel, static_responses=static_responses,
+                                                max_header_size=max_header_size, max_body_size=max_body_size,
+                                                max_pipeline_num=max_pipeline_num,
+                                                keep_alive_timeout=keep_alive_timeout)
+
+def main():
+  # only for test, see test.sh
+  def echo_handler(method, target, body, callback):
+    callback(body)
+  server = HttpServer(20000, echo_handler, {"/": ("text/plain", "Hello world!\r\n")}, idle_timeout = 5)
+  server.start()
+
+if __name__ == '__main__':
+  main()
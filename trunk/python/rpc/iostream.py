@@ -20,12 +20,33 @@
 
 import errno
 import logging
+import select
 import socket
+import time
 from collections import deque
 from tornado import ioloop
 
+EPOLLET = 1 << 31  # select.EPOLLET, which is missing on some platforms' select module
+TCP_NODELAY = getattr(socket, "TCP_NODELAY", None)
+TCP_CORK = getattr(socket, "TCP_CORK", None)  # Linux only
+
+def supports_edge_triggered(io_loop):
+  """Returns True if the io loop polls with epoll, which is the only one supporting edge-triggered mode."""
+  return hasattr(select, "epoll") and isinstance(getattr(io_loop, "_impl", None), select.epoll)
+
+class _Delimiter(object):
+  """A pending read_until, which remembers how far the read buffer has been scanned."""
+
+  __slots__ = ("delimiter", "max_bytes", "scanned")
+
+  def __init__(self, delimiter, max_bytes):
+    self.delimiter = delimiter
+    self.max_bytes = max_bytes
+    self.scanned = 0  # bytes after the read start that contain no delimiter
+
 class IOStream(object):
-  def __init__(self, socket, io_loop=None, name=None, min_buf_size=131072, max_buf_size=16777216, io_chunk_size=32768):
+  def __init__(self, socket, io_loop=None, name=None, min_buf_size=131072, max_buf_size=16777216, io_chunk_size=32768,
+               edge_triggered=False):
     """Initiate the iostream object.
 
     Args:
@@ -35,6 +56,12 @@ class IOStream(object):
       min_buf_size: Minimum size of the read/write buffer, default set to be 128K bytes.
       max_buf_size: Maximum size of the read/write buffer, default set to be 16M bytes.
       io_chunk_size: Chunk size for each socket read, default set to be 32K bytes.
+      edge_triggered: Registers the socket once for both read and write events in
+          edge-triggered mode, instead of updating the monitored events whenever
+          the pending reads / writes change.  The stream then drains the socket
+          until EAGAIN and tracks its readiness by itself, so that the steady
+          traffic costs no epoll_ctl call.  Falls back to level-triggered mode if
+          the io loop doesn't poll with epoll.
     """
     self.socket = socket
     self.socket.setblocking(False)
@@ -58,6 +85,29 @@ class IOStream(object):
     self._write_callbacks = deque()
     self._close_callback = None
     self._state = self.io_loop.ERROR
+
+    self._timer_wheel = None
+    self._timer = None
+    self._idle_timeout = None
+    self._read_timeout = None
+    self._write_timeout = None
+    self._last_activity = 0
+    self._read_since = None  # when the pending read started to receive data
+    self._write_since = None  # when the pending write started to wait for sending
+
+    if edge_triggered and not supports_edge_triggered(self.io_loop):
+      logging.warning("%s: Edge-triggered mode requires epoll, falls back to level-triggered", self.name)
+      edge_triggered = False
+    self._edge_triggered = edge_triggered
+    self._readable = True  # edge-triggered mode only, False after the socket read hits EAGAIN
+    self._writable = True  # edge-triggered mode only, False after the socket write hits EAGAIN
+    self._pending_io_scheduled = False
+    self._cork_num = 0  # nested cork() calls
+    self._flush_end = 0  # data before this position is sent out even if corked
+    # the write buffer does the coalescing, so Nagle's algorithm only adds latency.
+    self._set_tcp_option(TCP_NODELAY, 1)
+    if edge_triggered:
+      self._state = self.io_loop.READ | self.io_loop.WRITE | self.io_loop.ERROR | EPOLLET
     self.io_loop.add_handler(self.socket.fileno(), self._handle_events, self._state)
 
   def _run_callback(self, callback, *args, **kwargs):
@@ -95,23 +145,76 @@ class IOStream(object):
     """
     if length > self.max_buf_size:
       return (0, None)  # length is too long to fit into the buffer
-    if length < buf_size / 4:
+    if length < buf_size // 4:
       if buf_size == self.min_buf_size:
         return (buf_size, buf)
       else:
-        return (buf_size / 2, bytearray(buf_size / 2))  # shrinks the buffer size by half
-    if length < buf_size * 3 / 4:
+        return (buf_size // 2, bytearray(buf_size // 2))  # shrinks the buffer size by half
+    if length < buf_size * 3 // 4:
       return (buf_size, buf)  # returns the existing buffer
     new_size = buf_size * 2  # extends the buffer size by double
     while new_size <= self.max_buf_size:
-      if length < new_size * 3 / 4:
+      if length < new_size * 3 // 4:
         return (new_size, bytearray(new_size))  # returns the new buffer
-      new_size = buf_size * 2  # extends the buffer size by double
+      new_size *= 2  # extends the buffer size by double
     if buf_size == self.max_buf_size:
       return (buf_size, buf)
     else:
       return (self.max_buf_size, bytearray(self.max_buf_size))
 
+  def set_timeouts(self, timer_wheel, idle_timeout=None, read_timeout=None, write_timeout=None):
+    """Closes this stream when it hangs longer than the given timeouts.
+
+    The activity is only time-stamped on the stream when it happens, and the
+    timeouts are checked by a single timer on the wheel, which re-arms itself
+    when it fires earlier than the stream expires.
+
+    Args:
+      timer_wheel: The TimerWheel checking the timeouts, which should run on the same io loop.
+      idle_timeout: Seconds without any data received or sent.
+      read_timeout: Seconds that a partially received read request is allowed to take.
+      write_timeout: Seconds that the buffered data is allowed to wait for sending.
+    """
+    if self._timer:
+      self._timer_wheel.remove_timeout(self._timer)
+      self._timer = None
+    self._timer_wheel = timer_wheel
+    self._idle_timeout = idle_timeout
+    self._read_timeout = read_timeout
+    self._write_timeout = write_timeout
+    if timer_wheel is None:
+      return
+    # the clock of the wheel is stale while it's idle, and refreshed once a timer is armed on it.
+    now = time.time()
+    self._last_activity = now
+    timeouts = [timeout for timeout in (idle_timeout, read_timeout, write_timeout) if timeout]
+    if timeouts:
+      self._timer = timer_wheel.add_timeout(now + min(timeouts), self._check_timeouts)
+
+  def _check_timeouts(self):
+    """Closes the stream if any timeout expired, otherwise re-arms the timer."""
+    self._timer = None
+    if not self.socket:
+      return
+    now = self._timer_wheel.now
+    deadlines = []
+    if self._idle_timeout:
+      deadlines.append(self._last_activity + self._idle_timeout)
+    if self._read_timeout and self._read_since is not None:
+      deadlines.append(self._read_since + self._read_timeout)
+    if self._write_timeout and self._write_since is not None:
+      deadlines.append(self._write_since + self._write_timeout)
+    if not deadlines:
+      # nothing pending, checks again after the shortest timeout.
+      deadline = now + min(timeout for timeout in (self._read_timeout, self._write_timeout) if timeout)
+    else:
+      deadline = min(deadlines)
+    if deadline <= now:
+      logging.info("%s: Closing stream %d on timeout", self.name, self.socket.fileno())
+      self.close()
+      return
+    self._timer = self._timer_wheel.add_timeout(deadline, self._check_timeouts)
+
   def read(self, num_bytes, callback):
     """Call callback when we read the given number of bytes.
 
@@ -126,7 +229,57 @@ class IOStream(object):
     if not self.socket:
       raise IOError("Attempt to read/write to closed stream")
     self._read_callbacks.append((num_bytes, callback))
-    self._add_io_state(self.io_loop.READ)
+    if self._edge_triggered:
+      if self._readable:
+        self._schedule_pending_io()
+    else:
+      self._add_io_state(self.io_loop.READ)
+
+  def read_until(self, delimiter, callback, max_bytes=None):
+    """Call callback when we read the given delimiter.
+
+    The delimiter is searched in place in the read buffer, and the bytes already
+    scanned are not scanned again when more data arrives.
+
+    Args:
+      delimiter: The byte string that ends the data.
+      callback: The function will be called with the data up to and including the delimiter.
+          Function fingerprint: callback(buf, offset, num_bytes)
+      max_bytes: Closes the stream if the delimiter is not found in these many bytes, None for no limit.
+    """
+    request = _Delimiter(delimiter, max_bytes)
+    if not self._read_callbacks:
+      num_bytes = self._read_size(request)
+      if num_bytes is not None:
+        self._read_consume(num_bytes, callback)
+        return
+    if not self.socket:
+      raise IOError("Attempt to read/write to closed stream")
+    self._read_callbacks.append((request, callback))
+    if self._edge_triggered:
+      if self._readable:
+        self._schedule_pending_io()
+    else:
+      self._add_io_state(self.io_loop.READ)
+
+  def _read_size(self, request):
+    """Returns the number of bytes the pending read consumes, or None if they are not received yet.
+
+    Args:
+      request: The number of bytes, or the _Delimiter of a read_until.
+    """
+    available = self._read_end - self._read_start
+    if not isinstance(request, _Delimiter):
+      return request if request <= available else None
+    start = self._read_start + max(0, request.scanned - len(request.delimiter) + 1)
+    pos = self._read_buf.find(request.delimiter, start, self._read_end)
+    if pos >= 0:
+      return pos + len(request.delimiter) - self._read_start
+    request.scanned = available
+    if request.max_bytes is not None and available > request.max_bytes:
+      logging.warning("%s: Delimiter not found in %d bytes", self.name, request.max_bytes)
+      self.close()
+    return None
 
   def _read_consume(self, num_bytes, callback):
     """Consume bytes from read buffer and trigger callback.
@@ -137,6 +290,9 @@ class IOStream(object):
     """
     start = self._read_start
     self._read_start += num_bytes
+    if self._timer_wheel is not None:
+      # a read request has been fulfilled, restarts timing the next one.
+      self._read_since = self._timer_wheel.now if self._read_end > self._read_start else None
     if not callback:
       return
     self._run_callback(callback, self._read_buf, start, num_bytes)
@@ -144,46 +300,108 @@ class IOStream(object):
   def write(self, buf, offset, num_bytes, callback=0):
     """Write the given data to this stream.
 
-    By default, this operation won't acctually send the data out through socket.
-    Instead, it just writes these data into the write buffer thus may be more
-    efficient than calling socket.send each time.  Except:
-      1. callback array is not empty, indicating that there're some methods waiting.
-      2. more than io_chunk_size data is waiting to write out.
-    The user may like to apply the callback to None to manually send the waiting
-    write buffer to socket.
+    This operation won't acctually send the data out through socket.  Instead,
+    it just writes these data into the write buffer, which is sent out at the
+    end of the current io loop iteration, thus all data written in one
+    iteration costs a single socket.send call.  Except:
+      1. the stream is corked, then the data waits until uncork() or flush().
+      2. more than io_chunk_size data is waiting to write out, then it's sent
+         out anyway.
 
     Args:
       buf: The data stored in this buffer.
       offset: Offset of the data in the buffer.
       num_bytes: Data length.
       callback: Call this function if all data has been successfully written
-          to the stream.  Default set to 0.
+          to the stream.  Default set to 0, i.e. no callback.
           
           Function fingerprint: callback()
     """
     if not self.socket:
       raise IOError("Attempt to read/write to closed stream")
+    if self._timer_wheel is not None and self._write_end == self._write_start:
+      self._write_since = self._timer_wheel.now
     if (self._write_end + num_bytes) >= self._write_buf_size:
       # reach the end of the write buffer, needs re-allocation.
       length = self._write_end - self._write_start
       new_size, new_buf = self.__realloc(self._write_buf, length + num_bytes, self._write_buf_size)
-      if new_size is 0:
+      if new_size == 0:
         # buffer overflow, reports error
         logging.error("%s: Reached maximum write buffer size", self.name)
         self.close()
+        return
       new_buf[:length] = self._write_buf[self._write_start:self._write_end]  # copy existing data into new buffer
+      # adjust the registered positions
+      start = self._write_start
+      self._write_callbacks = deque([(pos - start, write_callback) for pos, write_callback in self._write_callbacks])
+      self._flush_end = max(0, self._flush_end - start)
       self._write_buf = new_buf
       self._write_buf_size = new_size
       self._write_start = 0
       self._write_end = length
-      # adjust the registered callbacks
-      self._write_callbacks = deque([(pos - length, write_callback) for pos, write_callback in self._write_callbacks])
     self._write_buf[self._write_end:self._write_end + num_bytes] = buf[offset:offset + num_bytes]
     self._write_end += num_bytes
-    if callback is not 0:
+    if callback != 0:
       self._write_callbacks.append((self._write_end, callback))
-    if not not self._write_callbacks or (self._write_end - self._write_start > self.io_chunk_size):
-      self._add_io_state(self.io_loop.WRITE)
+    if self._wants_write():
+      self._schedule_pending_io()
+
+  def flush(self, callback=0):
+    """Send out all data in the write buffer now, even if the stream is corked.
+
+    Args:
+      callback: Call this function when all data written so far has been
+          successfully written to the stream.  Default set to 0, i.e. no callback.
+
+          Function fingerprint: callback()
+    """
+    if not self.socket:
+      raise IOError("Attempt to read/write to closed stream")
+    if callback != 0:
+      self._write_callbacks.append((self._write_end, callback))
+    self._flush_end = self._write_end
+    if self._write_end > self._write_start:
+      self._schedule_pending_io()
+      return
+    while not not self._write_callbacks:  # nothing to write, calls back directly
+      pos, write_callback = self._write_callbacks.popleft()
+      if write_callback:
+        self._run_callback(write_callback)
+
+  def cork(self):
+    """Hold the written data in the write buffer until uncork() or flush().
+
+    Each cork() call should be paired with an uncork() call.  On TCP sockets
+    this also sets TCP_CORK, so that the kernel doesn't send partial frames
+    when more than io_chunk_size data has to be written while corked.
+    """
+    self._cork_num += 1
+    if self._cork_num == 1:
+      self._set_tcp_option(TCP_CORK, 1)
+
+  def uncork(self):
+    """Release the data held by cork(), and send it out at the end of the current io loop iteration."""
+    assert self._cork_num > 0, "%s: uncork() without cork()!" % self.name
+    self._cork_num -= 1
+    if self._cork_num or not self.socket:
+      return
+    self._set_tcp_option(TCP_CORK, 0)
+    if self._wants_write():
+      self._schedule_pending_io()
+
+  def _wants_write(self):
+    """Returns True if the data in the write buffer should be sent out."""
+    length = self._write_end - self._write_start
+    return length > 0 and (not self._cork_num or length > self.io_chunk_size or
+                           self._flush_end > self._write_start)
+
+  def _set_tcp_option(self, option, value):
+    if option is None:
+      return
+    try:
+      self.socket.setsockopt(socket.IPPROTO_TCP, option, value)
+    except socket.error:
+      pass  # not a TCP socket, e.g. the ipc socket pair
 
   def set_close_callback(self, callback):
     """Call the given callback when the stream is closed.
@@ -196,6 +414,9 @@ class IOStream(object):
   def close(self):
     """Close this stream."""
     if self.socket:
+      if self._timer:
+        self._timer_wheel.remove_timeout(self._timer)
+        self._timer = None
       self.io_loop.remove_handler(self.socket.fileno())
       self.socket.close()
       self.socket = None
@@ -208,6 +429,32 @@ class IOStream(object):
       self._write_callbacks.clear()
       self._write_callbacks = None
 
+  def _schedule_pending_io(self):
+    """Handles the pending writes, and the pending reads in edge-triggered mode, on a ready socket.
+
+    The io loop runs the added callbacks after handling all events of the
+    current iteration, so the pending work is handled at the end of the
+    iteration, which batches the writes made in it.  In edge-triggered mode,
+    no more edge will be reported for a socket which is already ready, so the
+    pending reads are handled there as well.
+    """
+    if not self._pending_io_scheduled:
+      self._pending_io_scheduled = True
+      self.io_loop.add_callback(self._handle_pending_io)
+
+  def _handle_pending_io(self):
+    self._pending_io_scheduled = False
+    if not self.socket:
+      return
+    if self._edge_triggered and self._readable and not not self._read_callbacks:
+      self._handle_read()
+      if not self.socket: return  # double check socket status after read
+    if self._writable and self._wants_write():
+      self._handle_write()
+      if not self.socket: return  # double check socket status after write
+      if not self._edge_triggered and self._wants_write():
+        self._add_io_state(self.io_loop.WRITE)  # the socket is full, waits for it to be writable
+
   def _add_io_state(self, state):
     """Add io state monitoring onto the current io loop."""
     if not self._state & state:
@@ -219,10 +466,14 @@ class IOStream(object):
     if not self.socket:
       logging.warning("%s: Got events for closed stream %d", self.name, fd)
       return
+    if self._edge_triggered:
+      self._handle_edge_events(events)
+      return
     if events & self.io_loop.READ:
       self._handle_read()
       if not self.socket: return  # double check socket status after read
     if events & self.io_loop.WRITE:
+      self._writable = True
       self._handle_write()
       if not self.socket: return  # double check socket status after write
     if events & self.io_loop.ERROR:
@@ -232,12 +483,28 @@ class IOStream(object):
     state = self.io_loop.ERROR
     if not not self._read_callbacks:
       state |= self.io_loop.READ
-    if not not self._write_callbacks or (self._write_end - self._write_start > self.io_chunk_size):
+    if self._wants_write():
       state |= self.io_loop.WRITE
     if state != self._state:
       self._state = state
       self.io_loop.update_handler(self.socket.fileno(), self._state)
 
+  def _handle_edge_events(self, events):
+    """Event dispatcher for io loop in edge-triggered mode."""
+    if events & self.io_loop.READ:
+      self._readable = True
+    if events & self.io_loop.WRITE:
+      self._writable = True
+    # without a pending read, leaves the data in the socket until some read is requested.
+    if self._readable and not not self._read_callbacks:
+      self._handle_read()
+      if not self.socket: return  # double check socket status after read
+    if self._writable and self._wants_write():
+      self._handle_write()
+      if not self.socket: return  # double check socket status after write
+    if events & self.io_loop.ERROR:
+      self.close()
+
   def _handle_write(self):
     """Handler to send data when it's ready."""
     while self._write_end > self._write_start:
@@ -245,8 +512,9 @@ class IOStream(object):
         length = self._write_end - self._write_start
         num_bytes = self.socket.write(self._write_buf, self._write_start, length)
         self._write_start += num_bytes
-      except socket.error, e:
-        if e[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+      except socket.error as e:
+        if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+          self._writable = False
           break
         else:
           logging.warning("%s: Write error on %d: %s", self.name, self.socket.fileno(), e)
@@ -258,6 +526,12 @@ class IOStream(object):
         logging.warning("%s: Write 0 bytes from %d", self.name, self.socket.fileno())
         self.close()
         return
+    if self._timer_wheel is not None:
+      self._last_activity = self._timer_wheel.now
+      if self._write_end == self._write_start:
+        self._write_since = None
+      elif self._write_callbacks and self._write_callbacks[0][0] <= self._write_start:
+        self._write_since = self._last_activity  # a message has been sent out
     while not not self._write_callbacks:
       pos, callback = self._write_callbacks.popleft()
       if pos > self._write_start:
@@ -274,10 +548,11 @@ class IOStream(object):
         # reach the end of the read buffer, needs re-allocation.
         length = self._read_end - self._read_start
         new_size, new_buf = self.__realloc(self._read_buf, length + self.io_chunk_size, self._read_buf_size)
-        if new_size is 0:
+        if new_size == 0:
           # buffer overflow, reports error
           logging.error("%s: Reached maximum read buffer size", self.name)
           self.close()
+          return
         new_buf[:length] = self._read_buf[self._read_start:self._read_end]  # copy existing data into new buffer
         self._read_buf = new_buf
         self._read_buf_size = new_size
@@ -286,24 +561,30 @@ class IOStream(object):
       try:
         num_bytes = self.socket.read(self._read_buf, self._read_end, self.io_chunk_size)
         self._read_end += num_bytes
-      except socket.error, e:
-        if e[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+      except socket.error as e:
+        if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+          self._readable = False
           break
         else:
           logging.warning("%s: Read error on %d: %s", self.name, self.socket.fileno(), e)
           self.close()
           return
-      if num_bytes < self.io_chunk_size:
-        break
       if not num_bytes:
         logging.warning("%s: Read 0 bytes from %d", self.name, self.socket.fileno())
         self.close()
         return
+      if num_bytes < self.io_chunk_size and not self._edge_triggered:
+        break  # edge-triggered mode has to read until EAGAIN, or no more event is reported
+    if self._timer_wheel is not None:
+      self._last_activity = self._timer_wheel.now
+      if self._read_since is None:
+        self._read_since = self._last_activity
     while not not self._read_callbacks:
-      num_bytes, callback = self._read_callbacks.popleft()
-      if num_bytes > (self._read_end - self._read_start):
-        self._read_callbacks.appendleft((num_bytes, callback))
+      request, callback = self._read_callbacks[0]
+      num_bytes = self._read_size(request)
+      if num_bytes is None:
         return
+      self._read_callbacks.popleft()
       if not callback:
         continue
       self._read_consume(num_bytes, callback)
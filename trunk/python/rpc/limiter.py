@@ -0,0 +1,74 @@
+"""The adaptive limit of the requests waiting in the worker queues, set by their queueing delay.
+
+Under overload, every request waiting in a worker queue makes all the
+requests behind it later, so a fixed dispatch window either wastes the
+workers when it's too small, or serves everything late when it's too large.
+AdaptiveLimiter takes the queueing delay of each request, from its dispatch
+by the acceptor to the worker taking it from its queue, and once per
+interval compares the minimum delay of the interval with the target, as
+CoDel does: a standing queue keeps even the minimum above the target.
+
+  - Above the target, the limit shrinks by the gradient target / delay,
+    at most by half per interval.
+  - At or below the target, the limit grows by its square root, but only
+    if it was reached during the interval, so that an idle server doesn't
+    inflate it.
+
+The change is smoothed, and the requests beyond the limit wait in the
+acceptor, where SocketServer sheds the ones which waited longer than
+max_queue_delay.
+"""
+
+import math
+import time
+
+class AdaptiveLimiter(object):
+  def __init__(self, initial_limit=16, min_limit=1, max_limit=1024, target_delay=0.005, interval=0.1,
+               smoothing=0.2, max_queue_delay=0.1):
+    """Initiate the limiter.
+
+    Args:
+      initial_limit: The limit to start with, the number of requests waiting in all the worker queues.
+      min_limit: The limit never goes below this.
+      max_limit: The limit never goes above this.
+      target_delay: Seconds a request may wait in a worker queue without counting as queueing.
+      interval: Seconds between the adjustments of the limit.
+      smoothing: The weight of each adjustment, 1 to apply it at once.
+      max_queue_delay: Seconds a request may wait in the acceptor before it's shed.
+    """
+    self._limit = float(initial_limit)
+    self._min_limit = min_limit
+    self._max_limit = max_limit
+    self._target_delay = target_delay
+    self._interval = interval
+    self._smoothing = smoothing
+    self.max_queue_delay = max_queue_delay
+    self._interval_end = time.time() + interval
+    self._min_delay = None  # the minimum delay of the current interval
+    self._saturated = False  # the limit was reached during the current interval
+
+  @property
+  def limit(self):
+    return int(self._limit)
+
+  def record_backlog(self, backlog):
+    """Records the number of requests in the worker queues, after a dispatch."""
+    if backlog >= int(self._limit):
+      self._saturated = True
+
+  def sample(self, delay, now=None):
+    """Records the queueing delay of a request, and adjusts the limit at the end of an interval."""
+    if self._min_delay is None or delay < self._min_delay:
+      self._min_delay = delay
+    now = now or time.time()
+    if now < self._interval_end:
+      return
+    gradient = 1.0 if self._min_delay <= self._target_delay else max(0.5, self._target_delay / self._min_delay)
+    new_limit = self._limit * gradient
+    if gradient == 1.0 and self._saturated:
+      new_limit += math.sqrt(self._limit)
+    self._limit += self._smoothing * (new_limit - self._limit)
+    self._limit = min(self._max_limit, max(self._min_limit, self._limit))
+    self._interval_end = now + self._interval
+    self._min_delay = None
+    self._saturated = False
@@ -0,0 +1,48 @@
+import time
+import unittest
+from limiter import AdaptiveLimiter
+
+class AdaptiveLimiterTest(unittest.TestCase):
+  def _run(self, limiter, intervals, delay, backlog=None, now=None):
+    now = now or time.time()
+    for _ in xrange(intervals):
+      now += 0.1
+      if backlog is not None:
+        limiter.record_backlog(backlog)
+      limiter.sample(delay, now)
+    return now
+
+  def test_shrinks_under_standing_queue(self):
+    limiter = AdaptiveLimiter(initial_limit=64, target_delay=0.005, interval=0.1)
+    self._run(limiter, 50, 0.05, backlog=1000)
+    self.assertEqual(1, limiter.limit)
+
+  def test_shrinks_at_most_by_half(self):
+    limiter = AdaptiveLimiter(initial_limit=64, target_delay=0.005, interval=0.1, smoothing=1)
+    self._run(limiter, 1, 10.0)
+    self.assertEqual(32, limiter.limit)
+
+  def test_grows_only_when_saturated(self):
+    limiter = AdaptiveLimiter(initial_limit=16, target_delay=0.005, interval=0.1, smoothing=1)
+    now = self._run(limiter, 10, 0.001)
+    self.assertEqual(16, limiter.limit)  # idle
+    self._run(limiter, 1, 0.001, backlog=16, now=now)
+    self.assertEqual(20, limiter.limit)
+
+  def test_bounds(self):
+    limiter = AdaptiveLimiter(initial_limit=8, min_limit=4, max_limit=10, interval=0.1, smoothing=1)
+    now = self._run(limiter, 20, 1.0, backlog=100)
+    self.assertEqual(4, limiter.limit)
+    self._run(limiter, 20, 0.0, backlog=100, now=now)
+    self.assertEqual(10, limiter.limit)
+
+  def test_minimum_delay_of_the_interval(self):
+    limiter = AdaptiveLimiter(initial_limit=32, target_delay=0.005, interval=0.1, smoothing=1)
+    now = time.time()
+    limiter.sample(0.5, now)
+    limiter.sample(0.001, now)  # a request served at once shows there is no standing queue
+    limiter.sample(0.5, now + 1)
+    self.assertEqual(32, limiter.limit)
+
+if __name__ == '__main__':
+  unittest.main()
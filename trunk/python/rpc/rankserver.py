@@ -0,0 +1,356 @@
+import math
+import struct
+import time
+import numpy as np
+from tornado import ioloop
+from socketserver import SocketServer
+from column import Column
+from scoreindex import ScoreIndex
+
+"""The rank server, which scores the items by their event time series in batch.
+
+It's the vectorized counterpart of php/rank/scorers.php.  The events of each
+series are kept in columnar NumPy arrays, and each scorer maintains one
+accumulator per item, so that scoring a candidate set is a single gather over
+the accumulators instead of a loop over the events of every item:
+
+  SumScorer:    score = sum(score_i)
+  AnnealScorer: score = sum(sgn_i * (|score_i| + score_stablizer) / anneal ^ (current - t_i + time_stablizer))
+                      = anneal ^ -(current - epoch + time_stablizer) * sum(sgn_i * (|score_i| + score_stablizer) * anneal ^ (t_i - epoch))
+
+Only the events happened before the current time are scored.  As the current
+time moves forward, the newly matured events are folded into the accumulators,
+and the decay of the anneal scores is a single factor.
+
+A series could also have a ScoreIndex (see scoreindex.py), which keeps its
+items ordered by score, so that its top items are found without a candidate
+set.  The indexes are snapshotted to disk periodically.
+
+Request = | 1 byte op | 4 bytes request_id | op fields | 4 bytes item_num | items |
+Response = | 1 byte op | 4 bytes request_id | 4 bytes item_num | items |
+
+Requests:
+  OP_ADD:    op fields = | 1 byte series_len | series |
+             item = | 2 bytes item_len | item | 4 bytes timestamp | 8 bytes double score |
+  OP_SET_CURRENT:
+             op fields = | 4 bytes current |, 0 means following the clock; no items
+  OP_RANK:   op fields = | 4 bytes top_k | 1 byte weight_num | weights |
+             weight = | 1 byte series_len | series | 8 bytes double weight |
+             item = | 2 bytes item_len | item |
+             The score of an item is the weighted sum of its scores in the series.
+  OP_TOP:    op fields = | 4 bytes top_k | 1 byte series_len | series |; no items
+             The series should have a ScoreIndex.
+
+Responses:
+  OP_ADD, OP_SET_CURRENT: no items.
+  OP_RANK:   item = | 2 bytes item_len | item | 8 bytes double score |
+             The top_k items by descending score, or all the items in the
+             request order if top_k is 0.
+  OP_TOP:    the same items as OP_RANK, the top_k items of the series.
+"""
+
+OP_ADD = 1
+OP_SET_CURRENT = 2
+OP_RANK = 3
+OP_TOP = 4
+
+_HEADER = struct.Struct("<BI")
+_UINT8 = struct.Struct("<B")
+_UINT16 = struct.Struct("<H")
+_UINT32 = struct.Struct("<I")
+_EVENT = struct.Struct("<Id")
+_DOUBLE = struct.Struct("<d")
+
+class SumScorer(object):
+  """Sums the scores of all the events together, the same as Zopt\\Rank\\SumScorer."""
+
+  def __init__(self, current=None):
+    self._current = time.time() if current is None else current
+    # the events, row is the index of the item, see RankService.
+    self._rows = Column(np.int32)
+    self._timestamps = Column(np.float64)
+    self._scores = Column(np.float64)
+    # the events after the current time, which are not in the accumulators yet.
+    self._pending = (np.zeros(0, np.int32), np.zeros(0, np.float64), np.zeros(0, np.float64))
+    self._accumulators = Column(np.float64)
+
+  def _weights(self, scores):
+    """Returns the contribution of the events to the accumulators at the epoch."""
+    return scores
+
+  def _kernel(self, timestamps):
+    """Returns the time factor of the events relative to the epoch."""
+    return 1.0
+
+  def _scale(self):
+    """Returns the factor turning the accumulators into the current scores."""
+    return 1.0
+
+  def _rebase(self):
+    """Resets the epoch to the current time, with the accumulators rescaled."""
+    pass
+
+  def _fold(self, rows, timestamps, scores):
+    """Adds the matured events into the accumulators."""
+    if len(rows):
+      accumulators = self._accumulators.values
+      accumulators += np.bincount(rows, self._weights(scores) * self._kernel(timestamps), len(accumulators))
+
+  def _rebuild(self):
+    """Recomputes the accumulators from all the events, when the current time moves backward."""
+    self._rebase()
+    timestamps = self._timestamps.values
+    matured = timestamps <= self._current
+    rows = self._rows.values
+    accumulators = self._accumulators.values
+    accumulators[:] = np.bincount(rows[matured], (self._weights(self._scores.values[matured]) *
+                                                  self._kernel(timestamps[matured])), len(accumulators))
+    future = ~matured
+    self._pending = (rows[future], timestamps[future], self._scores.values[future])
+
+  def add(self, rows, timestamps, scores):
+    """Adds events.
+
+    Args:
+      rows: The rows of the items, an int32 array.
+      timestamps: The UNIX timestamps of the events, a float64 array.
+      scores: The scores of the events, a float64 array.
+    """
+    self._rows.extend(rows)
+    self._timestamps.extend(timestamps)
+    self._scores.extend(scores)
+    self._accumulators.resize(int(rows.max()) + 1 if len(rows) else 0)
+    matured = timestamps <= self._current
+    self._fold(rows[matured], timestamps[matured], scores[matured])
+    if not matured.all():
+      future = ~matured
+      self._pending = tuple(np.concatenate((pending, new[future]))
+                            for pending, new in zip(self._pending, (rows, timestamps, scores)))
+
+  def set_current(self, current=None):
+    if current is None:
+      current = time.time()
+    if current < self._current:
+      self._current = current
+      self._rebuild()
+      return
+    self._current = current
+    self._rebase()
+    rows, timestamps, scores = self._pending
+    if len(timestamps):
+      matured = timestamps <= current
+      self._fold(rows[matured], timestamps[matured], scores[matured])
+      future = ~matured
+      self._pending = (rows[future], timestamps[future], scores[future])
+
+  def score(self, rows):
+    """Returns the current scores of the items as a float64 array.
+
+    Args:
+      rows: The rows of the items, an int32 array.  The rows without any event score 0.
+    """
+    accumulators = self._accumulators.values
+    scores = np.zeros(len(rows), np.float64)
+    known = rows < len(accumulators)
+    scores[known] = accumulators[rows[known]]
+    return scores * self._scale()
+
+class AnnealScorer(SumScorer):
+  """Scores the events by score / anneal ^ time_diff, the same as Zopt\\Rank\\AnnealScorer."""
+
+  # the epoch is moved when anneal ^ (current - epoch) exceeds e ^ _MAX_EXPONENT, so that the
+  # accumulators never overflow.
+  _MAX_EXPONENT = 64.0
+
+  def __init__(self, anneal=1.0, score_stablizer=0.0, time_stablizer=0.0, current=None):
+    SumScorer.__init__(self, current)
+    self._score_stablizer = score_stablizer
+    self._time_stablizer = time_stablizer
+    # the anneal should be larger than 1 to make the score fade out
+    self._log_anneal = math.log(max(anneal, 1.0))
+    self._epoch = self._current
+
+  def _weights(self, scores):
+    return np.where(scores > 0, 1.0, -1.0) * (np.abs(scores) + self._score_stablizer)
+
+  def _kernel(self, timestamps):
+    return np.exp(self._log_anneal * (timestamps - self._epoch))
+
+  def _scale(self):
+    return math.exp(-self._log_anneal * (self._current - self._epoch + self._time_stablizer))
+
+  def _rebase(self):
+    exponent = self._log_anneal * (self._current - self._epoch)
+    if exponent <= self._MAX_EXPONENT and self._current >= self._epoch:
+      return
+    self._accumulators.values[:] *= math.exp(-exponent)
+    self._epoch = self._current
+
+def top_k(scores, k):
+  """Returns the indexes of the k largest scores in descending order, or all the indexes if k is 0."""
+  if not k:
+    return np.arange(len(scores))
+  if k < len(scores):
+    indexes = np.argpartition(-scores, k - 1)[:k]
+  else:
+    indexes = np.arange(len(scores))
+  return indexes[np.argsort(-scores[indexes], kind="mergesort")]
+
+class RankService(object):
+  """The payload handler of the rank server."""
+
+  def __init__(self, scorers, indexes=None, snapshot_interval=60):
+    """Initiate the rank service.
+
+    Args:
+      scorers: The scorer of each series, {series: scorer}.
+      indexes: The ScoreIndex of the series to find the top items, {series: index}.
+      snapshot_interval: Seconds between the snapshots of the indexes with snapshot_path.
+    """
+    self._scorers = scorers
+    self._indexes = indexes or {}
+    self._rows = {}  # item -> row, shared by all the series
+    self._items = []  # row -> item
+    self._follow_clock = True
+    self._current = None  # the time set by OP_SET_CURRENT
+    self._snapshot_interval = snapshot_interval
+    self._snapshot_callback = None  # started in the worker process, on the worker's io loop
+
+  def snapshot(self):
+    """Saves the indexes with snapshot_path to disk."""
+    for index in self._indexes.itervalues():
+      if index.snapshot_path:
+        index.snapshot()
+
+  def _row(self, item):
+    row = self._rows.get(item)
+    if row is None:
+      row = self._rows[item] = len(self._items)
+      self._items.append(item)
+    return row
+
+  def merge(self, rows, weights):
+    """Returns the weighted sum of the scores of the items in the series.
+
+    Args:
+      rows: The rows of the items, an int32 array.
+      weights: The weight of each series, {series: weight}.  Unknown series are ignored.
+    """
+    merged = np.zeros(len(rows), np.float64)
+    for series, weight in weights.iteritems():
+      scorer = self._scorers.get(series)
+      if scorer is not None and weight:
+        merged += weight * scorer.score(rows)
+    return merged
+
+  def _handle_add(self, payload, pos):
+    series_len = _UINT8.unpack_from(payload, pos)[0]
+    series = bytes(payload[pos + 1:pos + 1 + series_len])
+    scorer = self._scorers.get(series)
+    index = self._indexes.get(series)
+    pos += 1 + series_len
+    item_num = _UINT32.unpack_from(payload, pos)[0]
+    pos += 4
+    rows = np.empty(item_num, np.int32)
+    timestamps = np.empty(item_num, np.float64)
+    scores = np.empty(item_num, np.float64)
+    for i in xrange(item_num):
+      item_len = _UINT16.unpack_from(payload, pos)[0]
+      item = bytes(payload[pos + 2:pos + 2 + item_len])
+      rows[i] = self._row(item)
+      pos += 2 + item_len
+      timestamps[i], scores[i] = _EVENT.unpack_from(payload, pos)
+      pos += _EVENT.size
+      if index is not None:
+        index.add(item, timestamps[i], scores[i])
+    if scorer is not None:
+      scorer.add(rows, timestamps, scores)
+    return []
+
+  def _handle_set_current(self, payload, pos):
+    current = _UINT32.unpack_from(payload, pos)[0]
+    self._follow_clock = not current
+    self._current = current or None
+    for scorer in self._scorers.itervalues():
+      scorer.set_current(current or None)
+    return []
+
+  def _handle_rank(self, payload, pos):
+    k = _UINT32.unpack_from(payload, pos)[0]
+    weight_num = _UINT8.unpack_from(payload, pos + 4)[0]
+    pos += 5
+    weights = {}
+    for _ in xrange(weight_num):
+      series_len = _UINT8.unpack_from(payload, pos)[0]
+      series = bytes(payload[pos + 1:pos + 1 + series_len])
+      pos += 1 + series_len
+      weights[series] = _DOUBLE.unpack_from(payload, pos)[0]
+      pos += _DOUBLE.size
+    item_num = _UINT32.unpack_from(payload, pos)[0]
+    pos += 4
+    items = []
+    for _ in xrange(item_num):
+      item_len = _UINT16.unpack_from(payload, pos)[0]
+      items.append(bytes(payload[pos + 2:pos + 2 + item_len]))
+      pos += 2 + item_len
+    if self._follow_clock:
+      now = time.time()
+      for scorer in self._scorers.itervalues():
+        scorer.set_current(now)
+    unknown_row = len(self._items)  # no scorer has an accumulator for it
+    rows = np.fromiter((self._rows.get(item, unknown_row) for item in items), np.int32, len(items))
+    scores = self.merge(rows, weights)
+    return [_UINT16.pack(len(items[i])) + items[i] + _DOUBLE.pack(scores[i]) for i in top_k(scores, k)]
+
+  def _handle_top(self, payload, pos):
+    k = _UINT32.unpack_from(payload, pos)[0]
+    series_len = _UINT8.unpack_from(payload, pos + 4)[0]
+    index = self._indexes.get(bytes(payload[pos + 5:pos + 5 + series_len]))
+    if index is None:
+      return []
+    return [_UINT16.pack(len(item)) + item + _DOUBLE.pack(score) for item, score in index.top(k, self._current)]
+
+  def handle(self, payload, callback):
+    if self._snapshot_callback is None and self._indexes:
+      self._snapshot_callback = ioloop.PeriodicCallback(self.snapshot, self._snapshot_interval * 1000)
+      self._snapshot_callback.start()
+    op, request_id = _HEADER.unpack_from(payload, 0)
+    pos = _HEADER.size
+    if op == OP_ADD:
+      results = self._handle_add(payload, pos)
+    elif op == OP_SET_CURRENT:
+      results = self._handle_set_current(payload, pos)
+    elif op == OP_RANK:
+      results = self._handle_rank(payload, pos)
+    elif op == OP_TOP:
+      results = self._handle_top(payload, pos)
+    else:
+      results = []
+    callback(_HEADER.pack(op, request_id) + _UINT32.pack(len(results)) + "".join(results))
+
+class RankServer(SocketServer):
+  """The rank server, whose items are all kept in one worker process."""
+
+  def __init__(self, port, scorers, indexes=None, snapshot_interval=60, **kwargs):
+    """Initiate the rank server.
+
+    Args:
+      port: The port to listen.
+      scorers: The scorer of each series, {series: scorer}.
+      indexes: The ScoreIndex of the series to find the top items, {series: index}.
+      snapshot_interval: Seconds between the snapshots of the indexes.
+      kwargs: The other arguments of SocketServer, except worker_num.
+    """
+    # the scores of one candidate set are computed over the accumulators of all its items, which
+    # therefore live in a single worker; the vectorized scoring keeps it off the critical path.
+    kwargs["worker_num"] = 1
+    SocketServer.__init__(self, port, RankService(scorers, indexes, snapshot_interval).handle, **kwargs)
+
+def main():
+  # only for test
+  server = RankServer(20002, {"votes": AnnealScorer(1.0001), "views": SumScorer()},
+                      {"votes": ScoreIndex(1.0001, snapshot_path = "/tmp/rank_votes.idx")}, idle_timeout = 60)
+  server.start()
+
+if __name__ == '__main__':
+  main()
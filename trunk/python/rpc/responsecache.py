@@ -0,0 +1,193 @@
+"""The response cache of the SocketServer acceptor.
+
+Many requests are read-only lookups repeated across clients, and each of them
+costs an ipc round trip to a worker.  With a response cache, the acceptor
+answers a cached request from its own memory, and collapses the identical
+requests arriving meanwhile into one call to a worker, whose response is
+written to all of them and cached.
+
+The calls collapsing the requests are sent to the workers under their own
+addr_ids, at the top of the connection serials which no client reaches, so
+their responses come back without touching the protocol.
+
+Which requests are cached and how the cached responses answer them is decided
+by a key policy, with the methods:
+  key(buf, offset, num_bytes): Returns (key, tag) of a cacheable request, or
+      None.  The tag is what tells the response of this request from the
+      cached one, e.g. its request id.
+  response(cached, tag): Returns the response to the request of the tag.
+  cacheable(response): Returns False if the response should only answer the
+      requests waiting for it, e.g. a transient error, instead of being cached.
+Only the requests answered by exactly one frame can be cached; the later
+frames of a call are dropped.
+
+A call unanswered within call_timeout seconds, or whose worker died, is
+abandoned, and the requests waiting for it are passed to abandon_callback so
+that the server sheds them.  The call ids are 16 bits, so at most 65536 calls
+are in flight, and lookup tells to shed the requests beyond them.
+"""
+
+import functools
+import hashlib
+import struct
+import time
+from tornado import ioloop
+from cachestore import CacheStore
+from channel import OVERLOADED_PAYLOAD_HEAD
+from timerwheel import TimerWheel
+
+_CALL_ID_PREFIX = "\xff\xff\xff\xff"
+_CALL_ID = struct.Struct("<H")
+
+class PayloadCacheKey(object):
+  """Keys the requests by their payload hash, for the protocols without request ids."""
+
+  def key(self, buf, offset, num_bytes):
+    return hashlib.sha1(buf[offset:offset + num_bytes]).digest(), None
+
+  def response(self, cached, tag):
+    return cached
+
+  def cacheable(self, response):
+    return True
+
+class RequestIdCacheKey(object):
+  """Keys the requests of the | 1 byte op | 4 bytes request_id | protocols by the payload without the request id.
+
+  This is the layout of the rank, geo, data and social services.
+  """
+
+  _HEADER = struct.Struct("<BI")
+
+  def __init__(self, ops, status_ok=None):
+    """Initiate the policy.
+
+    Args:
+      ops: The read-only ops whose responses are cached.
+      status_ok: The status byte following the header of the successful responses, e.g.
+          STATUS_OK of the data and social services, so that only those are cached.
+          None for the protocols without a status byte, e.g. the rank and geo services.
+    """
+    self._ops = frozenset(ops)
+    self._status_ok = status_ok
+
+  def key(self, buf, offset, num_bytes):
+    op, request_id = self._HEADER.unpack_from(buf, offset)
+    if op not in self._ops:
+      return None
+    sha1 = hashlib.sha1(chr(op))
+    sha1.update(buf[offset + self._HEADER.size:offset + num_bytes])
+    return sha1.digest(), request_id
+
+  def response(self, cached, tag):
+    return cached[:1] + struct.pack("<I", tag) + cached[self._HEADER.size:]
+
+  def cacheable(self, response):
+    return self._status_ok is None or response[self._HEADER.size:self._HEADER.size + 1] == chr(self._status_ok)
+
+class ResponseCache(object):
+  def __init__(self, policy, ttl=1, max_bytes=67108864, call_timeout=10, timer_wheel=None, abandon_callback=None):
+    """Initiate the response cache.
+
+    Args:
+      policy: The key policy, see the module doc.
+      ttl: Seconds that a response is cached.
+      max_bytes: Maximum total size of the cached keys and responses, the least recently used are evicted.
+      call_timeout: Seconds after which an unanswered call is abandoned, e.g. if its worker hangs,
+          and the next identical request makes a new call.
+      timer_wheel: The TimerWheel expiring the calls, default to one on the io loop instance.
+      abandon_callback: Called with each request waiting for an abandoned call.
+          Function fingerprint: abandon_callback(addr_id, payload_head)
+          payload_head: The first OVERLOADED_PAYLOAD_HEAD bytes of the request.
+    """
+    self._policy = policy
+    self._ttl = ttl
+    self._call_timeout = call_timeout
+    self._timer_wheel = timer_wheel
+    self._abandon_callback = abandon_callback
+    self._store = CacheStore(max(1, max_bytes / 256), max_bytes, admission=False)
+    self._calls = {}  # call_id -> [key, worker_id, timer, waiters as [(addr_id, tag, payload_head)]]
+    self._key_calls = {}  # key -> call_id
+    self._next_call_id = 0
+
+  def is_call(self, addr_id):
+    """Returns True if addr_id is of a call made by this cache, instead of a client."""
+    return addr_id.startswith(_CALL_ID_PREFIX)
+
+  def lookup(self, addr_id, buf, offset, num_bytes):
+    """Looks up the response of a request.
+
+    Returns:
+      None if the request is not cacheable, False if it should be shed as all the call ids
+      are in flight, otherwise (response, call_id):
+        (response, None) for a hit,
+        (None, call_id) if the request should be sent to a worker under call_id, see dispatched, and
+        (None, None) if the request waits for the same call in flight.
+    """
+    keyed = self._policy.key(buf, offset, num_bytes)
+    if keyed is None:
+      return None
+    key, tag = keyed
+    cached = self._store.get(key)
+    if cached is not None:
+      return self._policy.response(cached[0], tag), None
+    waiter = (addr_id, tag, bytes(buf[offset:offset + min(num_bytes, OVERLOADED_PAYLOAD_HEAD)]))
+    call_id = self._key_calls.get(key)
+    if call_id is not None:
+      self._calls[call_id][3].append(waiter)
+      return None, None
+    if len(self._calls) > 0xffff:
+      return False
+    while True:
+      call_id = _CALL_ID_PREFIX + _CALL_ID.pack(self._next_call_id)
+      self._next_call_id = (self._next_call_id + 1) & 0xffff
+      if call_id not in self._calls:
+        break
+    if self._timer_wheel is None:
+      self._timer_wheel = TimerWheel(ioloop.IOLoop.instance())
+    timer = self._timer_wheel.add_timeout(time.time() + self._call_timeout,
+                                          functools.partial(self._abandon_call, call_id))
+    self._calls[call_id] = [key, None, timer, [waiter]]
+    self._key_calls[key] = call_id
+    return None, call_id
+
+  def dispatched(self, call_id, worker_id):
+    """Records the worker serving the call, whose death abandons it."""
+    self._calls[call_id][1] = worker_id
+
+  def _pop_call(self, call_id):
+    call = self._calls.pop(call_id, None)
+    if call is None:
+      return None
+    self._timer_wheel.remove_timeout(call[2])
+    if self._key_calls.get(call[0]) == call_id:
+      del self._key_calls[call[0]]
+    return call
+
+  def _abandon_call(self, call_id):
+    call = self._pop_call(call_id)
+    if call is not None and self._abandon_callback:
+      for addr_id, _, payload_head in call[3]:
+        self._abandon_callback(addr_id, payload_head)
+
+  def abandon_worker(self, worker_id):
+    """Abandons the calls of the worker, which died."""
+    for call_id in [call_id for call_id, call in self._calls.iteritems() if call[1] == worker_id]:
+      self._abandon_call(call_id)
+
+  def complete(self, call_id, buf, offset, num_bytes):
+    """Caches the response of a call, and returns the [(addr_id, response)] of the requests waiting for it."""
+    call = self._pop_call(call_id)
+    if call is None:
+      return []
+    key, _, _, waiters = call
+    response = bytes(buf[offset:offset + num_bytes])
+    if self._policy.cacheable(response):
+      self._store.set(key, response, self._ttl)
+    return [(addr_id, self._policy.response(response, tag)) for addr_id, tag, _ in waiters]
+
+  def stats(self):
+    """Returns the statistics of the cached responses, see CacheStore.stats."""
+    stats = self._store.stats()
+    stats["calls"] = len(self._calls)
+    return stats
@@ -0,0 +1,102 @@
+import struct
+import unittest
+import responsecache
+import timerwheel
+from responsecache import ResponseCache, RequestIdCacheKey
+from timerwheel import TimerWheel
+
+class _Clock(object):
+  """Stands for the time module, with a clock moved by the test."""
+
+  def __init__(self, now):
+    self.now = now
+
+  def time(self):
+    return self.now
+
+class _Loop(object):
+  """The IO loop interface of TimerWheel, whose timeouts are run by the test."""
+
+  def __init__(self):
+    self.timeouts = []
+
+  def add_timeout(self, deadline, callback):
+    timeout = [deadline, callback]
+    self.timeouts.append(timeout)
+    return timeout
+
+  def remove_timeout(self, timeout):
+    self.timeouts.remove(timeout)
+
+  def run_until(self, clock, now):
+    while True:
+      due = [timeout for timeout in self.timeouts if timeout[0] <= now]
+      if not due:
+        break
+      timeout = min(due)
+      self.timeouts.remove(timeout)
+      clock.now = timeout[0]
+      timeout[1]()
+    clock.now = now
+
+def _request(op, request_id, body=""):
+  return struct.pack("<BI", op, request_id) + body
+
+class ResponseCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.clock = _Clock(1000.0)
+    self._time = responsecache.time, timerwheel.time
+    responsecache.time = timerwheel.time = self.clock
+    self.loop = _Loop()
+    self.abandoned = []
+    self.cache = ResponseCache(RequestIdCacheKey([1], status_ok=0), call_timeout=5,
+                               timer_wheel=TimerWheel(self.loop, tick=0.5),
+                               abandon_callback=lambda addr_id, head: self.abandoned.append((addr_id, head)))
+
+  def tearDown(self):
+    responsecache.time, timerwheel.time = self._time
+
+  def _lookup(self, addr_id, request):
+    return self.cache.lookup(addr_id, request, 0, len(request))
+
+  def test_collapses_and_caches(self):
+    response, call_id = self._lookup("a", _request(1, 7, "q"))
+    self.assertEqual(None, response)
+    self.assertTrue(self.cache.is_call(call_id))
+    self.assertEqual((None, None), self._lookup("b", _request(1, 8, "q")))
+    self.assertEqual(None, self._lookup("c", _request(2, 9, "q")))  # not a cached op
+    answered = self.cache.complete(call_id, _request(1, 7, "\0r"), 0, 7)
+    self.assertEqual([("a", _request(1, 7, "\0r")), ("b", _request(1, 8, "\0r"))], answered)
+    self.assertEqual((_request(1, 10, "\0r"), None), self._lookup("d", _request(1, 10, "q")))
+
+  def test_errors_answer_the_waiters_only(self):
+    call_id = self._lookup("a", _request(1, 7, "q"))[1]
+    self.assertEqual([("a", _request(1, 7, "\1e"))], self.cache.complete(call_id, _request(1, 7, "\1e"), 0, 7))
+    self.assertNotEqual(None, self._lookup("b", _request(1, 8, "q"))[1])
+
+  def test_expired_call_sheds_the_waiters(self):
+    call_id = self._lookup("a", _request(1, 7, "q"))[1]
+    self._lookup("b", _request(1, 8, "q"))
+    self.loop.run_until(self.clock, 1006.0)
+    self.assertEqual([("a", _request(1, 7, "q")), ("b", _request(1, 8, "q"))], self.abandoned)
+    self.assertEqual(0, self.cache.stats()["calls"])
+    self.assertEqual([], self.cache.complete(call_id, _request(1, 7, "\0r"), 0, 7))  # too late
+    self.assertNotEqual(call_id, self._lookup("c", _request(1, 9, "q"))[1])
+
+  def test_dead_worker_abandons_its_calls(self):
+    first = self._lookup("a", _request(1, 7, "q"))[1]
+    second = self._lookup("b", _request(1, 8, "p"))[1]
+    self.cache.dispatched(first, 0)
+    self.cache.dispatched(second, 1)
+    self.cache.abandon_worker(0)
+    self.assertEqual([("a", _request(1, 7, "q"))], self.abandoned)
+    self.assertEqual(1, self.cache.stats()["calls"])
+
+  def test_sheds_when_no_call_id_is_free(self):
+    for i in xrange(0x10000):
+      self.assertNotEqual(None, self._lookup("a", _request(1, i, struct.pack("<I", i)))[1])
+    self.assertEqual(False, self._lookup("b", _request(1, 0, "q")))
+    self.assertEqual((None, None), self._lookup("b", _request(1, 1, struct.pack("<I", 5))))  # still waits
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,69 @@
+"""The weighted fair queue of the requests waiting in the acceptor for a worker.
+
+Each priority class has its own FIFO queue, and the classes are served by
+stride scheduling: every class has a pass value which grows by 1 / weight
+with each request dispatched from it, and the non-empty class of the
+smallest pass goes next.  A class of weight 4 thus gets 4 times the
+dispatches of a class of weight 1 while both are backlogged, and any class
+with requests waiting is served within a bounded number of dispatches, so
+the batch traffic can't starve.  A class which was idle restarts from the
+current virtual time, instead of claiming the share it didn't use.
+"""
+
+from collections import deque
+
+class WeightedFairQueue(object):
+  def __init__(self, weights, max_len=None):
+    """Initiate the queue.
+
+    Args:
+      weights: The weights of the priority classes, {class: weight}; a request of
+          an unknown class goes to the class of the smallest weight.
+      max_len: Maximum number of the queued requests of each class, None for no limit.
+    """
+    self._weights = dict(weights)
+    self._default_class = min(self._weights, key=self._weights.get)
+    self._max_len = max_len
+    self._queues = dict((priority, deque()) for priority in self._weights)
+    self._passes = dict((priority, 0.0) for priority in self._weights)
+    self._virtual_time = 0.0
+    self._len = 0
+
+  def __len__(self):
+    return self._len
+
+  def push(self, priority, item):
+    """Queues an item of the priority class, returns False if the queue of the class is full."""
+    if priority not in self._queues:
+      priority = self._default_class
+    queue = self._queues[priority]
+    if self._max_len is not None and len(queue) >= self._max_len:
+      return False
+    if not queue:
+      self._passes[priority] = max(self._passes[priority], self._virtual_time)
+    queue.append(item)
+    self._len += 1
+    return True
+
+  def pop(self):
+    """Returns the next item in the weighted fair order, or None if the queue is empty."""
+    if not self._len:
+      return None
+    priority = min((self._passes[priority], priority) for priority, queue in self._queues.iteritems() if queue)[1]
+    self._virtual_time = self._passes[priority]
+    self._passes[priority] += 1.0 / self._weights[priority]
+    self._len -= 1
+    return self._queues[priority].popleft()
+
+  def drop_heads(self, predicate):
+    """Removes the items from the head of each class while predicate(item) is true, returns them."""
+    dropped = []
+    for queue in self._queues.itervalues():
+      while queue and predicate(queue[0]):
+        dropped.append(queue.popleft())
+    self._len -= len(dropped)
+    return dropped
+
+  def lengths(self):
+    """Returns the number of the queued items of each class."""
+    return dict((priority, len(queue)) for priority, queue in self._queues.iteritems())
@@ -0,0 +1,51 @@
+import unittest
+from scheduler import WeightedFairQueue
+
+class WeightedFairQueueTest(unittest.TestCase):
+  def test_shares_by_weight(self):
+    queue = WeightedFairQueue({0: 1, 1: 4})
+    for i in xrange(100):
+      queue.push(0, (0, i))
+      queue.push(1, (1, i))
+    popped = [queue.pop() for _ in xrange(50)]
+    self.assertEqual(10, sum(1 for priority, _ in popped if priority == 0))
+    self.assertEqual([i for priority, i in popped if priority == 1], range(40))  # FIFO in a class
+
+  def test_backlogged_class_is_not_starved(self):
+    queue = WeightedFairQueue({0: 1, 1: 100})
+    for i in xrange(1000):
+      queue.push(1, i)
+    queue.push(0, "batch")
+    self.assertTrue("batch" in [queue.pop() for _ in xrange(101)])
+
+  def test_idle_class_restarts_from_the_virtual_time(self):
+    queue = WeightedFairQueue({0: 1, 1: 1})
+    for i in xrange(10):
+      queue.push(0, i)
+    for _ in xrange(10):
+      queue.pop()
+    for i in xrange(10):
+      queue.push(0, i)
+      queue.push(1, "x%d" % i)
+    popped = [queue.pop() for _ in xrange(4)]
+    self.assertEqual(2, sum(1 for item in popped if str(item).startswith("x")))  # no credit for the idle time
+
+  def test_bounded_and_unknown_classes(self):
+    queue = WeightedFairQueue({0: 2, 2: 1}, max_len=2)
+    self.assertTrue(queue.push(7, "a"))  # goes to the class of the smallest weight
+    self.assertTrue(queue.push(2, "b"))
+    self.assertFalse(queue.push(2, "c"))
+    self.assertEqual({0: 0, 2: 2}, queue.lengths())
+    self.assertEqual(2, len(queue))
+
+  def test_drop_heads(self):
+    queue = WeightedFairQueue({0: 1, 1: 1})
+    for i in xrange(5):
+      queue.push(i % 2, i)
+    self.assertEqual([0, 1, 2], sorted(queue.drop_heads(lambda item: item < 3)))
+    self.assertEqual(2, len(queue))
+    self.assertEqual([3, 4], sorted([queue.pop(), queue.pop()]))
+    self.assertEqual(None, queue.pop())
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,147 @@
+import cPickle
+import heapq
+import math
+import os
+import time
+
+"""An incremental index of the anneal scores, which never rescans the events.
+
+With exponential decay, the score of an item is
+
+  score = anneal ^ -(current - epoch + time_stablizer) * sum(sgn_i * (|score_i| + score_stablizer) * anneal ^ (t_i - epoch))
+
+The sum is independent of the current time, so it's kept as one accumulator
+per item and updated in O(1) per new event.  The accumulators are stored in
+log space (as the sign and the log of the absolute value) relative to a fixed
+epoch, so they never overflow, however far the time goes.  As the decay factor
+is the same for all the items, the order of the accumulators is the order of
+the current scores: the heap ordered by the log accumulators never needs to be
+rebuilt as the time goes by.
+"""
+
+_NEG_INF = float("-inf")
+
+def _log_add(sign1, log1, sign2, log2):
+  """Returns (sign, log |x|) of x1 + x2, given the sign and the log of the absolute value of each."""
+  if log1 < log2:
+    sign1, log1, sign2, log2 = sign2, log2, sign1, log1
+  if log1 == _NEG_INF:
+    return 0, _NEG_INF
+  ratio = sign1 + sign2 * math.exp(log2 - log1)
+  if ratio == 0:
+    return 0, _NEG_INF
+  return (1 if ratio > 0 else -1), log1 + math.log(abs(ratio))
+
+def _order_key(sign, log_abs):
+  """The key of the min-heap, the item of the largest score has the smallest key."""
+  return (-sign, -sign * log_abs)
+
+class ScoreIndex(object):
+  """The anneal scores of the items, with the top items found in O(K log K)."""
+
+  def __init__(self, anneal=1.0, score_stablizer=0.0, time_stablizer=0.0, epoch=None, snapshot_path=None):
+    """Initiate the index.
+
+    Args:
+      anneal: The same as Zopt\\Rank\\AnnealScorer, 1.0 makes it a SumScorer.
+      score_stablizer: The same as Zopt\\Rank\\AnnealScorer.
+      time_stablizer: The same as Zopt\\Rank\\AnnealScorer.
+      epoch: The time the accumulators are relative to, default to now.
+      snapshot_path: The file to save the index to, and to restore it from if exists.
+    """
+    # the anneal should be larger than 1 to make the score fade out
+    self._log_anneal = math.log(max(anneal, 1.0))
+    self._score_stablizer = score_stablizer
+    self._time_stablizer = time_stablizer
+    self._epoch = time.time() if epoch is None else epoch
+    self.snapshot_path = snapshot_path
+    self._states = {}  # item -> (sign, log_abs, version) of its accumulator
+    # the min-heap of (order key, version, item); the entries of the old versions are skipped.
+    self._heap = []
+    self._version = 0
+    if snapshot_path and os.path.exists(snapshot_path):
+      self.restore()
+
+  def __len__(self):
+    return len(self._states)
+
+  def add(self, item, timestamp, score):
+    """Adds a ScoreEvent of the item in O(log N)."""
+    sign = 1 if score > 0 else -1  # the same as AnnealScorer, a zero score counts negative
+    magnitude = abs(score) + self._score_stablizer
+    if magnitude == 0:
+      return
+    log_abs = math.log(magnitude) + self._log_anneal * (timestamp - self._epoch)
+    state = self._states.get(item)
+    if state is not None:
+      sign, log_abs = _log_add(state[0], state[1], sign, log_abs)
+    self._version += 1
+    self._states[item] = (sign, log_abs, self._version)
+    heapq.heappush(self._heap, (_order_key(sign, log_abs), self._version, item))
+    if len(self._heap) > 2 * len(self._states) + 1024:
+      self._compact()
+
+  def remove(self, item):
+    """Removes the item, whose heap entries are skipped from now on."""
+    self._states.pop(item, None)
+
+  def _compact(self):
+    """Drops the heap entries of the old versions, in O(N)."""
+    self._heap = [(_order_key(sign, log_abs), version, item)
+                  for item, (sign, log_abs, version) in self._states.iteritems()]
+    heapq.heapify(self._heap)
+
+  def _score(self, sign, log_abs, current):
+    if not sign:
+      return 0.0
+    return sign * math.exp(log_abs - self._log_anneal * (current - self._epoch + self._time_stablizer))
+
+  def score(self, item, current=None):
+    """Returns the score of the item at the time current, default to now."""
+    state = self._states.get(item)
+    if state is None:
+      return 0.0
+    return self._score(state[0], state[1], time.time() if current is None else current)
+
+  def top(self, k, current=None):
+    """Returns the [(item, score)] of the k items of the largest scores at the time current.
+
+    The heap is walked from its root with a candidate heap, without touching the
+    other items, so it costs O(K log K) besides the skipped old entries.
+    """
+    if current is None:
+      current = time.time()
+    heap = self._heap
+    states = self._states
+    results = []
+    candidates = [(heap[0], 0)] if heap else []
+    while candidates and len(results) < k:
+      (key, version, item), index = heapq.heappop(candidates)
+      state = states.get(item)
+      if state is not None and state[2] == version:
+        results.append((item, self._score(state[0], state[1], current)))
+      for child in (2 * index + 1, 2 * index + 2):
+        if child < len(heap):
+          heapq.heappush(candidates, (heap[child], child))
+    return results
+
+  def snapshot(self, path=None):
+    """Saves the index to the file, which is replaced atomically."""
+    path = path or self.snapshot_path
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+      cPickle.dump((self._log_anneal, self._score_stablizer, self._time_stablizer, self._epoch,
+                    dict((item, state[:2]) for item, state in self._states.iteritems())),
+                   f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, path)
+
+  def restore(self, path=None):
+    """Loads the index saved by snapshot."""
+    with open(path or self.snapshot_path, "rb") as f:
+      (self._log_anneal, self._score_stablizer, self._time_stablizer, self._epoch,
+       accumulators) = cPickle.load(f)
+    self._states = {}
+    for item, (sign, log_abs) in accumulators.iteritems():
+      self._version += 1
+      self._states[item] = (sign, log_abs, self._version)
+    self._compact()
@@ -0,0 +1,213 @@
+"""A hash table cache in shared memory, read by all the worker processes without any ipc.
+
+CacheStore lives in the heap of one process, so the memoization of a handler
+is duplicated in every SocketWorker, and lost when a worker restarts.
+SharedCache keeps the items in a shared mmap created before the workers are
+forked, so all of them, and the ones forked later, see the same items, the
+same as ApcCache for the php tier:
+
+  cache = SharedCache(capacity=65536, slot_size=1024)
+  server = SocketServer(port, make_handler(cache), ...)
+
+The table is set-associative: a key hashes into a bucket of ways slots, and
+every slot holds one item of up to slot_size bytes in place, so no allocator
+is involved.  Each bucket is guarded by a seqlock: a writer makes the bucket
+sequence odd while it changes the bucket and even again after, and a reader
+retries if the sequence was odd or moved while it read, so the reads take no
+lock at all.  The writers take the striped lock of the bucket, shared through
+fork.  A writer dying in a file backed table leaves its bucket odd, so the
+odd buckets are dropped when the table is opened again.
+When a bucket is full, the CLOCK hand of the bucket evicts the first slot
+not referenced since the hand last passed it, which approximates LRU.
+
+The hit / miss counters are kept per process in shared rows, and summed up
+by stats().
+"""
+
+import mmap
+import multiprocessing
+import os
+import struct
+import time
+import zlib
+
+_MAGIC = "ZSHCACH1"
+_HEADER = struct.Struct("<8sIII")  # magic, bucket_num, ways, slot_size
+_BUCKET_HEADER = struct.Struct("<IB3x")  # seq, clock hand
+_SLOT_HEADER = struct.Struct("<IHIIB")  # key_crc, key_len (0 for empty slot), value_len, valid_until, referenced
+_STAT_ROW = struct.Struct("<QQQQ")  # hits, misses, sets, evictions
+_STAT_ROW_NUM = 256
+_MAX_READ_RETRY_NUM = 64
+
+class SharedCache(object):
+  def __init__(self, capacity=65536, slot_size=1024, ways=8, lock_num=64, path=None):
+    """Initiate the shared cache, before forking the processes which share it.
+
+    Args:
+      capacity: Number of slots, rounded up to a multiple of ways.
+      slot_size: Bytes of each slot, which limits the size of key + value of an item.
+      ways: Number of slots per bucket, the keys of a bucket compete for them.
+      lock_num: Number of the striped locks serializing the writers.
+      path: The file backing the table, so that the items survive the server restarts;
+          default an anonymous mapping.
+    """
+    self._ways = ways
+    self._bucket_num = max(1, (capacity + ways - 1) / ways)
+    self._slot_size = slot_size
+    self._bucket_size = _BUCKET_HEADER.size + ways * slot_size
+    self._buckets_offset = _HEADER.size + _STAT_ROW_NUM * _STAT_ROW.size
+    size = self._buckets_offset + self._bucket_num * self._bucket_size
+    if path:
+      fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+      try:
+        if os.fstat(fd).st_size != size:
+          os.ftruncate(fd, 0)  # a table of another layout is dropped
+          os.ftruncate(fd, size)
+        self._mmap = mmap.mmap(fd, size, mmap.MAP_SHARED)
+      finally:
+        os.close(fd)
+    else:
+      self._mmap = mmap.mmap(-1, size, mmap.MAP_SHARED)
+    header = (_MAGIC, self._bucket_num, ways, slot_size)
+    if _HEADER.unpack_from(self._mmap, 0) != header:
+      self._mmap[:size] = "\0" * size
+      _HEADER.pack_into(self._mmap, 0, *header)
+    else:
+      self._repair()
+    self._locks = [multiprocessing.Lock() for _ in xrange(lock_num)]
+
+  def _repair(self):
+    """Drops the buckets left odd by the writers which died, whose slots may be torn, and makes them even."""
+    for bucket in xrange(self._buckets_offset, self._buckets_offset + self._bucket_num * self._bucket_size,
+                         self._bucket_size):
+      seq = _BUCKET_HEADER.unpack_from(self._mmap, bucket)[0]
+      if seq & 1:
+        self._mmap[bucket:bucket + self._bucket_size] = "\0" * self._bucket_size
+        _BUCKET_HEADER.pack_into(self._mmap, bucket, (seq + 1) & 0xffffffff, 0)
+
+  def _bucket(self, key):
+    """Returns (key_crc, offset of the bucket)."""
+    key_crc = zlib.crc32(key) & 0xffffffff
+    return key_crc, self._buckets_offset + (key_crc % self._bucket_num) * self._bucket_size
+
+  def _lock(self, bucket):
+    """Returns the writer lock of the bucket at the offset, the same for all the keys of the bucket."""
+    return self._locks[(bucket - self._buckets_offset) / self._bucket_size % len(self._locks)]
+
+  def _stat_offset(self):
+    return _HEADER.size + (os.getpid() % _STAT_ROW_NUM) * _STAT_ROW.size
+
+  def _count(self, field, num=1):
+    """Adds to a counter of the stat row of this process."""
+    offset = self._stat_offset() + field * 8
+    self._mmap[offset:offset + 8] = struct.pack("<Q", struct.unpack_from("<Q", self._mmap, offset)[0] + num)
+
+  def _find(self, key, key_crc, bucket):
+    """Returns the offset of the slot holding the key in the bucket, or None."""
+    for slot in xrange(bucket + _BUCKET_HEADER.size, bucket + self._bucket_size, self._slot_size):
+      slot_crc, key_len = struct.unpack_from("<IH", self._mmap, slot)
+      if slot_crc == key_crc and key_len == len(key):
+        start = slot + _SLOT_HEADER.size
+        if self._mmap[start:start + key_len] == key:
+          return slot
+    return None
+
+  def get(self, key, now=None):
+    """Returns the (value, valid_until) tuple of the item, or None if it's not found or expired.
+
+    Args:
+      key: Key of the item.
+      now: The current epoch time in seconds, default to time.time().
+    """
+    key_crc, bucket = self._bucket(key)
+    result = None
+    for _ in xrange(_MAX_READ_RETRY_NUM):
+      seq = _BUCKET_HEADER.unpack_from(self._mmap, bucket)[0]
+      if seq & 1:
+        continue  # a writer is changing the bucket
+      slot = self._find(key, key_crc, bucket)
+      if slot is not None:
+        _, key_len, value_len, valid_until, referenced = _SLOT_HEADER.unpack_from(self._mmap, slot)
+        if _SLOT_HEADER.size + key_len + value_len > self._slot_size:
+          continue  # torn read
+        start = slot + _SLOT_HEADER.size + key_len
+        value = self._mmap[start:start + value_len]
+      if _BUCKET_HEADER.unpack_from(self._mmap, bucket)[0] != seq:
+        continue  # torn read
+      if slot is not None and (not valid_until or valid_until >= (now or time.time())):
+        if not referenced:
+          self._mmap[slot + _SLOT_HEADER.size - 1] = "\1"  # a hint for CLOCK, racing writers only lose it
+        result = (value, valid_until)
+      break
+    self._count(0 if result else 1)
+    return result
+
+  def set(self, key, value, ttl=0, now=None):
+    """Sets the item, returns False if it's too large to be cached.
+
+    Args:
+      key: Key of the item, a non-empty byte string.
+      value: Value of the item, a byte string.
+      ttl: Seconds that the item will exist, 0 means persistent until evicted.
+      now: The current epoch time in seconds, default to time.time().
+    """
+    if not key or _SLOT_HEADER.size + len(key) + len(value) > self._slot_size:
+      return False
+    now = int(now or time.time())
+    valid_until = now + ttl if ttl else 0
+    key_crc, bucket = self._bucket(key)
+    evicted = 0
+    with self._lock(bucket):
+      seq, hand = _BUCKET_HEADER.unpack_from(self._mmap, bucket)
+      _BUCKET_HEADER.pack_into(self._mmap, bucket, (seq + 1) & 0xffffffff, hand)
+      slot = self._find(key, key_crc, bucket)
+      if slot is None:
+        slot, hand, evicted = self._evict(bucket, hand, now)
+      _SLOT_HEADER.pack_into(self._mmap, slot, key_crc, len(key), len(value), valid_until, 0)
+      start = slot + _SLOT_HEADER.size
+      self._mmap[start:start + len(key) + len(value)] = key + value
+      _BUCKET_HEADER.pack_into(self._mmap, bucket, (seq + 2) & 0xffffffff, hand)
+    self._count(2)
+    if evicted:
+      self._count(3)
+    return True
+
+  def _evict(self, bucket, hand, now):
+    """Picks the slot for a new item in the bucket, returns (slot, new hand, whether a live item is evicted)."""
+    slots = [bucket + _BUCKET_HEADER.size + way * self._slot_size for way in xrange(self._ways)]
+    for slot in slots:
+      _, key_len, _, valid_until, _ = _SLOT_HEADER.unpack_from(self._mmap, slot)
+      if not key_len or (valid_until and valid_until < now):
+        return slot, hand, False
+    while True:
+      slot = slots[hand]
+      hand = (hand + 1) % self._ways
+      if self._mmap[slot + _SLOT_HEADER.size - 1] == "\0":
+        return slot, hand, True
+      self._mmap[slot + _SLOT_HEADER.size - 1] = "\0"  # gets a second chance
+
+  def remove(self, key):
+    """Removes the item, returns False if it's not found."""
+    key_crc, bucket = self._bucket(key)
+    with self._lock(bucket):
+      slot = self._find(key, key_crc, bucket)
+      if slot is None:
+        return False
+      seq, hand = _BUCKET_HEADER.unpack_from(self._mmap, bucket)
+      _BUCKET_HEADER.pack_into(self._mmap, bucket, (seq + 1) & 0xffffffff, hand)
+      _SLOT_HEADER.pack_into(self._mmap, slot, 0, 0, 0, 0, 0)
+      _BUCKET_HEADER.pack_into(self._mmap, bucket, (seq + 2) & 0xffffffff, hand)
+    return True
+
+  def stats(self):
+    """Returns the statistics of this table, summed up over all the processes."""
+    totals = [0, 0, 0, 0]
+    for row in xrange(_STAT_ROW_NUM):
+      for field, value in enumerate(_STAT_ROW.unpack_from(self._mmap, _HEADER.size + row * _STAT_ROW.size)):
+        totals[field] += value
+    hits, misses, sets, evictions = totals
+    return {"capacity": self._bucket_num * self._ways, "hits": hits, "misses": misses,
+            "sets": sets, "evictions": evictions}
+
+  def close(self):
+    self._mmap.close()
@@ -0,0 +1,280 @@
+import functools
+import json
+import logging
+import struct
+import time
+import urllib
+from tornado import ioloop
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from socketserver import SocketServer
+
+"""The social fan-out server, which serves Zopt\\Social\\RpcAggregator.
+
+Zopt\\Social\\Aggregator queries the social providers one after another, so
+its latency is the sum of theirs.  This server queries the providers of a
+request concurrently on the worker's io loop, each within its own deadline,
+and answers once all of them are done or timed out: the latency is the
+slowest provider's, capped by its deadline.  The users of the providers which
+failed or timed out are reported as missed, like $missedSnuids in Aggregator.
+
+Request = | 1 byte op | 4 bytes request_id | json arguments |
+Response = | 1 byte op | 4 bytes request_id | 1 byte status | json result |
+  status: STATUS_OK, or STATUS_ERROR with the error message as the result.
+
+  OP_GET_USERS:   {snid: {"uids": [uid, ...], "token": ego token or null}}
+                  -> {"users": {snid: {uid: raw user blob}}, "missed": {snid: [uid, ...]}}
+  OP_GET_FRIENDS: {snid: {"uid": uid, "token": token or null, "offset": offset, "count": count or null}}
+                  -> {"friends": {snid: {uid: score}}, "missed": [snid, ...]}
+"""
+
+OP_GET_USERS = 1
+OP_GET_FRIENDS = 2
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+_HEADER = struct.Struct("<BI")
+_STATUS = struct.Struct("<B")
+
+class FacebookProvider(object):
+  """Fetches the raw user blobs and the friends from the facebook graph API, the same as Zopt\\Social\\Facebook\\Provider."""
+
+  USER_FIELDS = ("id", "name", "picture", "gender", "locale", "link", "username",
+                 "email", "hometown", "location", "education", "work")
+
+  def __init__(self, app_id=None, app_secret=None, graph_url="https://graph.facebook.com", max_batch=50, timeout=1.0):
+    """Initiate the provider.
+
+    Args:
+      app_id: The facebook application id, to fetch with the application token.
+      app_secret: The facebook application secret.
+      graph_url: The facebook graph API url.
+      max_batch: Maximum number of the requests in one batch, limited by facebook.
+      timeout: Seconds to wait for the provider.
+    """
+    self._app_token = "%s|%s" % (app_id, app_secret) if app_id and app_secret else None
+    self._graph_url = graph_url
+    self._max_batch = max_batch
+    self.timeout = timeout
+    self._http_client = None  # created in the worker process, on the worker's io loop
+
+  def _send_batch(self, requests, token, callback):
+    """Sends the batched requests concurrently in chunks of max_batch.
+
+    Args:
+      requests: The (request_id, relative_url) tuples of the GET requests.
+      token: The access token.
+      callback: The function called with {request_id: response body} of the succeeded requests.
+          Function fingerprint: callback(results)
+    """
+    if not self._http_client:
+      self._http_client = AsyncHTTPClient(io_loop=ioloop.IOLoop.instance())
+    results = {}
+    chunks = [requests[offset:offset + self._max_batch] for offset in xrange(0, len(requests), self._max_batch)]
+    remaining = [len(chunks)]
+    if not chunks:
+      callback(results)
+      return
+
+    def on_response(chunk, response):
+      if not response.error:
+        try:
+          for (request_id, _), result in zip(chunk, json.loads(response.body)):
+            if result and result.get("code") == 200:
+              results[request_id] = result["body"]
+        except (ValueError, TypeError, AttributeError):
+          logging.warning("Invalid facebook batch response: %r", response.body[:256])
+      remaining[0] -= 1
+      if not remaining[0]:
+        callback(results)
+
+    for chunk in chunks:
+      batch = json.dumps([{"method": "GET", "relative_url": url} for _, url in chunk])
+      request = HTTPRequest(self._graph_url, method="POST", request_timeout=self.timeout,
+                            body=urllib.urlencode({"access_token": token, "batch": batch}))
+      self._http_client.fetch(request, functools.partial(on_response, chunk))
+
+  def get_users(self, uids, token, callback):
+    """Fetches the raw user blobs, with the ego token then with the application token for the missed ones.
+
+    Args:
+      uids: The user ids.
+      token: The auth token of the user who inits the query, None to use the application token.
+      callback: The function called with {uid: raw user blob}.
+          Function fingerprint: callback(users)
+    """
+    fields = ",".join(self.USER_FIELDS)
+
+    def fetch(uids, token, callback):
+      self._send_batch([(uid, "/%s?fields=%s" % (uid, fields)) for uid in uids], token, callback)
+
+    def on_ego_users(users):
+      missed = [uid for uid in uids if uid not in users]
+      if not missed or not self._app_token:
+        callback(users)
+        return
+      fetch(missed, self._app_token, lambda app_users: callback(dict(app_users, **users)))
+
+    if token:
+      fetch(uids, token, on_ego_users)
+    elif self._app_token:
+      fetch(uids, self._app_token, callback)
+    else:
+      callback({})
+
+  def get_friends(self, uid, token, offset, count, callback):
+    """Fetches the friends of the user, all scored 0.0.
+
+    Args:
+      callback: The function called with {uid: score}, or None if the friends are not available.
+          Function fingerprint: callback(friends)
+    """
+    query = "/%s/friends?offset=%d" % (uid, offset)
+    if count is not None:
+      query += "&limit=%d" % count
+
+    def on_response(token, results):
+      body = results.get("friends")
+      if body is None:
+        if token != self._app_token and self._app_token:
+          self._send_batch([("friends", query)], self._app_token, functools.partial(on_response, self._app_token))
+        else:
+          callback(None)
+        return
+      try:
+        friends = dict((friend["id"], 0.0) for friend in json.loads(body)["data"])
+      except (ValueError, TypeError, KeyError):
+        friends = None
+      callback(friends)
+
+    token = token or self._app_token
+    if not token:
+      callback(None)
+      return
+    self._send_batch([("friends", query)], token, functools.partial(on_response, token))
+
+class _FanOut(object):
+  """The concurrent calls of one request to the providers, which answers once all are done or timed out."""
+
+  def __init__(self, snids, callback):
+    self._pending = set(snids)
+    self._timeouts = {}
+    self.results = {}  # snid -> result, the timed out providers are absent
+    self._callback = callback
+    if not self._pending:
+      callback(self)
+
+  def start(self, snid, timeout, call):
+    """Calls the provider, which gets call(done) with done(result) to report its result."""
+    io_loop = ioloop.IOLoop.instance()
+    self._timeouts[snid] = io_loop.add_timeout(time.time() + timeout, functools.partial(self._expire, snid))
+    try:
+      call(functools.partial(self._finish, snid))
+    except Exception:
+      logging.exception("Failed to call social provider %s", snid)
+      self._finish(snid, None)
+
+  def _expire(self, snid):
+    if snid in self._pending:
+      logging.warning("Social provider %s timed out", snid)
+    self._timeouts.pop(snid, None)
+    self._finish(snid, None)
+
+  def _finish(self, snid, result):
+    if snid not in self._pending:
+      return  # already timed out, or answered
+    self._pending.discard(snid)
+    timeout = self._timeouts.pop(snid, None)
+    if timeout is not None:
+      ioloop.IOLoop.instance().remove_timeout(timeout)
+    if result is not None:
+      self.results[snid] = result
+    if not self._pending:
+      self._callback(self)
+
+class SocialService(object):
+  """The payload handler of the workers."""
+
+  def __init__(self, providers):
+    """Initiate the service.
+
+    Args:
+      providers: The providers by their snid, e.g. {"1": FacebookProvider(...)}.
+    """
+    self._providers = providers
+
+  def _get_users(self, args, respond):
+    missed = {}
+    requests = {}
+    for snid, query in args.iteritems():
+      if snid in self._providers:
+        requests[snid] = query
+      else:
+        missed[snid] = query["uids"]
+
+    def on_done(fan_out):
+      users = {}
+      for snid, query in requests.iteritems():
+        snid_users = fan_out.results.get(snid, {})
+        users[snid] = snid_users
+        snid_missed = [uid for uid in query["uids"] if uid not in snid_users]
+        if snid_missed:
+          missed[snid] = snid_missed
+      respond(STATUS_OK, {"users": users, "missed": missed})
+
+    fan_out = _FanOut(requests, on_done)
+    for snid, query in requests.iteritems():
+      provider = self._providers[snid]
+      fan_out.start(snid, provider.timeout, functools.partial(provider.get_users, query["uids"], query.get("token")))
+
+  def _get_friends(self, args, respond):
+    requests = dict((snid, query) for snid, query in args.iteritems() if snid in self._providers)
+
+    def on_done(fan_out):
+      respond(STATUS_OK, {"friends": fan_out.results,
+                          "missed": [snid for snid in args if snid not in fan_out.results]})
+
+    fan_out = _FanOut(requests, on_done)
+    for snid, query in requests.iteritems():
+      provider = self._providers[snid]
+      fan_out.start(snid, provider.timeout, functools.partial(
+          provider.get_friends, query["uid"], query.get("token"), query.get("offset") or 0, query.get("count")))
+
+  def handle(self, payload, callback):
+    op, request_id = _HEADER.unpack_from(payload, 0)
+
+    def respond(status, result):
+      callback(_HEADER.pack(op, request_id) + _STATUS.pack(status) + json.dumps(result))
+
+    try:
+      args = json.loads(str(payload[_HEADER.size:]) or "{}")
+      if op == OP_GET_USERS:
+        self._get_users(args, respond)
+      elif op == OP_GET_FRIENDS:
+        self._get_friends(args, respond)
+      else:
+        respond(STATUS_ERROR, "Unknown op: %d." % op)
+    except Exception as e:
+      logging.exception("Failed to serve op %d", op)
+      respond(STATUS_ERROR, "%s: %s" % (e.__class__.__name__, e))
+
+class SocialServer(SocketServer):
+  """The social fan-out server."""
+
+  def __init__(self, port, providers, **kwargs):
+    """Initiate the social server.
+
+    Args:
+      port: The port to listen.
+      providers: The providers by their snid, see SocialService.
+      kwargs: The other arguments of SocketServer.
+    """
+    SocketServer.__init__(self, port, SocialService(providers).handle, **kwargs)
+
+def main():
+  # only for test, with the application token only.
+  server = SocialServer(20005, {"1": FacebookProvider()}, idle_timeout = 60)
+  server.start()
+
+if __name__ == '__main__':
+  main()
@@ -1,19 +1,44 @@
+import _multiprocessing
 import errno
+import logging
+import os
 import socket
 import struct
+import time
 import functools
 from tornado import ioloop, iostream
 from multiprocessing import cpu_count, Process
-from channel import NetworkChannel, IpcChannel
+from channel import NetworkChannel, IpcChannel, CONTROL_CANCEL, CONTROL_HANDOFF, CONTROL_CLOSED, CONTROL_CREDIT, \
+    CONTROL_DEQUEUED, CONTROL_OVERLOADED, OVERLOADED_PAYLOAD_HEAD, PRIORITY_NORMAL, CHUNK_LAST, CHUNK_ABORTED, LENGTH_MASK, pack_cancel, pack_control
+from timerwheel import TimerWheel
+from responsecache import ResponseCache
+from scheduler import WeightedFairQueue
 from collections import deque
 
 """RpcServer in this module."""
 
-def get_address_signature(address):
-  """Generates 6 bytes signature for a given socket."""
-  packed_ip = socket.inet_aton(address[0])
-  packed_sock_id = struct.pack("4sH", packed_ip, address[1])
-  return packed_sock_id
+# The addr_id of a connection is the 6 bytes big-endian serial number of its
+# accept, which is never reused (unlike the ip and port of the peer), so that
+# a late response or CONTROL_CANCEL can't reach a later connection.
+_CONNECTION_ID = struct.Struct(">Q")
+
+def pack_connection_id(serial):
+  """Returns the 6 bytes addr_id of the connection of the given serial number."""
+  return _CONNECTION_ID.pack(serial)[2:]
+
+class _HandedOffConnection(object):
+  """Stands for a connection served by a worker in the fd handoff mode, so that it's still counted."""
+
+  def __init__(self, worker_id):
+    self.worker_id = worker_id
+
+class _Download(object):
+  """The streamed responses of a connection being sent, and the responses queued behind them."""
+
+  def __init__(self, iterator):
+    self.iterator = iterator  # the chunks of the current streamed response, None once it's sent
+    self.in_flight = 0  # chunks not credited yet
+    self.queue = deque()  # the following responses, payloads or iterables of chunks
 
 class SocketServer(object):
   """This class implements a typical non-blocking, async socket server"""
@@ -22,7 +47,81 @@ class SocketServer(object):
                io_loop = ioloop.IOLoop.instance(),
                max_connection_num = 1024,
                ip_addr = "localhost",
-               worker_num = 2 * cpu_count()):
+               worker_num = 2 * cpu_count(),
+               idle_timeout = None,
+               read_timeout = None,
+               write_timeout = None,
+               resume_connection_num = None,
+               max_accept_num_per_loop = 64,
+               max_connection_num_per_ip = None,
+               fd_handoff = False,
+               response_cache_key = None,
+               response_cache_ttl = 1,
+               response_cache_bytes = 67108864,
+               compressor = None,
+               stream_handler = None,
+               stream_window = 4,
+               priority_weights = None,
+               dispatch_window = 8,
+               max_queued_requests = 65536,
+               limiter = None):
+    """Initiate the socket server.
+
+    Args:
+      max_connection_num: Maximum number of live connections.  The server stops
+          accepting connections when reaching it.
+      resume_connection_num: The server resumes accepting connections when the
+          live connections drop to this number; default 90% of max_connection_num.
+      max_accept_num_per_loop: Maximum number of connections accepted in one io
+          loop iteration, so that a connection flood doesn't starve the others.
+      max_connection_num_per_ip: Maximum number of live connections from one ip
+          address, None for no limit.
+      idle_timeout: Seconds a connection could stay without any traffic, None for no limit.
+      read_timeout: Seconds a request could take to be fully received, None for no limit.
+      write_timeout: Seconds a response could wait to be sent out, None for no limit.
+      fd_handoff: Passes each accepted connection to a worker, which reads and
+          writes it directly, so that the requests and responses don't cross
+          the acceptor.  The worker is chosen by _choose_worker.  Servers
+          routing the requests in the acceptor, e.g. CacheServer, must not
+          enable it, as their _inbound_callback / _outbound_callback are bypassed.
+      response_cache_key: The key policy of the response cache, e.g.
+          responsecache.RequestIdCacheKey(read_only_ops), which enables the
+          acceptor to answer the repeated requests from its cache, and to
+          collapse the identical requests in flight into one worker call, see
+          responsecache.  None disables it; it doesn't work with fd_handoff.
+      response_cache_ttl: Seconds that a response is cached.
+      response_cache_bytes: Maximum total size of the cached responses.
+      compressor: The compression.Compressor of the responses, which compresses
+          the responses to the clients that accept its codec.  None sends all
+          the responses raw; the compressed requests are decoded anyway.
+      stream_handler: The handler of the streamed requests, whose chunks are
+          passed to a worker as they arrive, so that a request of any size
+          takes bounded memory.  It's called at the first chunk of a request,
+          and returns the consumer of its chunks, which is called with
+          chunk None if the client aborted the request or disconnected.
+          None closes the connections sending streamed requests.
+          Function fingerprint: stream_handler(callback) -> consumer(chunk, last),
+          callback as of payload_handler
+      stream_window: Maximum number of chunks of a stream not consumed yet by the
+          other end; the sender waits for their credits before sending more.
+      priority_weights: The weights of the priority classes of the requests,
+          e.g. {PRIORITY_INTERACTIVE: 8, PRIORITY_NORMAL: 4, PRIORITY_BATCH: 1},
+          which makes the requests wait in the acceptor, in a queue per class,
+          and pass to _inbound_callback in the weighted fair order as the
+          workers take them in, see scheduler.py.  None passes the requests to
+          _inbound_callback as they arrive.  It doesn't work with fd_handoff.
+          The control messages are never queued.
+      dispatch_window: Maximum average number of requests waiting in the queue of a worker,
+          with priority_weights.
+      max_queued_requests: Maximum number of requests of a class waiting in the acceptor,
+          the requests beyond are shed.
+      limiter: The limiter.AdaptiveLimiter of the requests waiting in the worker
+          queues, which replaces dispatch_window with a limit adjusted by their
+          queueing delay.  The requests beyond the limit wait in the acceptor,
+          in one class unless priority_weights is given, and the ones waiting
+          longer than its max_queue_delay are shed.  It doesn't work with fd_handoff.
+          A shed request is answered at once by CONTROL_OVERLOADED.
+    """
     # prepares socket
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -30,42 +129,252 @@ class SocketServer(object):
     sock.bind((ip_addr, port))
     self._listen_sock = sock
     self._max_connection_num = max_connection_num
+    if resume_connection_num is None:
+      resume_connection_num = max_connection_num * 9 / 10
+    self._resume_connection_num = resume_connection_num
+    self._max_accept_num_per_loop = max_accept_num_per_loop
+    self._max_connection_num_per_ip = max_connection_num_per_ip
+    self._ip_connection_nums = {}  # packed ip -> number of its live connections
+    self._connection_ips = {}  # addr_id -> packed ip of the connection
+    self._next_connection_serial = 1
+    self._accepting = False
+    # the channel speaking the client protocol, called as NetworkChannel(sock, data_callback, control_callback, close_callback, io_loop).
+    self._net_channel_class = NetworkChannel
+    self._compressor = compressor
+    self._stream_handler = stream_handler
+    self._stream_window = stream_window
+    self._uploads = {}  # addr_id -> [worker_id of its streamed request or None after the last chunk, chunks not credited]
+    self._request_queue = None
+    if (priority_weights or limiter) and not fd_handoff:
+      self._request_queue = WeightedFairQueue(priority_weights or {PRIORITY_NORMAL: 1}, max_queued_requests)
+    self._dispatch_window = dispatch_window
+    self._limiter = limiter
+    self._worker_backlogs = {}  # worker_id -> number of requests sent to it but not taken from its queue yet
+    self._backlog = 0  # total of _worker_backlogs
+    self._dispatch_times = {}  # worker_id -> the dispatch times of its backlog in order, with limiter only
+    self.shed_num = 0
     self._net_channels = {}
+    self._dispatched_workers = {}  # addr_id -> set of worker_ids which got its requests
     # prepares IO loop
     self._io_loop = io_loop
+    self._timeouts = (idle_timeout, read_timeout, write_timeout)
+    self._timer_wheel = TimerWheel(io_loop) if any(self._timeouts) else None
+    self._response_cache = None
+    if response_cache_key is not None and not fd_handoff:
+      timer_wheel = self._timer_wheel if self._timer_wheel is not None else TimerWheel(io_loop)
+      self._response_cache = ResponseCache(response_cache_key, response_cache_ttl, response_cache_bytes,
+                                           timer_wheel=timer_wheel, abandon_callback=self._shed)
     # prepares process pool
     self._ipc_channels = {}
+    self._handoff_sockets = {}  # worker_id -> the socket passing the connection fds, fd_handoff mode only
     self._worker_processes = {}
     self.__next_worker_queue = deque()
     for worker_id in xrange(worker_num):
       server_connection, worker_connection = socket.socketpair()
       ipc_channel = IpcChannel(server_connection, worker_id,
-                               self._outbound_callback, None,
+                               self._outbound_callback, functools.partial(self._worker_control_callback, worker_id),
                                functools.partial(self.destory_worker,
                                                  worker_id), self._io_loop)
+      ipc_channel.set_chunk_callback(functools.partial(self._outbound_chunk, worker_id))
       self._ipc_channels[worker_id] = ipc_channel
-      process = SocketWorker(worker_connection, worker_id, payload_handler)
+      handoff_connection = None
+      if fd_handoff:
+        # SCM_RIGHTS needs its own socket, as the fds travel with a dummy byte, which would break the ipc frames.
+        self._handoff_sockets[worker_id], handoff_connection = socket.socketpair()
+        self._handoff_sockets[worker_id].setblocking(False)
+      process = SocketWorker(worker_connection, worker_id, payload_handler, handoff_connection, self._timeouts,
+                             stream_handler, stream_window, self._request_queue is not None)
+      self._worker_backlogs[worker_id] = 0
+      self._dispatch_times[worker_id] = deque()
       self._worker_processes[worker_id] = process
       self.__next_worker_queue.append(worker_id)
 
-  def _inbound_callback(self, addr_id, payload):
+  def _choose_worker(self, addr_id):
+    """Returns the worker_id serving the next request, or the handed-off connection, of addr_id."""
     # round-robin selection
     worker_id = self.__next_worker_queue.popleft()
     self.__next_worker_queue.append(worker_id)
+    return worker_id
+
+  def _inbound_callback(self, addr_id, buf, offset, num_bytes, deadline):
+    if deadline is not None and deadline < time.time():
+      return  # drops the request as the client no longer waits for it.
+    if self._response_cache is not None:
+      cached = self._response_cache.lookup(addr_id, buf, offset, num_bytes)
+      if cached is False:
+        self._shed(addr_id, buf[offset:offset + num_bytes])
+        return
+      if cached is not None:
+        response, call_id = cached
+        if response is not None:
+          self._outbound_callback(addr_id, response, 0, len(response), None)
+        elif call_id is not None:
+          # the call answers all the waiting clients, so it isn't bound to the deadline of any one of them.
+          worker_id = self._choose_worker(addr_id)
+          self._ipc_channels[worker_id].write(call_id, buf, offset, num_bytes, None)
+          self._response_cache.dispatched(call_id, worker_id)
+          self._count_dispatch(worker_id)
+        return
+    self._send_to_worker(self._choose_worker(addr_id), addr_id, buf, offset, num_bytes, deadline)
+
+  def _send_to_worker(self, worker_id, addr_id, buf, offset, num_bytes, deadline, chunk_flags=None):
+    """Sends the request, or a chunk of the streamed request, of the given connection to the worker."""
     ipc_channel = self._ipc_channels[worker_id]
     # send message
-    ipc_channel.write(addr_id, payload)
+    ipc_channel.write(addr_id, buf, offset, num_bytes, deadline, 0, chunk_flags)
+    self._dispatched_workers[addr_id].add(worker_id)
+    if chunk_flags is None:
+      self._count_dispatch(worker_id)
+
+  def _count_dispatch(self, worker_id):
+    if self._request_queue is not None:
+      self._worker_backlogs[worker_id] += 1
+      self._backlog += 1
+      if self._limiter:
+        self._dispatch_times[worker_id].append(time.time())
+        self._limiter.record_backlog(self._backlog)
+
+  def _dispatch_limit(self):
+    """Returns the number of requests allowed to wait in the worker queues."""
+    if self._limiter:
+      return self._limiter.limit
+    return self._dispatch_window * len(self._ipc_channels)
+
+  def _queue_request(self, addr_id, buf, offset, num_bytes, deadline):
+    """Queues the request by its priority class, or passes it on at once if the workers have room for it."""
+    if not self._request_queue and self._backlog < self._dispatch_limit():
+      self._inbound_callback(addr_id, buf, offset, num_bytes, deadline)
+      return
+    now = time.time()
+    payload = bytes(buf[offset:offset + num_bytes])
+    # the channels without priority classes, e.g. HttpChannel, queue all their requests as normal.
+    priority = getattr(self._net_channels[addr_id], "priority", PRIORITY_NORMAL)
+    if not self._request_queue.push(priority, (addr_id, payload, deadline, now)):
+      self._shed(addr_id, payload)
+    if self._limiter:
+      queued_before = now - self._limiter.max_queue_delay
+      for addr_id, payload, _, _ in self._request_queue.drop_heads(lambda request: request[3] < queued_before):
+        self._shed(addr_id, payload)
+
+  def _shed(self, addr_id, payload):
+    """Answers the request with CONTROL_OVERLOADED instead of serving it."""
+    self.shed_num += 1
+    if addr_id in self._net_channels:
+      msg = bytearray([CONTROL_OVERLOADED]) + payload[:OVERLOADED_PAYLOAD_HEAD]
+      self._net_channels[addr_id].write(msg, 0, len(msg), False)
+
+  def _dispatch_queued(self):
+    """Passes the queued requests on, in the weighted fair order, while the workers have room for them."""
+    queued_before = time.time() - self._limiter.max_queue_delay if self._limiter else 0
+    while self._request_queue and self._backlog < self._dispatch_limit():
+      addr_id, payload, deadline, queued_at = self._request_queue.pop()
+      if addr_id not in self._net_channels:
+        continue
+      if queued_at < queued_before:
+        self._shed(addr_id, payload)
+        continue
+      self._inbound_callback(addr_id, payload, 0, len(payload), deadline)
+
+  def _worker_dequeued(self, worker_id, count):
+    """The worker took count requests from its queue."""
+    count = min(count, self._worker_backlogs.get(worker_id, 0))
+    self._worker_backlogs[worker_id] -= count
+    self._backlog -= count
+    if self._limiter:
+      # the worker takes its requests in order, except the cancelled ones which count as taken at once.
+      now = time.time()
+      dispatch_times = self._dispatch_times[worker_id]
+      for _ in xrange(count):
+        self._limiter.sample(now - dispatch_times.popleft(), now)
+    self._dispatch_queued()
+
+  def _inbound_chunk(self, addr_id, buf, offset, num_bytes, deadline, chunk_flags):
+    """Passes a chunk of a streamed request to the worker of its first chunk."""
+    upload = self._uploads.get(addr_id)
+    if upload is None:
+      upload = self._uploads[addr_id] = [None, 0]
+    if upload[0] is None:
+      upload[0] = self._choose_worker(addr_id)
+    if upload[0] not in self._ipc_channels:
+      self._net_channels[addr_id].close()  # the worker died in the middle of the request
+      return
+    self._send_to_worker(upload[0], addr_id, buf, offset, num_bytes, deadline, chunk_flags)
+    upload[1] += 1
+    if chunk_flags & CHUNK_LAST:
+      upload[0] = None
+    if upload[1] >= self._stream_window:
+      self._net_channels[addr_id].pause_reading()
+
+  def _upload_credit(self, addr_id):
+    """A worker consumed a chunk of the streamed requests of addr_id."""
+    upload = self._uploads.get(addr_id)
+    if upload is None:
+      return
+    upload[1] -= 1
+    if not upload[1] and upload[0] is None:
+      del self._uploads[addr_id]
+    if upload[1] < self._stream_window and addr_id in self._net_channels:
+      self._net_channels[addr_id].resume_reading()
+
+  def _outbound_chunk(self, worker_id, addr_id, buf, offset, num_bytes, deadline, chunk_flags):
+    """Passes a chunk of a streamed response to the client, and credits the worker once it's sent out."""
+    net_channel = self._net_channels.get(addr_id)
+    if net_channel is None:
+      # the response started after the connection closed, so the worker missed the cancel message.
+      if worker_id in self._ipc_channels:
+        cancel_msg = pack_cancel(addr_id)
+        self._ipc_channels[worker_id].write_control(cancel_msg, 0, len(cancel_msg))
+      return
+    net_channel.write(buf, offset, num_bytes, callback=functools.partial(self._send_credit, worker_id, addr_id),
+                      chunk_flags=chunk_flags)
+
+  def _send_credit(self, worker_id, addr_id):
+    if worker_id in self._ipc_channels:
+      msg = pack_control(CONTROL_CREDIT, addr_id)
+      self._ipc_channels[worker_id].write_control(msg, 0, len(msg))
 
-  def _outbound_callback(self, addr_id, payload):
+  def _outbound_callback(self, addr_id, buf, offset, num_bytes, deadline):
+    if self._response_cache is not None and self._response_cache.is_call(addr_id):
+      for waiter_addr_id, response in self._response_cache.complete(addr_id, buf, offset, num_bytes):
+        self._outbound_callback(waiter_addr_id, response, 0, len(response), None)
+      return
     if addr_id not in self._net_channels:
       return  # discards the response if the sock already closed.
     net_channel = self._net_channels[addr_id]
     # send message
-    net_channel.write(payload)
+    net_channel.write(buf, offset, num_bytes)
+
+  def _worker_control_callback(self, worker_id, buf, offset, num_bytes):
+    if buf[offset] == CONTROL_CLOSED:
+      self.close_net_channel(bytes(buf[offset + 1:offset + 7]))
+    elif buf[offset] == CONTROL_CREDIT:
+      self._upload_credit(bytes(buf[offset + 1:offset + 7]))
+    elif buf[offset] == CONTROL_DEQUEUED:
+      self._worker_dequeued(worker_id, struct.unpack_from("<I", buf, offset + 1)[0])
+
+  def _hand_off(self, net_connection, addr_id):
+    """Passes the accepted connection to a worker, which then owns it."""
+    worker_id = self._choose_worker(addr_id)
+    self._net_channels[addr_id] = _HandedOffConnection(worker_id)
+    self._dispatched_workers[addr_id] = set()
+    try:
+      _multiprocessing.sendfd(self._handoff_sockets[worker_id].fileno(), net_connection.fileno())
+    except OSError as e:
+      # the worker doesn't keep up with the handoffs.
+      logging.warning("Failed to hand off connection to worker %d: %s", worker_id, e)
+      self.close_net_channel(addr_id)
+    else:
+      msg = pack_control(CONTROL_HANDOFF, addr_id)
+      self._ipc_channels[worker_id].write_control(msg, 0, len(msg))
+    net_connection.close()  # the worker holds its own copy of the fd
 
   def _connection_ready(self, fd, events):
     """Accepts cominng connection requests."""
-    while True:
+    for _ in xrange(self._max_accept_num_per_loop):
+      if len(self._net_channels) >= self._max_connection_num:
+        # leaves the further connections in the listen backlog until some close.
+        self._stop_accepting()
+        return
       try:
         net_connection, addr = self._listen_sock.accept()
       except socket.error as e:
@@ -73,19 +382,53 @@ class SocketServer(object):
           raise
         return
       net_connection.setblocking(0)
-      addr_id = get_address_signature(addr)
-      self._net_channels[addr_id] = NetworkChannel(net_connection,
-                                                   functools.partial(self._inbound_callback,
-                                                                     addr_id),
-                                                   None,
-                                                   functools.partial(self.close_net_channel,
-                                                                     addr_id),
-                                                   self._io_loop)
-      self._net_channels[addr_id].start_read()
+      ip = socket.inet_aton(addr[0])
+      ip_connection_num = self._ip_connection_nums.get(ip, 0)
+      if self._max_connection_num_per_ip and ip_connection_num >= self._max_connection_num_per_ip:
+        logging.warning("Refused connection from %s: too many connections", addr[0])
+        net_connection.close()
+        continue
+      self._ip_connection_nums[ip] = ip_connection_num + 1
+      addr_id = pack_connection_id(self._next_connection_serial)
+      self._next_connection_serial += 1
+      self._connection_ips[addr_id] = ip
+      if self._handoff_sockets:
+        self._hand_off(net_connection, addr_id)
+        continue
+      inbound_callback = self._inbound_callback if self._request_queue is None else self._queue_request
+      self._net_channels[addr_id] = self._net_channel_class(net_connection,
+                                                            functools.partial(inbound_callback, addr_id),
+                                                            None,
+                                                            functools.partial(self.close_net_channel,
+                                                                              addr_id),
+                                                            self._io_loop)
+      self._dispatched_workers[addr_id] = set()
+      if self._timer_wheel is not None:
+        self._net_channels[addr_id].set_timeouts(self._timer_wheel, *self._timeouts)
+      if self._compressor:
+        self._net_channels[addr_id].set_compressor(self._compressor)
+      if self._stream_handler:
+        self._net_channels[addr_id].set_chunk_callback(functools.partial(self._inbound_chunk, addr_id))
+      self._net_channels[addr_id].read()
 
   def close_net_channel(self, addr_id):
     if addr_id in self._net_channels:
       del self._net_channels[addr_id]
+      ip = self._connection_ips.pop(addr_id)
+      self._ip_connection_nums[ip] -= 1
+      if not self._ip_connection_nums[ip]:
+        del self._ip_connection_nums[ip]
+      if not self._accepting and len(self._net_channels) <= self._resume_connection_num:
+        self._start_accepting()
+    self._uploads.pop(addr_id, None)
+    # cancels the requests still queued in workers for this closed connection.
+    worker_ids = self._dispatched_workers.pop(addr_id, ())
+    if not worker_ids:
+      return
+    cancel_msg = pack_cancel(addr_id)
+    for worker_id in worker_ids:
+      if worker_id in self._ipc_channels:
+        self._ipc_channels[worker_id].write_control(cancel_msg, 0, len(cancel_msg))
 
   def destory_worker(self, worker_id):
     if worker_id in self._worker_processes:
@@ -94,11 +437,30 @@ class SocketServer(object):
     if worker_id in self._ipc_channels:
       self._ipc_channels[worker_id].close()
       del self._ipc_channels[worker_id]
+    if worker_id in self._handoff_sockets:
+      self._handoff_sockets.pop(worker_id).close()
+      # the connections handed off to the worker are gone with it.
+      for addr_id, net_channel in self._net_channels.items():
+        if isinstance(net_channel, _HandedOffConnection) and net_channel.worker_id == worker_id:
+          self.close_net_channel(addr_id)
     try:
       self.__next_worker_queue.remove(worker_id)
     except ValueError:
       # just ignore it
       pass
+    self._backlog -= self._worker_backlogs.pop(worker_id, 0)
+    self._dispatch_times.pop(worker_id, None)
+    if self._response_cache is not None:
+      self._response_cache.abandon_worker(worker_id)  # sheds the requests waiting for its calls
+
+  def _start_accepting(self):
+    self._accepting = True
+    self._io_loop.add_handler(self._listen_sock.fileno(),
+                              self._connection_ready, ioloop.IOLoop.READ)
+
+  def _stop_accepting(self):
+    self._accepting = False
+    self._io_loop.remove_handler(self._listen_sock.fileno())
 
   def start(self):
     #TODO: quit gracefully
@@ -106,29 +468,80 @@ class SocketServer(object):
     self._listen_sock.listen(self._max_connection_num)
     # starts worker processes pool
     for worker_process in self._worker_processes.itervalues():
+      worker_process.net_channel_class = self._net_channel_class  # could be replaced by the subclasses after __init__
+      worker_process.compressor = self._compressor
       worker_process.start()
     # starts ipc channel
     for ipc_channel in self._ipc_channels.itervalues():
-      ipc_channel.start_read()
+      ipc_channel.read()
     # starts io_loop
-    self._io_loop.add_handler(self._listen_sock.fileno(),
-                              self._connection_ready, ioloop.IOLoop.READ)
+    self._start_accepting()
     self._io_loop.start()
 
 class SocketWorker(Process):
   """This class implements the worker process for socket server."""
 
-  def __init__(self, connection, worker_id, payload_handler):
+  def __init__(self, connection, worker_id, payload_handler, handoff_connection=None, timeouts=(None, None, None),
+               stream_handler=None, stream_window=4, report_dequeued=False):
+    """Initiate the worker.
+
+    Args:
+      connection: The worker end of the ipc socket pair.
+      worker_id: The id of this worker.
+      payload_handler: The function serving the requests.
+          Function fingerprint: payload_handler(payload, callback), and callback(result)
+          result is the response payload, or an iterable (e.g. a generator) of
+          the chunks of a streamed response, which are pulled as the client
+          takes them in.
+      handoff_connection: The worker end of the socket pair passing the connection fds, None unless in fd handoff mode.
+      timeouts: The (idle_timeout, read_timeout, write_timeout) of the handed-off connections.
+      stream_handler: The handler of the streamed requests, see SocketServer.
+      stream_window: Maximum number of chunks of a streamed response not taken by the client yet.
+      report_dequeued: Reports the number of requests taken from the queue after each batch,
+          for the weighted fair queuing of the acceptor.
+    """
     Process.__init__(self)
     self._io_loop = ioloop.IOLoop()
     self._payload_handler = payload_handler
     self._ipc_channel = IpcChannel(connection, worker_id,
-                                   self._inbound_callback, None,
+                                   self._inbound_callback,
+                                   self._control_callback,
                                    self.stop, self._io_loop)
+    self._ipc_channel.set_chunk_callback(self._inbound_chunk)
     self._worker_id = worker_id
+    self._stream_handler = stream_handler
+    self._stream_window = stream_window
+    self._report_dequeued = report_dequeued
+    self._upload_consumers = {}  # addr_id -> the consumer of its streamed request being received
+    self._downloads = {}  # addr_id -> its _Download
+    # requests are queued, and run at most max_batch_size per io loop iteration
+    # with the ipc channel read in between, so that the cancel messages read
+    # meanwhile still drop the queued requests of the closed connections.
+    self._pending_requests = deque()
+    self.max_batch_size = 64
+    # fd handoff mode
+    self._handoff_connection = handoff_connection
+    self._timeouts = timeouts
+    self._timer_wheel = None
+    self.net_channel_class = NetworkChannel
+    self.compressor = None
+    # called with the addr_id of a connection which is gone, after its requests are cancelled,
+    # so that the payload handler may release the state it keeps for the connection.
+    self.close_handler = None
+    self._net_channels = {}  # addr_id -> the channel of the handed-off connection
+    self._handoff_fds = deque()  # the received fds, waiting for their CONTROL_HANDOFF
+    self._handoff_addr_ids = deque()  # the received CONTROL_HANDOFF, waiting for their fds
 
   def run(self):
-    self._ipc_channel.start_read()
+    # the handlers running in this process get the worker's loop from IOLoop.instance(),
+    # instead of the server's one inherited through fork.
+    ioloop.IOLoop._instance = self._io_loop
+    self._ipc_channel.read()
+    if self._handoff_connection:
+      if any(self._timeouts):
+        self._timer_wheel = TimerWheel(self._io_loop)
+      self._handoff_connection.setblocking(False)
+      self._io_loop.add_handler(self._handoff_connection.fileno(), self._handle_handoff, ioloop.IOLoop.READ)
     self._io_loop.start()
 
   def stop(self):
@@ -136,11 +549,188 @@ class SocketWorker(Process):
     self._ipc_channel.close()
 
   def payload_callback(self, addr_id, result):
-    self._ipc_channel.write(addr_id, result)
+    if not isinstance(result, (basestring, bytearray)):
+      self._queue_response(addr_id, iter(result))
+      return
+    if addr_id in self._downloads:
+      self._queue_response(addr_id, result)  # keeps the order behind the streamed responses
+      return
+    self._write_response(addr_id, result)
+
+  def _write_response(self, addr_id, result, chunk_flags=None):
+    if self._handoff_connection:
+      if addr_id in self._net_channels:
+        credit = 0 if chunk_flags is None else functools.partial(self._download_credit, addr_id)
+        self._net_channels[addr_id].write(result, 0, len(result), callback=credit, chunk_flags=chunk_flags)
+      elif chunk_flags is not None:
+        self._cancel_requests(addr_id)  # no credit would ever come
+      return
+    self._ipc_channel.write(addr_id, result, 0, len(result), None, 0, chunk_flags)
+
+  def _queue_response(self, addr_id, response):
+    download = self._downloads.get(addr_id)
+    if download is None:
+      self._downloads[addr_id] = download = _Download(None)
+    download.queue.append(response)
+    self._pump_download(addr_id)
+
+  def _download_credit(self, addr_id):
+    """The client took a chunk of the streamed responses of addr_id."""
+    download = self._downloads.get(addr_id)
+    if download is not None:
+      download.in_flight -= 1
+      self._pump_download(addr_id)
+
+  def _pump_download(self, addr_id):
+    """Sends the responses of addr_id until the window of the streamed responses is full."""
+    download = self._downloads[addr_id]
+    while download.in_flight < self._stream_window:
+      if download.iterator is None:
+        if not download.queue:
+          if not download.in_flight:
+            del self._downloads[addr_id]  # the credits in flight would miscount the next streamed response
+          return
+        response = download.queue.popleft()
+        if isinstance(response, (basestring, bytearray)):
+          self._write_response(addr_id, response)
+        else:
+          download.iterator = response
+        continue
+      try:
+        chunk = next(download.iterator)
+        if len(chunk) > LENGTH_MASK:
+          raise ValueError("Chunk of %d bytes is too large" % len(chunk))
+        chunk_flags = 0
+      except StopIteration:
+        chunk, chunk_flags = "", CHUNK_LAST
+      except Exception:
+        logging.exception("Failed to produce the streamed response")
+        chunk, chunk_flags = "", CHUNK_LAST | CHUNK_ABORTED
+      if chunk_flags:
+        download.iterator = None
+      download.in_flight += 1
+      self._write_response(addr_id, chunk, chunk_flags)
+      if self._downloads.get(addr_id) is not download:
+        return  # cancelled
+
+  def _inbound_chunk(self, addr_id, buf, offset, num_bytes, deadline, chunk_flags):
+    """Passes a chunk of a streamed request to its consumer, and credits the acceptor."""
+    consumer = self._upload_consumers.get(addr_id)
+    if consumer is None:
+      consumer = self._stream_handler(functools.partial(self.payload_callback, addr_id))
+      self._upload_consumers[addr_id] = consumer
+    last = bool(chunk_flags & CHUNK_LAST)
+    if last:
+      del self._upload_consumers[addr_id]
+    try:
+      consumer(None if chunk_flags & CHUNK_ABORTED else bytes(buf[offset:offset + num_bytes]), last)
+    except Exception:
+      logging.exception("Failed to consume the streamed request")
+      if not last:
+        self._upload_consumers[addr_id] = lambda chunk, last: None  # drops the rest of the request
+    if not self._handoff_connection:
+      msg = pack_control(CONTROL_CREDIT, addr_id)
+      self._ipc_channel.write_control(msg, 0, len(msg))
+
+  def _handle_handoff(self, fd, events):
+    """Receives the fds of the handed-off connections."""
+    while True:
+      try:
+        self._handoff_fds.append(_multiprocessing.recvfd(fd))
+      except OSError as e:
+        if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
+          raise
+        break
+      except RuntimeError:
+        # the acceptor closed its end.
+        self._io_loop.remove_handler(fd)
+        break
+    self._adopt_connections()
+
+  def _adopt_connections(self):
+    """Serves the handed-off connections whose fd and addr_id both arrived."""
+    while self._handoff_fds and self._handoff_addr_ids:
+      fd = self._handoff_fds.popleft()
+      addr_id = self._handoff_addr_ids.popleft()
+      net_connection = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+      os.close(fd)  # fromfd duplicates it
+      net_connection.setblocking(0)
+      net_channel = self.net_channel_class(net_connection,
+                                           functools.partial(self._inbound_callback, addr_id),
+                                           None,
+                                           functools.partial(self._close_net_channel, addr_id),
+                                           self._io_loop)
+      self._net_channels[addr_id] = net_channel
+      if self._timer_wheel is not None:
+        net_channel.set_timeouts(self._timer_wheel, *self._timeouts)
+      if self.compressor:
+        net_channel.set_compressor(self.compressor)
+      if self._stream_handler:
+        net_channel.set_chunk_callback(functools.partial(self._inbound_chunk, addr_id))
+      net_channel.read()
+
+  def _close_net_channel(self, addr_id):
+    if addr_id not in self._net_channels:
+      return
+    del self._net_channels[addr_id]
+    self._cancel_requests(addr_id)
+    msg = pack_control(CONTROL_CLOSED, addr_id)
+    self._ipc_channel.write_control(msg, 0, len(msg))
+
+  def _send_dequeued(self, count):
+    if self._report_dequeued and count:
+      msg = bytearray(struct.pack("<BI", CONTROL_DEQUEUED, count))
+      self._ipc_channel.write_control(msg, 0, len(msg))
+
+  def _cancel_requests(self, addr_id):
+    num = len(self._pending_requests)
+    self._pending_requests = deque(request for request in self._pending_requests
+                                   if request[0] != addr_id)
+    self._send_dequeued(num - len(self._pending_requests))
+    download = self._downloads.pop(addr_id, None)
+    if download is not None:
+      for response in [download.iterator] + list(download.queue):
+        if hasattr(response, "close"):
+          response.close()  # runs the finally clauses of the generators
+    consumer = self._upload_consumers.pop(addr_id, None)
+    if consumer is not None:
+      try:
+        consumer(None, True)
+      except Exception:
+        logging.exception("Failed to abort the streamed request")
+    if self.close_handler:
+      try:
+        self.close_handler(addr_id)
+      except Exception:
+        logging.exception("Failed to handle the closed connection")
+
+  def _inbound_callback(self, addr_id, buf, offset, num_bytes, deadline):
+    if not self._pending_requests:
+      self._io_loop.add_callback(self._process_requests)
+    self._pending_requests.append((addr_id, bytes(buf[offset:offset + num_bytes]), deadline))
+
+  def _control_callback(self, buf, offset, num_bytes):
+    if buf[offset] == CONTROL_CANCEL:
+      self._cancel_requests(bytes(buf[offset + 1:offset + 7]))
+    elif buf[offset] == CONTROL_HANDOFF:
+      self._handoff_addr_ids.append(bytes(buf[offset + 1:offset + 7]))
+      self._adopt_connections()
+    elif buf[offset] == CONTROL_CREDIT:
+      self._download_credit(bytes(buf[offset + 1:offset + 7]))
 
-  def _inbound_callback(self, addr_id, payload):
-    callback = functools.partial(self.payload_callback, addr_id)
-    self._payload_handler(payload, callback)
+  def _process_requests(self):
+    batch_size = 0
+    # a handler may cancel the requests of a connection, which replaces the queue.
+    while self._pending_requests and batch_size < self.max_batch_size:
+      addr_id, payload, deadline = self._pending_requests.popleft()
+      batch_size += 1
+      if deadline is not None and deadline < time.time():
+        continue  # the client no longer waits for the result.
+      callback = functools.partial(self.payload_callback, addr_id)
+      self._payload_handler(payload, callback)
+    self._send_dequeued(batch_size)
+    if self._pending_requests:
+      self._io_loop.add_callback(self._process_requests)
 
 def main():
   # only for test
@@ -149,7 +739,7 @@ def main():
   def www_handler(payload, callback):
     callback("HTTP/1.1 200 OK\r\nKeep-Alive: timeout=5, max=100\r\nConnection: Keep-Alive\r\nContent-Length: 12\r\n\r\nHello world!\r\n")
   io_loop = ioloop.IOLoop()
-  server = SocketServer(20000, www_handler, io_loop, worker_num = 8)
+  server = SocketServer(20000, www_handler, io_loop, worker_num = 8, idle_timeout = 5)
   server.start()
 
 if __name__ == '__main__':
@@ -0,0 +1,47 @@
+import socket
+import unittest
+from channel import pack_cancel
+from responsecache import ResponseCache, PayloadCacheKey
+from socketserver import SocketWorker, pack_connection_id
+
+class ConnectionIdTest(unittest.TestCase):
+  def test_serials_are_distinct_from_the_calls(self):
+    ids = [pack_connection_id(serial) for serial in (1, 2, 0xffff, 0x10000, 0xffffffff, 0x100000000)]
+    self.assertEqual(len(ids), len(set(ids)))
+    self.assertTrue(all(len(addr_id) == 6 for addr_id in ids))
+    cache = ResponseCache(PayloadCacheKey())
+    self.assertFalse(any(cache.is_call(addr_id) for addr_id in ids))
+
+class SocketWorkerTest(unittest.TestCase):
+  def setUp(self):
+    self.sockets = socket.socketpair()
+    self.served = []
+    self.worker = SocketWorker(self.sockets[1], 0, lambda payload, callback: self.served.append(payload))
+    self.worker._io_loop.callbacks = []
+    self.worker._io_loop.add_callback = self.worker._io_loop.callbacks.append
+
+  def tearDown(self):
+    for sock in self.sockets:
+      sock.close()
+
+  def _run_callbacks(self):
+    callbacks = self.worker._io_loop.callbacks
+    while callbacks:
+      callbacks.pop(0)()
+
+  def test_cancel_drops_the_backlog_between_batches(self):
+    self.worker.max_batch_size = 4
+    closed = pack_connection_id(1)
+    for i in xrange(10):
+      self.worker._inbound_callback(closed, bytearray("a%d" % i), 0, 2, None)
+      self.worker._inbound_callback(pack_connection_id(2), bytearray("b%d" % i), 0, 2, None)
+    callbacks = self.worker._io_loop.callbacks
+    callbacks.pop(0)()  # the first batch
+    self.assertEqual(["a0", "b0", "a1", "b1"], self.served)
+    msg = pack_cancel(closed)
+    self.worker._control_callback(msg, 0, len(msg))
+    self._run_callbacks()
+    self.assertEqual(["a0", "b0", "a1", "b1"] + ["b%d" % i for i in xrange(2, 10)], self.served)
+
+if __name__ == '__main__':
+  unittest.main()
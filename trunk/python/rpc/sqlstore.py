@@ -0,0 +1,484 @@
+import bisect
+import heapq
+import json
+import re
+import time
+import zlib
+
+"""The sharded SQL data store, the same layout as Zopt\\Storage\\ShardSqlDataStoreClient.
+
+Every shard database has the tables:
+  meta_table_of_table (tableName, config): the tables of the data store.
+  <table> (familyName, config): the families of the table.
+  <table>_<family> (rowKey, data): the rows, data is a json object {qualifier: value}.
+
+A row key goes to the shard of the largest id no greater than crc32(row key),
+or the shard of the largest id if there isn't such one.
+
+As the rows are hashed over the shards, a scan of a key range reads all the
+shards: each family table of each shard is read in key order by batches, and
+the streams are merged through a heap, so that the memory of a scan is bounded
+by the batch size whatever the size of the range.
+"""
+
+_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_]+$")
+MAX_FAMILY_LENGTH = 31
+MAX_KEY_LENGTH = 255
+
+class DataStoreError(Exception):
+  pass
+
+def _check_name(name):
+  if not _NAME_PATTERN.match(name):
+    raise DataStoreError("Invalid name: %r." % name)
+  return name
+
+def parse_column(column):
+  """Returns (family, qualifier) of a column, qualifier is None for the whole family.
+
+  "family" - all the qualifiers of the family
+  "family:" - the implicit qualifier "*"
+  "family:qualifier" - the qualifier
+  """
+  components = column.split(":")
+  if len(components) > 2:
+    raise DataStoreError("Unrecognized column format: %s." % column)
+  if len(components) == 1:
+    return components[0], None
+  return components[0], components[1] or "*"
+
+class _ConnectionPool(object):
+  """The idle connections of one shard, which are reused across requests."""
+
+  def __init__(self, connect, max_idle_num=4):
+    """Initiate the pool.
+
+    Args:
+      connect: The function opening a DB-API connection to the shard.
+          Function fingerprint: connect()
+      max_idle_num: Maximum number of idle connections kept open.
+    """
+    self._connect = connect
+    self._max_idle_num = max_idle_num
+    self._idle_connections = []
+
+  def acquire(self):
+    if self._idle_connections:
+      return self._idle_connections.pop()
+    return self._connect()
+
+  def release(self, connection, broken=False):
+    """Returns the connection to the pool, or closes it if it's broken or the pool is full."""
+    if broken or len(self._idle_connections) >= self._max_idle_num:
+      try:
+        connection.close()
+      except Exception:
+        pass
+      return
+    self._idle_connections.append(connection)
+
+  def close(self):
+    while self._idle_connections:
+      self._idle_connections.pop().close()
+
+class _Transaction(object):
+  """Runs the statements in one transaction on a pooled connection.
+
+  Usage:
+    with _Transaction(pool) as cursor:
+      cursor.execute(...)
+  """
+
+  def __init__(self, pool):
+    self._pool = pool
+    self._connection = None
+
+  def __enter__(self):
+    self._connection = self._pool.acquire()
+    return self._connection.cursor()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    connection = self._connection
+    try:
+      if exc_type is None:
+        connection.commit()
+      else:
+        connection.rollback()
+    except Exception:
+      self._pool.release(connection, True)
+      raise
+    self._pool.release(connection)
+    return False
+
+class ShardSqlStore(object):
+  def __init__(self, shards, meta_ttl=60, max_idle_num=4):
+    """Initiate the data store.
+
+    Args:
+      shards: The connect functions of the shard databases by the shard ids, {shard_id: connect}.
+          The shard id is the lowest crc32 of the row keys it holds.  The connections
+          should use the qmark paramstyle, e.g. sqlite3.
+      meta_ttl: Seconds the table / family meta data is cached, as the other
+          processes may change it.  The changes made by this store evict it at once.
+      max_idle_num: Maximum number of idle connections kept open to each shard.
+    """
+    self._shard_ids = sorted(shards)  # the shard ring, searched by bisect
+    self._pools = [_ConnectionPool(shards[shard_id], max_idle_num) for shard_id in self._shard_ids]
+    self._meta_ttl = meta_ttl
+    self._meta = None  # {table: [family, ...]}
+    self._meta_expire_time = 0
+
+  def close(self):
+    for pool in self._pools:
+      pool.close()
+
+  def _get_shard(self, row_key):
+    """Returns the index of the shard holding the row, in O(log N)."""
+    if isinstance(row_key, unicode):
+      row_key = row_key.encode("utf-8")
+    row_id = zlib.crc32(row_key) & 0xffffffff
+    return (bisect.bisect_right(self._shard_ids, row_id) - 1) % len(self._shard_ids)
+
+  def _group_by_shard(self, row_keys):
+    shard_keys = {}
+    for row_key in row_keys:
+      shard_keys.setdefault(self._get_shard(row_key), []).append(row_key)
+    return shard_keys
+
+  def get_meta(self):
+    """Returns the meta data {table: [family, ...]}, which is the same in all shards."""
+    now = time.time()
+    if self._meta is None or now >= self._meta_expire_time:
+      self._meta = self._get_meta_from_dbs()
+      self._meta_expire_time = now + self._meta_ttl
+    return self._meta
+
+  def evict_meta(self):
+    self._meta = None
+
+  def _get_meta_from_dbs(self):
+    meta = None
+    for pool in self._pools:
+      shard_meta = {}
+      with _Transaction(pool) as cursor:
+        cursor.execute("SELECT `tableName` FROM `meta_table_of_table`")
+        for (table,) in cursor.fetchall():
+          cursor.execute("SELECT `familyName` FROM `%s`" % _check_name(table))
+          shard_meta[table] = sorted(family for (family,) in cursor.fetchall())
+      if meta is not None and meta != shard_meta:
+        raise DataStoreError("Meta data error: table / family name mismatch in shard dbs.")
+      meta = shard_meta
+    return meta
+
+  def _get_families(self, table):
+    families = self.get_meta().get(table)
+    if families is None:
+      raise DataStoreError("%s is not found." % table)
+    return families
+
+  def _ddl(self, statements):
+    """Runs the statements on every shard, and evicts the meta data."""
+    try:
+      for pool in self._pools:
+        with _Transaction(pool) as cursor:
+          for statement, params in statements:
+            cursor.execute(statement, params)
+    finally:
+      self.evict_meta()
+
+  def get_table_names(self):
+    return sorted(self.get_meta())
+
+  def create_table(self, table):
+    """Creates the table, returns False if it already exists."""
+    if table in self.get_meta():
+      return False
+    self._ddl([("CREATE TABLE `%s` (`familyName` CHAR(%d) NOT NULL, `config` BLOB, PRIMARY KEY(`familyName`))" %
+                (_check_name(table), MAX_FAMILY_LENGTH), ()),
+               ("INSERT INTO `meta_table_of_table` (`tableName`, `config`) VALUES (?, '')", (table,))])
+    return True
+
+  def delete_table(self, table):
+    """Deletes the table with its families, returns False if it doesn't exist."""
+    families = self.get_meta().get(table)
+    if families is None:
+      return False
+    self._ddl([("DROP TABLE `%s_%s`" % (table, family), ()) for family in families] +
+              [("DROP TABLE `%s`" % table, ()),
+               ("DELETE FROM `meta_table_of_table` WHERE `tableName` = ?", (table,))])
+    return True
+
+  def create_family(self, table, family):
+    """Creates the family in the table, returns False if it already exists."""
+    if family in self._get_families(table):
+      return False
+    self._ddl([("CREATE TABLE `%s_%s` (`rowKey` VARCHAR(%d) NOT NULL, `data` MEDIUMBLOB, PRIMARY KEY(`rowKey`))" %
+                (table, _check_name(family), MAX_KEY_LENGTH), ()),
+               ("INSERT INTO `%s` (`familyName`, `config`) VALUES (?, '')" % table, (family,))])
+    return True
+
+  def delete_family(self, table, family):
+    """Deletes the family from the table, returns False if it doesn't exist."""
+    if family not in self._get_families(table):
+      return False
+    self._ddl([("DROP TABLE `%s_%s`" % (table, family), ()),
+               ("DELETE FROM `%s` WHERE `familyName` = ?" % table, (family,))])
+    return True
+
+  def _select_families(self, cursor, table, families, row_keys):
+    """Returns {row_key: {family: {qualifier: value}}} of the rows in one shard, one query per family."""
+    rows = {}
+    placeholders = ",".join("?" * len(row_keys))
+    for family in families:
+      cursor.execute("SELECT `rowKey`, `data` FROM `%s_%s` WHERE `rowKey` IN (%s)" % (table, family, placeholders),
+                     row_keys)
+      for row_key, data in cursor.fetchall():
+        rows.setdefault(row_key, {})[family] = json.loads(data)
+    return rows
+
+  def get_rows(self, table, row_keys, columns=None):
+    """Returns {row_key: {column: value}} of the rows, batched per shard; the missing rows are omitted.
+
+    Args:
+      table: The table.
+      row_keys: The row keys.
+      columns: The columns to return, see parse_column; None for all the qualifiers of all the families.
+          A whole family column returns {qualifier: value}.
+    """
+    all_families = self._get_families(table)
+    if columns:
+      families = []
+      for column in columns:
+        family = parse_column(column)[0]
+        if family not in all_families:
+          raise DataStoreError("Unrecognized family: %s for table %s." % (family, table))
+        if family not in families:
+          families.append(family)
+    else:
+      families = all_families
+    results = {}
+    for shard, shard_keys in self._group_by_shard(row_keys).iteritems():
+      with _Transaction(self._pools[shard]) as cursor:
+        rows = self._select_families(cursor, table, families, shard_keys)
+      for row_key, family_results in rows.iteritems():
+        results[row_key] = self._format_row(family_results, columns)
+    return results
+
+  @staticmethod
+  def _format_row(family_results, columns):
+    row = {}
+    if not columns:
+      for family, qualifiers in family_results.iteritems():
+        for qualifier, value in qualifiers.iteritems():
+          row[family if qualifier == "*" else "%s:%s" % (family, qualifier)] = value
+      return row
+    for column in columns:
+      family, qualifier = parse_column(column)
+      qualifiers = family_results.get(family)
+      if qualifiers is None:
+        continue
+      if qualifier is None:
+        row[column] = qualifiers
+      elif qualifier in qualifiers:
+        row[column] = qualifiers[qualifier]
+    return row
+
+  def mutate_rows(self, table, row_mutations):
+    """Applies the mutations to the rows, atomically for each shard; returns the updated rows.
+
+    Args:
+      table: The table.
+      row_mutations: {row_key: [(is_delete, column, value), ...]}.  Deleting a
+          whole family column removes the family from the row.
+
+    Returns:
+      {row_key: {column: value}} of the mutated rows, without the ones which are now empty.
+    """
+    all_families = self._get_families(table)
+    results = {}
+    for shard, shard_keys in self._group_by_shard(row_mutations).iteritems():
+      families = set()
+      for row_key in shard_keys:
+        for is_delete, column, value in row_mutations[row_key]:
+          family = parse_column(column)[0]
+          if family not in all_families:
+            raise DataStoreError("Unrecognized family: %s for table %s." % (family, table))
+          families.add(family)
+      with _Transaction(self._pools[shard]) as cursor:
+        rows = self._select_families(cursor, table, all_families, shard_keys)
+        for family in families:
+          updates = []
+          deletes = []
+          for row_key in shard_keys:
+            family_results = rows.setdefault(row_key, {})
+            qualifiers = family_results.get(family, {})
+            touched = False
+            for is_delete, column, value in row_mutations[row_key]:
+              column_family, qualifier = parse_column(column)
+              if column_family != family:
+                continue
+              touched = True
+              if qualifier is None and is_delete:
+                qualifiers = {}
+              elif qualifier is None:
+                qualifiers = dict(value) if isinstance(value, dict) else {"*": value}
+              elif is_delete:
+                qualifiers.pop(qualifier, None)
+              else:
+                qualifiers[qualifier] = value
+            if not touched:
+              continue
+            if qualifiers:
+              family_results[family] = qualifiers
+              updates.append((row_key, json.dumps(qualifiers)))
+            else:
+              family_results.pop(family, None)
+              deletes.append((row_key,))
+          full_name = "%s_%s" % (table, family)
+          if updates:
+            cursor.executemany("REPLACE INTO `%s` (`rowKey`, `data`) VALUES (?, ?)" % full_name, updates)
+          if deletes:
+            cursor.executemany("DELETE FROM `%s` WHERE `rowKey` = ?" % full_name, deletes)
+      for row_key in shard_keys:
+        if rows.get(row_key):
+          results[row_key] = self._format_row(rows[row_key], None)
+    return results
+
+  def delete_rows(self, table, row_keys):
+    """Deletes the rows, batched per shard; returns the keys of the rows which were found."""
+    families = self._get_families(table)
+    deleted = set()
+    for shard, shard_keys in self._group_by_shard(row_keys).iteritems():
+      placeholders = ",".join("?" * len(shard_keys))
+      with _Transaction(self._pools[shard]) as cursor:
+        for family in families:
+          full_name = "%s_%s" % (table, family)
+          cursor.execute("SELECT `rowKey` FROM `%s` WHERE `rowKey` IN (%s)" % (full_name, placeholders), shard_keys)
+          deleted.update(row_key for (row_key,) in cursor.fetchall())
+          cursor.execute("DELETE FROM `%s` WHERE `rowKey` IN (%s)" % (full_name, placeholders), shard_keys)
+    return sorted(deleted)
+
+  def open_scanner(self, table, start_row_key="", stop_row_key=None, columns=None, batch_size=256):
+    """Returns a Scanner of the rows in [start_row_key, stop_row_key) in key order.
+
+    Args:
+      table: The table.
+      start_row_key: The row key that the scan starts with (inclusive).
+      stop_row_key: The row key that the scan stops with (exclusive), None for the end of the table.
+      columns: The columns to return, see get_rows.
+      batch_size: Number of the rows read from each family table of each shard at a time.
+    """
+    all_families = self._get_families(table)
+    families = all_families
+    if columns:
+      families = sorted(set(parse_column(column)[0] for column in columns))
+      for family in families:
+        if family not in all_families:
+          raise DataStoreError("Unrecognized family: %s for table %s." % (family, table))
+    streams = [_FamilyStream(pool, table, family, start_row_key, stop_row_key, batch_size)
+               for pool in self._pools for family in families]
+    return Scanner(streams, columns)
+
+class _FamilyStream(object):
+  """The rows of one family table in one shard, read in key order by batches.
+
+  Each batch is a separate keyset query starting after the last key read, so
+  that no transaction or DB cursor is kept open between the batches.
+  """
+
+  def __init__(self, pool, table, family, start_row_key, stop_row_key, batch_size):
+    self.family = family
+    self._pool = pool
+    self._batch_size = batch_size
+    self._query = "SELECT `rowKey`, `data` FROM `%s_%s` WHERE `rowKey` %s ?%s ORDER BY `rowKey` LIMIT %d" % (
+        table, family, "%s", "" if stop_row_key is None else " AND `rowKey` < ?", batch_size)
+    self._stop_row_key = stop_row_key
+    self._last_row_key = start_row_key
+    self._started = False
+    self._rows = []  # the rows read in reverse key order, popped from the end
+    self.exhausted = False  # no more rows in the table
+
+  def fetch(self):
+    """Reads the next batch of rows, in front of the ones not consumed yet."""
+    if self.exhausted:
+      return
+    params = [self._last_row_key]
+    if self._stop_row_key is not None:
+      params.append(self._stop_row_key)
+    with _Transaction(self._pool) as cursor:
+      cursor.execute(self._query % (">" if self._started else ">="), params)
+      rows = cursor.fetchall()
+    self._started = True
+    if len(rows) < self._batch_size:
+      self.exhausted = True
+    if rows:
+      self._last_row_key = rows[-1][0]
+      rows.reverse()
+      self._rows[:0] = rows
+
+  def prefetch(self):
+    """Reads the next batch if half of the last one has been consumed."""
+    if len(self._rows) < self._batch_size / 2:
+      self.fetch()
+
+  def peek(self):
+    """Returns the key of the next row, or None at the end."""
+    if not self._rows:
+      self.fetch()
+    return self._rows[-1][0] if self._rows else None
+
+  def pop(self):
+    """Returns (row_key, {qualifier: value}) of the next row."""
+    row_key, data = self._rows.pop()
+    return row_key, json.loads(data)
+
+class Scanner(object):
+  """The merged rows of the family streams of all the shards, in key order."""
+
+  def __init__(self, streams, columns):
+    self._streams = streams
+    self._columns = columns
+    self._heap = []  # (row_key, stream index) of the next row of each stream
+    for index, stream in enumerate(streams):
+      row_key = stream.peek()
+      if row_key is not None:
+        self._heap.append((row_key, index))
+    heapq.heapify(self._heap)
+
+  @property
+  def done(self):
+    return not self._heap
+
+  def next(self, count):
+    """Returns the next count rows in a list of (row_key, {column: value})."""
+    heap = self._heap
+    streams = self._streams
+    results = []
+    while heap and len(results) < count:
+      row_key = heap[0][0]
+      family_results = {}
+      # the families of the row are the heads of the other streams with the same key.
+      while heap and heap[0][0] == row_key:
+        index = heap[0][1]
+        stream = streams[index]
+        family_results[stream.family] = stream.pop()[1]
+        next_row_key = stream.peek()
+        if next_row_key is None:
+          heapq.heappop(heap)
+        else:
+          heapq.heapreplace(heap, (next_row_key, index))
+      row = ShardSqlStore._format_row(family_results, self._columns)
+      if row:
+        results.append((row_key, row))
+    return results
+
+  def prefetch(self):
+    """Reads ahead the streams which have consumed half of their batch, e.g. while the client consumes the last rows."""
+    for stream in self._streams:
+      stream.prefetch()
+
+def init_shard_db(connection):
+  """Creates the meta table in a new shard database."""
+  connection.execute("CREATE TABLE IF NOT EXISTS `meta_table_of_table` "
+                     "(`tableName` VARCHAR(255) NOT NULL, `config` BLOB, PRIMARY KEY(`tableName`))")
+  connection.commit()
@@ -0,0 +1,135 @@
+import logging
+import time
+from tornado import ioloop
+
+try:
+  import stackless
+  greenlet = None
+except ImportError:
+  stackless = None
+  try:
+    from greenlet import greenlet
+  except ImportError:
+    greenlet = None
+
+"""Runs the payload handlers in tasklets, so that they call the other services in blocking style.
+
+A callback-style handler which calls another service has to continue in the
+callback, and a handler calling a few in turn ends up as nested callbacks.
+With tasklet_handler, each request runs in its own lightweight tasklet
+(Stackless Python) or greenlet, and call() suspends it until the callback of
+an async api fires, while the worker's IOLoop serves the other requests:
+
+  def get_profile(payload, callback):
+    users = tasklet.call(provider.get_users, uids, token)
+    friends = tasklet.call(provider.get_friends, uid, token, 0, 100)
+    return json.dumps([users, friends])
+
+  server = SocketServer(port, tasklet.tasklet_handler(get_profile))
+
+A suspended tasklet keeps only its own frames, a few KB, so a worker holds
+thousands of requests in flight.  The tasklets must not block on sockets
+themselves, e.g. the synchronous SqlDataStore still blocks the whole worker.
+"""
+
+def available():
+  """Returns True if tasklets are supported, by either Stackless Python or the greenlet module."""
+  return stackless is not None or greenlet is not None
+
+def in_tasklet():
+  """Returns True if the caller runs in a handler tasklet, where call() may suspend."""
+  if stackless is not None:
+    return stackless.getcurrent() is not stackless.getmain()
+  return greenlet is not None and greenlet.getcurrent().parent is not None
+
+def _spawn(func, *args):
+  """Runs func in a new tasklet until it finishes or suspends."""
+  if stackless is not None:
+    stackless.tasklet(func)(*args).run()
+  else:
+    greenlet(func).switch(*args)
+
+class _Waiter(object):
+  """The callback a suspended tasklet waits for."""
+
+  def __init__(self):
+    self.done = False
+    self.value = None
+    self._suspended = None  # the channel (Stackless) or greenlet to resume
+
+  def callback(self, *args):
+    if self.done:
+      logging.warning("Callback of a tasklet call fired twice")
+      return
+    self.done = True
+    self.value = args[0] if len(args) == 1 else (args or None)
+    if self._suspended is None:
+      return  # completed before the tasklet suspends
+    if in_tasklet():
+      # resuming it here would strand the current tasklet, so it's resumed from the loop.
+      ioloop.IOLoop.instance().add_callback(self._resume)
+    else:
+      self._resume()
+
+  def _resume(self):
+    suspended = self._suspended
+    self._suspended = None
+    if stackless is not None:
+      suspended.send(None)
+    else:
+      suspended.switch()
+
+  def wait(self):
+    if not self.done:
+      if stackless is not None:
+        self._suspended = stackless.channel()
+        self._suspended.receive()
+      else:
+        self._suspended = greenlet.getcurrent()
+        self._suspended.parent.switch()
+    return self.value
+
+def call(func, *args, **kwargs):
+  """Calls a callback-style function and suspends the current tasklet until it calls back.
+
+  Args:
+    func: The async function, which takes the callback as its last positional argument.
+    args: The other positional arguments of func.
+    kwargs: The keyword arguments of func.
+
+  Returns:
+    The argument of the callback, the tuple of the arguments if there are several, or None.
+  """
+  if not in_tasklet():
+    raise RuntimeError("tasklet.call must be called in a tasklet handler")
+  waiter = _Waiter()
+  func(*(args + (waiter.callback,)), **kwargs)
+  return waiter.wait()
+
+def sleep(seconds):
+  """Suspends the current tasklet for the given seconds."""
+  call(lambda callback: ioloop.IOLoop.instance().add_timeout(time.time() + seconds, callback))
+
+def tasklet_handler(handler):
+  """Wraps a handler into the payload handler of SocketServer, which runs each request in a tasklet.
+
+  Args:
+    handler: The handler, called the same as a payload handler but in a tasklet,
+        where it may call call().  It responds by callback, or by returning the
+        response, unless None.
+        Function fingerprint: handler(payload, callback)
+  """
+  if not available():
+    raise RuntimeError("tasklet_handler needs Stackless Python or the greenlet module")
+
+  def run(payload, callback):
+    try:
+      result = handler(payload, callback)
+      if result is not None:
+        callback(result)
+    except Exception:
+      logging.exception("Failed to handle the payload in a tasklet")
+
+  def payload_handler(payload, callback):
+    _spawn(run, payload, callback)
+  return payload_handler
@@ -8,7 +8,7 @@ class Echo(object):
   def __init__(self, sock):
     self.stream = iostream.IOStream(sock)
   def start(self):
-    self.stream.read_bytes(10, self.handle_req)
+    self.stream.read(10, self.handle_req)
   def handle_req(self, buf, offset, num_bytes):
     self.stream.write(buf, offset, num_bytes)
     self.stream.flush()
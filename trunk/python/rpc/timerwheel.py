@@ -0,0 +1,174 @@
+"""A hierarchical timer wheel driven by the IO loop.
+
+IOLoop.add_timeout keeps its timeouts in a heap, so adding and removing one
+costs O(log n).  With one timeout per connection, and the timeout pushed back
+on every read / write, that is too expensive for a large number of
+connections.  TimerWheel hashes the timers into the slots of several wheels
+of increasing granularity instead, so adding / removing a timer is O(1), and
+it costs the IO loop only one timeout per tick.
+"""
+
+import math
+import time
+from tornado import ioloop
+
+class HashedWheel(object):
+  """The hierarchical wheels which hash items by their expiring tick, without any clock.
+
+  The items should have the writable attributes:
+    expires: The tick on which the item expires, set before adding the item.
+    slot: The wheel slot holding the item, maintained by the wheel.
+  """
+
+  def __init__(self, wheel_sizes=(256, 64, 64, 64)):
+    """Initiate the wheels.
+
+    Args:
+      wheel_sizes: Number of slots of each wheel, from the finest to the coarsest.
+          The default covers 256 * 64 * 64 * 64 ticks.  Items beyond that are
+          parked in the coarsest wheel and re-hashed.
+    """
+    self.current_tick = 0  # could be moved freely while the wheel is empty
+    self._wheel_sizes = wheel_sizes
+    self._wheels = [[set() for _ in xrange(size)] for size in wheel_sizes]
+    self._spans = []  # number of ticks covered by one slot of each wheel
+    span = 1
+    for size in wheel_sizes:
+      self._spans.append(span)
+      span *= size
+    self._max_delta = span - 1
+    self._item_num = 0
+
+  def __len__(self):
+    return self._item_num
+
+  def add(self, item):
+    """Adds the item, which expires no earlier than the next tick."""
+    item.expires = max(item.expires, self.current_tick + 1)
+    self._hash(item)
+    self._item_num += 1
+
+  def remove(self, item):
+    """Removes the item if it's still in the wheel."""
+    if item.slot is not None:
+      item.slot.discard(item)
+      item.slot = None
+      self._item_num -= 1
+
+  def _hash(self, item):
+    """Puts the item into the wheel slot according to its expiring tick."""
+    delta = min(item.expires - self.current_tick, self._max_delta)
+    for level, size in enumerate(self._wheel_sizes):
+      span = self._spans[level]
+      if delta < span * size:
+        slot = self._wheels[level][((self.current_tick + delta) / span) % size]
+        break
+    slot.add(item)
+    item.slot = slot
+
+  def tick(self):
+    """Moves the wheel one tick forward, and returns the expired items."""
+    self.current_tick += 1
+    tick = self.current_tick
+    # cascades the items of the coarser wheels when the finer ones wrap around.
+    for level in xrange(1, len(self._wheel_sizes)):
+      if tick % self._spans[level]:
+        break
+      wheel = self._wheels[level]
+      index = (tick / self._spans[level]) % self._wheel_sizes[level]
+      items = wheel[index]
+      wheel[index] = set()
+      for item in items:
+        self._hash(item)
+    wheel = self._wheels[0]
+    index = tick % self._wheel_sizes[0]
+    items = wheel[index]
+    if not items:
+      return ()
+    wheel[index] = set()
+    expired = []
+    for item in items:
+      if item.expires > tick:
+        self._hash(item)  # parked beyond the range of the wheels
+        continue
+      item.slot = None
+      expired.append(item)
+    self._item_num -= len(expired)
+    return expired
+
+class _Timer(object):
+  """A timer registered on the timer wheel."""
+
+  __slots__ = ("deadline", "callback", "expires", "slot")
+
+  def __init__(self, deadline, callback):
+    self.deadline = deadline
+    self.callback = callback
+    self.expires = 0  # the tick on which this timer expires
+    self.slot = None  # the wheel slot holding this timer
+
+class TimerWheel(object):
+  def __init__(self, io_loop=None, tick=0.5, wheel_sizes=(256, 64, 64, 64)):
+    """Initiate the timer wheel.
+
+    Args:
+      io_loop: The IO loop, which drives the wheel; default using global IOLoop instance.
+      tick: The granularity of the wheel in seconds.  Timers may expire up to one tick late.
+      wheel_sizes: Number of slots of each wheel, from the finest to the coarsest.
+          The default covers 256 * 64 * 64 * 64 ticks, i.e. more than 6 years.
+    """
+    self.io_loop = io_loop or ioloop.IOLoop.instance()
+    self.tick = tick
+    self.now = time.time()  # refreshed on every tick, cheaper than calling time.time()
+    self._epoch = self.now
+    self._wheel = HashedWheel(wheel_sizes)
+    self._timeout = None  # the IO loop timeout of the next tick
+
+  def __len__(self):
+    return len(self._wheel)
+
+  def add_timeout(self, deadline, callback):
+    """Calls callback at the time deadline.
+
+    Args:
+      deadline: The absolute time (as time.time()) when the callback will be called.
+      callback: The function will be called.
+          Function fingerprint: callback()
+
+    Returns:
+      The timer handle, which could be passed to remove_timeout.
+    """
+    if self._timeout is None:
+      self._start()
+    timer = _Timer(deadline, callback)
+    timer.expires = int(math.ceil((deadline - self._epoch) / self.tick))
+    self._wheel.add(timer)
+    return timer
+
+  def remove_timeout(self, timer):
+    """Cancels a pending timer returned by add_timeout."""
+    self._wheel.remove(timer)
+
+  def _start(self):
+    """Starts ticking; the wheel is idle whenever it holds no timer."""
+    self.now = time.time()
+    self._wheel.current_tick = int((self.now - self._epoch) / self.tick)
+    self._schedule()
+
+  def _schedule(self):
+    next_tick_time = self._epoch + (self._wheel.current_tick + 1) * self.tick
+    self._timeout = self.io_loop.add_timeout(next_tick_time, self._on_tick)
+
+  def _on_tick(self):
+    self.now = time.time()
+    last_tick = int((self.now - self._epoch) / self.tick)
+    while self._wheel.current_tick < last_tick:
+      for timer in self._wheel.tick():
+        try:
+          timer.callback()
+        except:
+          self.io_loop.handle_callback_exception(timer.callback)
+    if len(self._wheel):
+      self._schedule()
+    else:
+      self._timeout = None
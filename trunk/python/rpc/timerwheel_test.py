@@ -0,0 +1,155 @@
+import unittest
+import iostream
+import timerwheel
+from timerwheel import HashedWheel, TimerWheel
+
+class _Clock(object):
+  """Stands for the time module, with a clock moved by the test."""
+
+  def __init__(self, now):
+    self.now = now
+
+  def time(self):
+    return self.now
+
+class _Loop(object):
+  """The IO loop interface used by TimerWheel and IOStream, whose timeouts are run by the test."""
+
+  READ = 1
+  WRITE = 4
+  ERROR = 0x18
+
+  def __init__(self):
+    self.timeouts = []
+
+  def add_timeout(self, deadline, callback):
+    timeout = [deadline, callback]
+    self.timeouts.append(timeout)
+    return timeout
+
+  def remove_timeout(self, timeout):
+    self.timeouts.remove(timeout)
+
+  def add_handler(self, fd, handler, events):
+    pass
+
+  def update_handler(self, fd, events):
+    pass
+
+  def remove_handler(self, fd):
+    pass
+
+  def add_callback(self, callback):
+    pass
+
+  def handle_callback_exception(self, callback):
+    raise
+
+  def run_until(self, clock, now):
+    """Moves the clock to now, running the timeouts due on the way."""
+    while True:
+      due = [timeout for timeout in self.timeouts if timeout[0] <= now]
+      if not due:
+        break
+      timeout = min(due)
+      self.timeouts.remove(timeout)
+      clock.now = timeout[0]
+      timeout[1]()
+    clock.now = now
+
+class _Socket(object):
+  def __init__(self):
+    self.closed = False
+
+  def setblocking(self, flag):
+    pass
+
+  def setsockopt(self, *args):
+    pass
+
+  def fileno(self):
+    return 7
+
+  def close(self):
+    self.closed = True
+
+class HashedWheelTest(unittest.TestCase):
+  def _item(self, expires):
+    item = type("Item", (object,), {})()
+    item.expires = expires
+    item.slot = None
+    return item
+
+  def test_expires_on_its_tick(self):
+    wheel = HashedWheel((4, 4))
+    items = [self._item(expires) for expires in (1, 3, 9, 40)]
+    for item in items:
+      wheel.add(item)
+    expired = {}
+    for tick in xrange(1, 41):
+      for item in wheel.tick():
+        expired[item.expires] = tick
+    self.assertEqual({1: 1, 3: 3, 9: 9, 40: 40}, expired)
+    self.assertEqual(0, len(wheel))
+
+  def test_remove(self):
+    wheel = HashedWheel()
+    item = self._item(2)
+    wheel.add(item)
+    wheel.remove(item)
+    wheel.remove(item)
+    self.assertEqual(0, len(wheel))
+    self.assertEqual((), wheel.tick() or ())
+
+class TimerWheelTest(unittest.TestCase):
+  def setUp(self):
+    self.clock = _Clock(1000.0)
+    self._time = timerwheel.time, iostream.time
+    timerwheel.time = iostream.time = self.clock
+    self.loop = _Loop()
+
+  def tearDown(self):
+    timerwheel.time, iostream.time = self._time
+
+  def test_arms_timer_on_empty_wheel(self):
+    wheel = TimerWheel(self.loop, tick=0.5)
+    fired = []
+    wheel.add_timeout(1002.0, lambda: fired.append(self.clock.now))
+    self.assertEqual(1, len(self.loop.timeouts))
+    self.loop.run_until(self.clock, 1010.0)
+    self.assertEqual(1, len(fired))
+    self.assertTrue(1002.0 <= fired[0] <= 1002.5)
+    self.assertEqual([], self.loop.timeouts)  # idle again
+
+  def test_remove_timeout(self):
+    wheel = TimerWheel(self.loop, tick=0.5)
+    fired = []
+    timer = wheel.add_timeout(1001.0, lambda: fired.append(1))
+    wheel.remove_timeout(timer)
+    self.loop.run_until(self.clock, 1010.0)
+    self.assertEqual([], fired)
+
+  def test_stream_idle_timeout_on_empty_wheel(self):
+    wheel = TimerWheel(self.loop, tick=0.5)
+    sock = _Socket()
+    stream = iostream.IOStream(sock, self.loop)
+    stream.set_timeouts(wheel, idle_timeout=2)
+    self.loop.run_until(self.clock, 1001.5)
+    self.assertFalse(sock.closed)
+    self.loop.run_until(self.clock, 1003.0)
+    self.assertTrue(sock.closed)
+
+  def test_stream_armed_after_idle_wheel(self):
+    wheel = TimerWheel(self.loop, tick=0.5)
+    wheel.add_timeout(1001.0, lambda: None)
+    self.loop.run_until(self.clock, 1060.0)  # the wheel has been idle for a minute
+    sock = _Socket()
+    stream = iostream.IOStream(sock, self.loop)
+    stream.set_timeouts(wheel, idle_timeout=2)
+    self.loop.run_until(self.clock, 1061.5)
+    self.assertFalse(sock.closed)
+    self.loop.run_until(self.clock, 1063.0)
+    self.assertTrue(sock.closed)
+
+if __name__ == '__main__':
+  unittest.main()
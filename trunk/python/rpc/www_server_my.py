@@ -3,10 +3,12 @@ import functools
 from tornado import ioloop
 import socket
 import iostream
+from timerwheel import TimerWheel
 
 class HttpHandler(object):
-  def __init__(self, sock):
+  def __init__(self, sock, timer_wheel):
     self.stream = iostream.IOStream(sock)
+    self.stream.set_timeouts(timer_wheel, idle_timeout=5)  # as advertised by Keep-Alive
     self.resp = bytearray("HTTP/1.1 200 OK\r\nKeep-Alive: timeout=5, max=100\r\nConnection: Keep-Alive\r\nContent-Length: 121\r\n\r\nHello world!\r\n")
     self.resp_size = len(self.resp)
   def start(self):
@@ -25,6 +27,7 @@ class Server(object):
     sock.listen(1024)
     self.listen_sock = sock
     self.io_loop = ioloop.IOLoop.instance()
+    self.timer_wheel = TimerWheel(self.io_loop)
 
   def connection_ready(self, sock, fd, events):
     while True:
@@ -35,7 +38,7 @@ class Server(object):
           raise
         return
       connection.setblocking(0)
-      data_stream = HttpHandler(connection)
+      data_stream = HttpHandler(connection, self.timer_wheel)
       data_stream.start()
 
   def start(self):